@@ -6,8 +6,7 @@ from chimera_supervisor.controllers.model import (Session, List, CheckTime, Chec
                                                   CheckDome, CheckTelescope, CheckWeatherStation,
                                                   CheckTransparency, CheckInstrumentFlag,
                                                   Response)
-from chimera_supervisor.controllers.iostatus_model import Session as ioSession
-from chimera_supervisor.controllers.iostatus_model import InstrumentOperationStatus, KeyList
+from chimera_supervisor.controllers.flagstore import FlagStore
 
 from chimera_supervisor.controllers.handlers import (CheckHandler, TimeHandler,
                                                      HumidityHandler, TemperatureHandler, TransparencyHandler,
@@ -15,6 +14,7 @@ from chimera_supervisor.controllers.handlers import (CheckHandler, TimeHandler,
                                                      DewHandler, AskListenerHandler,
                                                      DomeHandler, TelescopeHandler, CheckWeatherStationHandler)
 from chimera_supervisor.controllers import baseresponse
+from chimera_supervisor.controllers.weathersnapshot import WeatherSnapshot
 from chimera_supervisor.controllers.status import FlagStatus, ResponseStatus, InstrumentOperationFlag
 
 from chimera.core.exceptions import ObjectNotFoundException, InvalidLocationException
@@ -31,12 +31,12 @@ class CheckList(object):
 
     def __init__(self, controller):
 
-        self.currentHandler  = None
-        self.currentCheck    = None
-        self.currentResponse = None
-
         self.mustStop = threading.Event()
 
+        # Responses touching the same instrument are serialized with these locks
+        self._instrumentLocks = {}
+        self._instrumentLocksLock = threading.Lock()
+
         self.controller = controller
         self.log = controller.debuglog
 
@@ -56,6 +56,9 @@ class CheckList(object):
         self.itemsList = {}
         self.responseList = {}
 
+        self.weather = None
+        self.flags = None
+
     def __start__(self):
 
         self.log.debug('Starting...')
@@ -69,6 +72,10 @@ class CheckList(object):
         for handler in self.checkHandlers.values():
             self._injectInstrument(handler)
 
+        # Weather station readings are shared by all handlers
+        self.weather = WeatherSnapshot(self._weatherStations(), self.controller["weather_timeout"])
+        CheckHandler.weather = self.weather
+
         # Configure base responses
         for name,obj in inspect.getmembers(baseresponse):
             if inspect.isclass(obj) and issubclass(obj,baseresponse.BaseResponse):
@@ -80,34 +87,31 @@ class CheckList(object):
 
         # Todo: Configure user-defined responses
 
-        # Read instrument status flag from database
-        session = ioSession()
+        # Read instrument status flag from database and journal
         self.log.debug('Loading flags from the database')
+        self.flags = FlagStore(self.log, flush_interval=self.controller["flag_flush_interval"])
+        self.flags.start()
         for inst_ in self.controller.getInstrumentList():
-            status = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == inst_)
-            if status.count() == 0:
+            if inst_ not in self.flags:
                 self.log.warning("No %s intrument on database. Adding with status UNSET."%inst_)
-                iostatus = InstrumentOperationStatus(instrument = inst_,
-                                                     status = InstrumentOperationFlag.UNSET.index,
-                                                     lastUpdate = self.controller.site().ut().replace(tzinfo=None),
-                                                     lastChange = self.controller.site().ut().replace(tzinfo=None))
-                session.add(iostatus)
-                session.commit()
+                self.flags.add(inst_)
             else:
-                self.log.debug('%s[%s]' % (inst_,InstrumentOperationFlag[status[0].status]) )
+                self.log.debug('%s[%s]' % (inst_,self.flags.status(inst_)) )
                 self.controller.setFlag(inst_,
-                                        InstrumentOperationFlag[status[0].status],
+                                        self.flags.status(inst_),
                                         False)
 
 
         return
 
+    def __stop__(self):
+        if self.flags is not None:
+            self.flags.stop()
+
     def check(self, item):
 
         t0 = time.time()
 
-        self.mustStop.clear()
-
         self.log.debug('Checking if item is active...')
         if not item.active:
             self.log.debug('Item is inactive. skipping...')
@@ -128,18 +132,17 @@ class CheckList(object):
             # Should be included in check?
 
             try:
-                self.currentCheck = check
                 try:
-                    self.currentHandler = self.checkHandlers[type(check)]
+                    currentHandler = self.checkHandlers[type(check)]
                 except KeyError:
                     self.log.error("No handler to %s item. Skipping it" % check)
                     continue
 
-                logMsg = str(self.currentHandler.log(check))
+                logMsg = str(currentHandler.log(check))
                 self.log.debug("[start] %s " % logMsg)
                 self.controller.checkBegin(check, logMsg)
 
-                i_status,i_msg = self.currentHandler.process(check) # return response id
+                i_status,i_msg = currentHandler.process(check) # return response id
                 # self.log.debug("%s and (%s or (%s != %s)) = %s" % (i_status,
                 #                                                    item.eager,
                 #                                                    i_status,
@@ -174,11 +177,19 @@ class CheckList(object):
             # Get response
             for response in item.response:
                 response_status = ResponseStatus.OK
+                currentResponse = None
                 try:
                     self.log.debug('%s' % response.response_id)
-                    self.currentResponse = self.responseList[response.response_id]
-                    self.controller.itemResponseBegin(item,self.currentResponse)
-                    self.currentResponse.process(response)
+                    currentResponse = self.responseList[response.response_id]
+                    self.controller.itemResponseBegin(item,currentResponse)
+                    locks = self._instrumentLocksFor(self._responseInstruments(response))
+                    for lock in locks:
+                        lock.acquire()
+                    try:
+                        currentResponse.process(response)
+                    finally:
+                        for lock in reversed(locks):
+                            lock.release()
                 except KeyError:
                     self.log.warning("No handler to response %s. Skipping it" % response.response_id)
                     response_status = ResponseStatus.ERROR
@@ -192,7 +203,7 @@ class CheckList(object):
                         self.log.info("Running in non-eager response mode. Stopping.")
                         break
                 finally:
-                    self.controller.itemResponseComplete(item, self.currentResponse, status)
+                    self.controller.itemResponseComplete(item, currentResponse, status)
 
             # currentResponse = self.responseList[item.response]
             #
@@ -207,6 +218,70 @@ class CheckList(object):
 
         self.log.debug("[finish] took: %f s" % (time.time() - t0))
 
+    def _checkInstruments(self, check):
+        instruments = set(getattr(self.checkHandlers.get(type(check), CheckHandler).process, "__requires__", []))
+        if isinstance(check, CheckInstrumentFlag):
+            instruments.add(str(check.instrument))
+        return instruments
+
+    def _responseInstruments(self, response):
+        instruments = set()
+        if response.response_id in self.responseList:
+            instruments.update(getattr(self.responseList[response.response_id].process, "__requires__", []))
+        if getattr(response, "instrument", None):
+            instruments.add(str(response.instrument))
+        # site is only read, no need to serialize on it
+        instruments.discard("site")
+        return instruments
+
+    def itemInstruments(self, item):
+        '''
+        Instruments an item reads (in its checks) and writes (in its responses). Used to find out which items can be
+        checked concurrently.
+
+        :return: (reads, writes) sets of instrument names.
+        '''
+        reads = set()
+        writes = set()
+        for check in item.check:
+            reads.update(self._checkInstruments(check))
+        for response in item.response:
+            writes.update(self._responseInstruments(response))
+        return reads, writes
+
+    def itemInputs(self, item):
+        '''
+        Inputs (see CheckHandler.inputs) the checks of an item depend on.
+        '''
+        inputs = set()
+        for check in item.check:
+            if type(check) in self.checkHandlers:
+                inputs.update(self.checkHandlers[type(check)].inputs(check))
+        return inputs
+
+    def itemDeadline(self, item):
+        '''
+        Earliest time at which a check of the item may change result by itself (see CheckHandler.deadline).
+        '''
+        deadlines = []
+        for check in item.check:
+            if type(check) not in self.checkHandlers:
+                continue
+            try:
+                deadline = self.checkHandlers[type(check)].deadline(check)
+            except Exception, e:
+                self.log.exception(e)
+                continue
+            if deadline is not None:
+                deadlines.append(deadline)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def _instrumentLocksFor(self, instruments):
+        # Always acquired in the same (sorted) order to avoid deadlocks between items.
+        with self._instrumentLocksLock:
+            return [self._instrumentLocks.setdefault(instrument, threading.Lock())
+                    for instrument in sorted(instruments)]
+
     def runActions(self, item):
         '''
         This funcion will run the responses of a given item without running the checklist.
@@ -218,7 +293,14 @@ class CheckList(object):
             try:
                 self.log.debug('%s' % response.response_id)
                 currentResponse = self.responseList[response.response_id]
-                currentResponse.process(response)
+                locks = self._instrumentLocksFor(self._responseInstruments(response))
+                for lock in locks:
+                    lock.acquire()
+                try:
+                    currentResponse.process(response)
+                finally:
+                    for lock in reversed(locks):
+                        lock.release()
             except KeyError:
                 self.log.error("No handler to response %s. Skipping it" % response.response_id)
                 return
@@ -228,69 +310,16 @@ class CheckList(object):
 
 
     def updateInstrumentStatus(self,instrument,status,key=None):
-        session = ioSession()
-        iostatus = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == instrument)[0]
-        iostatus_keys = session.query(KeyList).filter(KeyList.key_id == iostatus.id)
-        str_keys = [k.key for k in iostatus_keys]
-        active_keys = [k.active for k in iostatus_keys]
-        # session.commit()
-
         self.log.debug("Update %s status: %s -> %s" % (instrument,
-                                                       InstrumentOperationFlag[iostatus.status],
+                                                       self.flags.status(instrument),
                                                        status))
-        if iostatus.status != InstrumentOperationFlag.LOCK.index: # Instrument currently unlocked
-            iostatus.status = status.index # just flip status flag
-
-            if key is not None and status == InstrumentOperationFlag.LOCK: # new status is a lock
-                if key in str_keys: # Activating existing key
-                    iostatus_keys[str_keys.index(key)].active = True
-                    iostatus_keys[str_keys.index(key)].updatetime = self.controller.site().ut().replace(tzinfo=None)
-                else: # Creating new key
-                    newkey = KeyList(key_id=iostatus.id,
-                                     key=key,
-                                     updatetime=self.controller.site().ut().replace(tzinfo=None),
-                                     active=True)
-                    session.add(newkey)
-        else: # Instrument is locked
-
-            if status != InstrumentOperationFlag.LOCK: # it is an unlock operation
-                if key in str_keys:# and key is in the list
-                    active_keys[str_keys.index(key)] = False
-                    iostatus_keys[str_keys.index(key)].active = False
-                    iostatus_keys[str_keys.index(key)].updatetime = self.controller.site().ut().replace(tzinfo=None)
-                if True not in active_keys: # able to unlock instrument
-                    iostatus.status = status.index
-                else:
-                    # Could not unlock instrument
-                    session.commit()
-                    return False
-
-            else: # it is a new lock operation
-                if key in str_keys: # Activating existing key
-                    iostatus_keys[str_keys.index(key)].active = True
-                    iostatus_keys[str_keys.index(key)].updatetime = self.controller.site().ut().replace(tzinfo=None)
-                else: # Creating new key
-                    newkey = KeyList(key_id=iostatus.id,
-                                     key=key,
-                                     updatetime=self.controller.site().ut().replace(tzinfo=None),
-                                     active=True)
-                    session.add(newkey)
-
-        session.commit()
-        return True
+        return self.flags.update(instrument, status, key)
 
     def getInstrumentStatus(self,instrument):
-        session = ioSession()
-        iostatus = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == instrument)
-
-        return InstrumentOperationFlag[iostatus[0].status]
+        return self.flags.status(instrument)
 
     def instrumentKey(self,instrument):
-        session = ioSession()
-        iostatus = session.query(InstrumentOperationStatus).filter(InstrumentOperationStatus.instrument == instrument)[0]
-        iostatus_keys = session.query(KeyList).filter(KeyList.key_id == iostatus.id, KeyList.active == True)
-
-        return [k.key for k in iostatus_keys]
+        return self.flags.keys(instrument)
 
     def activate(self,item):
         session = Session()
@@ -328,6 +357,19 @@ class CheckList(object):
         return items
 
 
+    def _weatherStations(self):
+        if self.controller["weatherstations"] is None:
+            return []
+
+        weatherstations = []
+        for location in self.controller.getInstrumentLocationList("weatherstations"):
+            try:
+                weatherstations.append(self.controller.getManager().getProxy(location))
+            except Exception, e:
+                self.log.error('Could not get weather station %s' % location)
+                self.log.exception(e)
+        return weatherstations
+
     def _injectInstrument(self, handler):
         if not (issubclass(handler, CheckHandler) or issubclass(handler, baseresponse.BaseResponse)):
             return
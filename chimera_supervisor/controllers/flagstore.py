@@ -0,0 +1,261 @@
+'''
+Instrument operation flags and lock keys.
+
+The flags live in memory and are the authoritative copy, so reading them never touches the database. Every change is
+appended to a journal file and a background thread commits the changes, in batches, to the status database. On startup
+the state is read from the database in one query and the journal entries not committed yet are replayed over it.
+'''
+
+import os
+import json
+import datetime
+import threading
+
+from chimera_supervisor.core.constants import DEFAULT_STATUS_JOURNAL
+from chimera_supervisor.controllers.iostatus_model import Session as ioSession
+from chimera_supervisor.controllers.iostatus_model import InstrumentOperationStatus, KeyList
+from chimera_supervisor.controllers.status import InstrumentOperationFlag
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _formatTime(value):
+    return None if value is None else value.strftime(TIME_FORMAT)
+
+def _parseTime(value):
+    return None if value is None else datetime.datetime.strptime(value, TIME_FORMAT)
+
+class FlagStore(object):
+    '''
+    In-memory table of instrument status and lock keys. Entries are replaced (never modified in place) when they
+    change, so readers can use them without locking.
+    '''
+
+    def __init__(self, log, journal=DEFAULT_STATUS_JOURNAL, flush_interval=5.):
+        '''
+        :param log: Logger.
+        :param journal: Journal file. A second file, with ".old" appended, holds the batch being committed.
+        :param flush_interval: Time, in seconds, between commits to the database.
+        '''
+        self.log = log
+        self.journal = journal
+        self.flush_interval = float(flush_interval)
+
+        # instrument -> dict(status, keys, lastUpdate, lastChange), keys is a dict key -> (active, updatetime)
+        self._table = {}
+        self._pending = {}
+
+        self._writeLock = threading.Lock()
+        self._journalLock = threading.Lock()
+        self._journalFile = None
+
+        self._stop = threading.Event()
+        self._writer = None
+
+    def start(self):
+        '''
+        Load the flags and start the write-behind thread.
+        '''
+        self._load()
+        self._journalFile = open(self.journal, 'a')
+
+        self._writer = threading.Thread(target=self._writeBehind)
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def stop(self):
+        '''
+        Stop the write-behind thread, committing whatever is pending.
+        '''
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        self.flush()
+        with self._journalLock:
+            if self._journalFile is not None:
+                self._journalFile.close()
+                self._journalFile = None
+
+    def __contains__(self, instrument):
+        return instrument in self._table
+
+    def status(self, instrument):
+        return InstrumentOperationFlag[self._table[instrument]['status']]
+
+    def keys(self, instrument):
+        '''
+        Active keys locking the instrument.
+        '''
+        return [key for key, (active, updatetime) in self._table[instrument]['keys'].items() if active]
+
+    def add(self, instrument, status=InstrumentOperationFlag.UNSET):
+        now = datetime.datetime.utcnow()
+        with self._writeLock:
+            self._set(instrument, dict(status=status.index, keys={}, lastUpdate=now, lastChange=now))
+
+    def update(self, instrument, status, key=None):
+        '''
+        Change the status of an instrument. A locked instrument can only be unlocked after all its keys are released.
+
+        :return: False if the instrument is still locked by other keys, True otherwise.
+        '''
+        now = datetime.datetime.utcnow()
+
+        with self._writeLock:
+            entry = self._table[instrument]
+            keys = dict(entry['keys'])
+            new = dict(entry, keys=keys, lastUpdate=now)
+
+            if entry['status'] != InstrumentOperationFlag.LOCK.index: # Instrument currently unlocked
+                new['status'] = status.index # just flip status flag
+                if key is not None and status == InstrumentOperationFlag.LOCK: # new status is a lock
+                    keys[key] = (True, now)
+
+            elif status != InstrumentOperationFlag.LOCK: # Locked and it is an unlock operation
+                if key in keys:
+                    keys[key] = (False, now)
+                if True not in [active for active, updatetime in keys.values()]: # able to unlock instrument
+                    new['status'] = status.index
+                else:
+                    # Could not unlock instrument
+                    self._set(instrument, new)
+                    return False
+
+            else: # it is a new lock operation
+                keys[key] = (True, now)
+
+            if new['status'] != entry['status']:
+                new['lastChange'] = now
+
+            self._set(instrument, new)
+
+        return True
+
+    def _set(self, instrument, entry):
+        # Called with the write lock held.
+        table = dict(self._table)
+        table[instrument] = entry
+        self._table = table
+
+        with self._journalLock:
+            self._pending[instrument] = entry
+            if self._journalFile is not None:
+                self._journalFile.write(json.dumps(self._dump(instrument, entry)) + '\n')
+                self._journalFile.flush()
+
+    @staticmethod
+    def _dump(instrument, entry):
+        return dict(instrument=instrument,
+                    status=entry['status'],
+                    keys=dict([(key, (active, _formatTime(updatetime)))
+                               for key, (active, updatetime) in entry['keys'].items()]),
+                    lastUpdate=_formatTime(entry['lastUpdate']),
+                    lastChange=_formatTime(entry['lastChange']))
+
+    @staticmethod
+    def _parse(record):
+        return dict(status=record['status'],
+                    keys=dict([(str(key), (active, _parseTime(updatetime)))
+                               for key, (active, updatetime) in record['keys'].items()]),
+                    lastUpdate=_parseTime(record['lastUpdate']),
+                    lastChange=_parseTime(record['lastChange']))
+
+    def _load(self):
+        session = ioSession()
+        table = {}
+        try:
+            for iostatus in session.query(InstrumentOperationStatus):
+                table[str(iostatus.instrument)] = dict(status=iostatus.status,
+                                                       keys={},
+                                                       lastUpdate=iostatus.lastUpdate,
+                                                       lastChange=iostatus.lastChange)
+            for key, instrument in session.query(KeyList, InstrumentOperationStatus.instrument).join(
+                    InstrumentOperationStatus, KeyList.key_id == InstrumentOperationStatus.id):
+                table[str(instrument)]['keys'][str(key.key)] = (key.active, key.updatetime)
+        finally:
+            session.commit()
+
+        # Entries written to the journal but not committed to the database (previous run did not stop cleanly).
+        # Records hold the whole state of the instrument, so replaying them in order is enough.
+        for filename in (self.journal + '.old', self.journal):
+            if not os.path.exists(filename):
+                continue
+            with open(filename) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Incomplete last line
+                        continue
+                    table[str(record['instrument'])] = self._parse(record)
+                    self._pending[str(record['instrument'])] = table[str(record['instrument'])]
+
+        self._table = table
+        self.flush()
+
+    def _writeBehind(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception, e:
+                self.log.error('Could not commit instrument flags. Will try again.')
+                self.log.exception(e)
+
+    def _rotate(self):
+        # Called with the journal lock held. If the last commit failed, the old journal is still there and the new
+        # entries are appended to it.
+        if not os.path.exists(self.journal):
+            return
+        if os.path.exists(self.journal + '.old'):
+            with open(self.journal + '.old', 'a') as old, open(self.journal) as new:
+                old.write(new.read())
+            os.remove(self.journal)
+        else:
+            os.rename(self.journal, self.journal + '.old')
+
+    def flush(self):
+        '''
+        Commit the pending changes to the database in a single transaction and start a new journal.
+        '''
+        with self._journalLock:
+            if len(self._pending) == 0:
+                return
+            pending = self._pending
+            self._pending = {}
+            if self._journalFile is not None:
+                self._journalFile.close()
+            self._rotate()
+            self._journalFile = open(self.journal, 'a') if self._writer is not None else None
+
+        session = ioSession()
+        try:
+            current = dict([(str(iostatus.instrument), iostatus) for iostatus in
+                            session.query(InstrumentOperationStatus).filter(
+                                InstrumentOperationStatus.instrument.in_(pending.keys()))])
+            for instrument, entry in pending.items():
+                iostatus = current.get(instrument)
+                if iostatus is None:
+                    iostatus = InstrumentOperationStatus(instrument=instrument)
+                    session.add(iostatus)
+                iostatus.status = entry['status']
+                iostatus.lastUpdate = entry['lastUpdate']
+                iostatus.lastChange = entry['lastChange']
+
+                keylist = dict([(str(k.key), k) for k in iostatus.keylist])
+                for key, (active, updatetime) in entry['keys'].items():
+                    if key not in keylist:
+                        keylist[key] = KeyList(key=key)
+                        iostatus.keylist.append(keylist[key])
+                    keylist[key].active = active
+                    keylist[key].updatetime = updatetime
+            session.commit()
+        except Exception:
+            session.rollback()
+            # Keep the changes for the next flush. Newer entries win.
+            with self._journalLock:
+                for instrument, entry in pending.items():
+                    self._pending.setdefault(instrument, entry)
+            raise
+
+        if os.path.exists(self.journal + '.old'):
+            os.remove(self.journal + '.old')
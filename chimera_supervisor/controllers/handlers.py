@@ -15,6 +15,9 @@ def requires(instrument):
 
 class CheckHandler(object):
 
+    # WeatherSnapshot shared by all handlers. Set by the CheckList.
+    weather = None
+
     @staticmethod
     def process(check):
         pass
@@ -27,6 +30,31 @@ class CheckHandler(object):
     def log(check):
         return str(check)
 
+    @staticmethod
+    def inputs(check):
+        '''
+        Inputs the check result depends on. Used in reactive mode to re-check only the items affected by a change.
+        Weather readings are named "weather.<reading>", instrument flags "flag.<instrument>" and instrument events by
+        the instrument name.
+        '''
+        return []
+
+    @staticmethod
+    def deadline(check):
+        '''
+        Next time (UT datetime) at which the check result may change by itself, without any input changing. None if
+        it does not depend on time.
+        '''
+        return None
+
+def elapsedDeadline(check):
+    '''
+    Deadline of the checks that require a condition to hold for deltaTime hours (mode 1).
+    '''
+    if check.mode == 1 and check.time is not None:
+        return check.time + datetime.timedelta(hours=check.deltaTime)
+    return None
+
 class TimeHandler(CheckHandler):
     '''
     This class checks if now is before of after a specified time delta with respect to a specific sun event.
@@ -46,8 +74,7 @@ class TimeHandler(CheckHandler):
     sun is above the specified value or False, otherwise.
     '''
     @staticmethod
-    @requires("site")
-    def process(check):
+    def reference(check):
         site = TimeHandler.site[0]
 
         ut = site.ut()
@@ -72,6 +99,13 @@ class TimeHandler(CheckHandler):
         else:
             reftime = check.time
 
+        return ut, reftime
+
+    @staticmethod
+    @requires("site")
+    def process(check):
+        ut, reftime = TimeHandler.reference(check)
+
         if reftime is None:
             return False,"Could not determined reference time."
         elif check.mode >= 0:
@@ -92,6 +126,14 @@ class TimeHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def deadline(check):
+        ut, reftime = TimeHandler.reference(check)
+        if reftime is None:
+            return None
+        reftime += check.deltaTime
+        return reftime.replace(tzinfo=None) if reftime > ut else None
+
 
 class HumidityHandler(CheckHandler):
     '''
@@ -104,20 +146,11 @@ class HumidityHandler(CheckHandler):
     @requires("weatherstations")
     def process(check):
 
-        weatherstations = HumidityHandler.weatherstations
         site = HumidityHandler.site[0]
 
         manager = HumidityHandler.manager
 
-        humidity = None
-        for i in range(len(weatherstations)):
-            try:
-                h = weatherstations[i].humidity()
-                if datetime.datetime.utcnow() - h.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    humidity = h
-                    break
-            except:
-                pass
+        index, humidity = HumidityHandler.weather.first('humidity', manager["max_mins"])
 
         if humidity is None:
             return check.mode == 0, "No valid weather station data available!"
@@ -153,6 +186,14 @@ class HumidityHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.humidity']
+
+    @staticmethod
+    def deadline(check):
+        return elapsedDeadline(check)
+
 class TemperatureHandler(CheckHandler):
     '''
     This class checks if temperature is above or bellow some threshold.
@@ -163,20 +204,11 @@ class TemperatureHandler(CheckHandler):
     @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = TemperatureHandler.weatherstations
         site = TemperatureHandler.site[0]
 
         manager = TemperatureHandler.manager
 
-        temperature = None
-        for i in range(len(weatherstations)):
-            try:
-                t = weatherstations[i].temperature()
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    humidity = t
-                    break
-            except:
-                pass
+        index, temperature = TemperatureHandler.weather.first('temperature', manager["max_mins"])
 
         if temperature is None:
             return check.mode == 0, "No valid weather station data available!"
@@ -213,6 +245,14 @@ class TemperatureHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.temperature']
+
+    @staticmethod
+    def deadline(check):
+        return elapsedDeadline(check)
+
 class WindSpeedHandler(CheckHandler):
     '''
     This class checks if wind speed is above or bellow some threshold.
@@ -223,28 +263,20 @@ class WindSpeedHandler(CheckHandler):
     @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = WindSpeedHandler.weatherstations
         site = WindSpeedHandler.site[0]
 
         manager = WindSpeedHandler.manager
 
-        wind_speed_dict = {}
-        for i in range(len(weatherstations)):
-            try:
-                s = weatherstations[i].wind_speed()
-                if datetime.datetime.utcnow() - s.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    wind_speed_dict['%s' % weatherstations[i]] = s
-            except:
-                pass
+        wind_speed_list = WindSpeedHandler.weather.fresh('wind_speed', manager["max_mins"])
 
         msg = ''
-        if len(wind_speed_dict) == 0:
+        if len(wind_speed_list) == 0:
             return check.mode == 0, "No valid weather station data available!"
         else:
-            for key in wind_speed_dict.keys():
-                msg += "%s: %s" % (key, wind_speed_dict[key])
+            for key, value in wind_speed_list:
+                msg += "%s: %s" % (key, value)
 
-        windspeed = wind_speed_dict[wind_speed_dict.keys()[0]]
+        windspeed = wind_speed_list[0][1]
 
         if check.mode == 0:
             ret = check.windspeed < windspeed.value
@@ -278,6 +310,14 @@ class WindSpeedHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.wind_speed']
+
+    @staticmethod
+    def deadline(check):
+        return elapsedDeadline(check)
+
 class DewPointHandler(CheckHandler):
     '''
     This class checks if dew point is above or bellow some threshold.
@@ -297,6 +337,10 @@ class DewPointHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.dew_point']
+
 class TransparencyHandler(CheckHandler):
     '''
     This class checks if dew point is above or bellow some threshold.
@@ -306,20 +350,11 @@ class TransparencyHandler(CheckHandler):
     @staticmethod
     @requires("weatherstations")
     def process(check):
-        weatherstations = WindSpeedHandler.weatherstations
         site = WindSpeedHandler.site[0]
 
         manager = WindSpeedHandler.manager
 
-        transparency = None
-        for i in range(len(weatherstations)):
-            try:
-                t = weatherstations[i].sky_transparency()
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    transparency = t
-                    break
-            except:
-                pass
+        index, transparency = TransparencyHandler.weather.first('sky_transparency', manager["max_mins"])
 
         if transparency is None:
             return check.mode == 0, "No valid weather station data available!"
@@ -357,6 +392,14 @@ class TransparencyHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.sky_transparency']
+
+    @staticmethod
+    def deadline(check):
+        return elapsedDeadline(check)
+
 class AskListenerHandler(CheckHandler):
 
     @staticmethod
@@ -382,24 +425,13 @@ class DewHandler(CheckHandler):
     @requires("site")
     @requires("weatherstations")
     def process(check):
-        weatherstations = DewHandler.weatherstations
         site = DewHandler.site[0]
 
-        temperature = None # weatherstation.temperature()
-        dewpoint = None # weatherstation.dew_point()
-
         manager = DewHandler.manager
 
-        for i in range(len(weatherstations)):
-            try:
-                t = weatherstations[i].temperature()
-                d = weatherstations[i].dew_point()
-                if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
-                    temperature = t
-                    dewpoint = d
-                    break
-            except:
-                pass
+        # dew point is taken from the same station as the temperature
+        index, temperature = DewHandler.weather.first('temperature', manager["max_mins"])
+        dewpoint = None if index is None else DewHandler.weather.get(index, 'dew_point')
 
         if (temperature is None) or (dewpoint is None):
             return bool(check.mode == 0), "No valid weather station data available!"
@@ -442,6 +474,14 @@ class DewHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.temperature', 'weather.dew_point']
+
+    @staticmethod
+    def deadline(check):
+        return elapsedDeadline(check)
+
 
 class DomeHandler(CheckHandler):
     '''
@@ -475,6 +515,10 @@ class DomeHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['dome']
+
 
 class TelescopeHandler(CheckHandler):
     '''
@@ -541,17 +585,19 @@ class TelescopeHandler(CheckHandler):
     def log(check):
         return "%s"%(check)
 
+    @staticmethod
+    def inputs(check):
+        return ['telescope']
+
 class CheckWeatherStationHandler(CheckHandler):
 
     @staticmethod
     @requires("weatherstations")
     def process(check):
         manager = CheckWeatherStationHandler.manager
-        weatherstations = CheckWeatherStationHandler.weatherstations
 
-        ws = weatherstations[check.index]
         try:
-            t = ws.temperature()
+            t = CheckWeatherStationHandler.weather.get(check.index, 'temperature')
             if check.mode == 0:
                 # Check if WS is ok
                 if datetime.datetime.utcnow() - t.time < datetime.timedelta(minutes=manager["max_mins"]):
@@ -575,6 +621,10 @@ class CheckWeatherStationHandler(CheckHandler):
     def log(check):
         return "%s" % check
 
+    @staticmethod
+    def inputs(check):
+        return ['weather.temperature']
+
 class InstrumentFlagHandler(CheckHandler):
 
     @staticmethod
@@ -608,4 +658,8 @@ class InstrumentFlagHandler(CheckHandler):
 
     @staticmethod
     def log(check):
-        return '%s' % check
\ No newline at end of file
+        return '%s' % check
+
+    @staticmethod
+    def inputs(check):
+        return ['flag.%s' % check.instrument]
\ No newline at end of file
@@ -1,16 +1,19 @@
 from chimera_supervisor.core.constants import DEFAULT_STATUS_DATABASE
+from chimera_supervisor.core.database import Database
 
 from sqlalchemy import (Column, String, Integer, DateTime, Boolean, ForeignKey,
-                        Float, PickleType, MetaData, create_engine)
+                        Float, PickleType)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relation, backref
+from sqlalchemy.orm import relation, backref
 
-engine = create_engine('sqlite:///%s' % DEFAULT_STATUS_DATABASE, echo=False)
+database = Database('status', DEFAULT_STATUS_DATABASE)
 
-metaData = MetaData()
-metaData.bind = engine
+engine = database.engine
 
-Session = sessionmaker(bind=engine)
+metaData = database.metaData
+
+Session = database.Session
+ScopedSession = database.ScopedSession
 Base = declarative_base(metadata=metaData)
 
 class InstrumentOperationStatus(Base):
@@ -1,6 +1,6 @@
 
 from chimera_supervisor.controllers.states import State
-from chimera_supervisor.controllers.model import Session, List
+from chimera_supervisor.controllers.model import Session, ScopedSession, List
 from chimera_supervisor.controllers.status import OperationStatus
 from chimera_supervisor.core.exceptions import CheckAborted
 
@@ -8,6 +8,8 @@ from chimera.core.site import Site
 
 import threading
 import logging
+import datetime
+from multiprocessing.pool import ThreadPool
 
 import time
 
@@ -25,7 +27,19 @@ class Machine(threading.Thread):
         self.checklist = checklist
         self.controller = controller
         self.log = controller.debuglog
-        
+
+        # Workers used to check the items concurrently
+        self._pool = None
+
+        # Reactive mode. Inputs and time deadlines of each item (by id), and items waiting to be checked.
+        self._inputs = {}
+        self._deadlines = {}
+        self._pending = set()
+        self._fullSweep = True
+        self._lastSweep = 0.
+        self._triggerLock = threading.Lock()
+        self._watcherStop = threading.Event()
+
         self.setDaemon(False)
 
     def state(self, state=None):
@@ -47,6 +61,13 @@ class Machine(threading.Thread):
         # inject instruments on handlers
         self.checklist.__start__()
 
+        self._pool = ThreadPool(self.controller["checklist_workers"])
+
+        if self.controller["reactive"]:
+            watcher = threading.Thread(target=self._watch)
+            watcher.setDaemon(True)
+            watcher.start()
+
         while self.state() != State.SHUTDOWN:
 
             if self.state() == State.OFF:
@@ -58,7 +79,7 @@ class Machine(threading.Thread):
 
                 # Run checklist
                 self.state(State.BUSY)
-                self._process()
+                self._process(self._nextItems())
 
             elif self.state() == State.IDLE:
                 self.log.debug("[idle] waiting for wake-up call..")
@@ -79,6 +100,9 @@ class Machine(threading.Thread):
                 self.log.debug("[shutdown] should die soon.")
                 break
 
+        self._watcherStop.set()
+        self._pool.close()
+
         self.log.debug('[shutdown] thread ending...')
 
     def sleep(self):
@@ -111,43 +135,185 @@ class Machine(threading.Thread):
         else:
             return True
 
-    def _process(self):
+    def sweep(self):
+        '''
+        Request a check of the whole list. Returns False if the machine is busy (the sweep is done next).
+        '''
+        with self._triggerLock:
+            self._fullSweep = True
+        if self.state() == State.IDLE:
+            self.state(State.START)
+            return True
+        return False
+
+    def sweepAge(self):
+        '''
+        Time, in seconds, since the last full check of the list.
+        '''
+        return time.time() - self._lastSweep
+
+    def trigger(self, *inputs):
+        '''
+        Schedule a check of the items that depend on any of the given inputs (see CheckHandler.inputs).
+        '''
+        inputs = set(inputs)
+        with self._triggerLock:
+            items = [item_id for item_id, item_inputs in self._inputs.items() if item_inputs & inputs]
+            self._pending.update(items)
+
+        if len(items) > 0:
+            self.log.debug("[trigger] %s -> %i items" % (", ".join(sorted(inputs)), len(items)))
+            if self.state() == State.IDLE:
+                self.state(State.START)
+
+    def _nextItems(self):
+        '''
+        Items to check in the next cycle. None means the whole list.
+        '''
+        now = datetime.datetime.utcnow()
+        with self._triggerLock:
+            if self._fullSweep or not self.controller["reactive"]:
+                self._fullSweep = False
+                self._pending.clear()
+                return None
+            # Items with a time threshold that has passed
+            for item_id, deadline in self._deadlines.items():
+                if deadline is not None and deadline <= now:
+                    self._pending.add(item_id)
+                    self._deadlines[item_id] = None
+            items = self._pending
+            self._pending = set()
+        return items
+
+    def _watch(self):
+        '''
+        Reactive mode watcher. Polls the weather stations and the item deadlines and triggers the items that are
+        affected by a change.
+        '''
+        period = self.controller["poll_period"]
+        while not self._watcherStop.wait(period) and self.state() != State.SHUTDOWN:
+            try:
+                changed = self.checklist.weather.refresh()
+                if len(changed) > 0:
+                    self.trigger(*["weather.%s" % reading for reading in changed])
+
+                now = datetime.datetime.utcnow()
+                with self._triggerLock:
+                    due = [deadline for deadline in self._deadlines.values() if deadline is not None and deadline <= now]
+                if len(due) > 0 and self.state() == State.IDLE:
+                    self.state(State.START)
+            except Exception, e:
+                self.log.exception(e)
 
-        def process ():
+    def _checkItem(self, item_id, dependencies, done):
+        '''
+        Check a single item in its own session, after the items it depends on are done.
+        '''
+        try:
+            for dependency in dependencies:
+                done[dependency].wait()
 
-            # session to be used by executor and handlers
-            session = Session()
+            if self.checklist.mustStop.isSet():
+                return
 
-            checklist = None
+            # Sessions cannot be shared between threads, each worker uses its own
+            session = ScopedSession()
+            item = session.query(List).get(item_id)
             try:
-                checklist = session.query(List)
+                self.log.debug("[start] Checking %s"%item)
+                self.checklist.check(item)
+                # Deadlines cost extra site calls (e.g. TimeHandler), only the reactive watcher uses them
+                if self.controller["reactive"]:
+                    deadline = self.checklist.itemDeadline(item)
+                    with self._triggerLock:
+                        self._deadlines[item_id] = deadline
+                session.commit()
+            except CheckAborted:
+                self.checklist.mustStop.set()
+                self.state(State.OFF)
+                self.log.debug("[aborted by user] %s" % str(item))
+                session.rollback()
             except Exception, e:
                 self.log.exception(e)
-                self.state(State.OFF)
-                return
+                try:
+                    session.commit()
+                except Exception, e:
+                    self.log.exception(e)
+                    session.rollback()
+            finally:
+                ScopedSession.remove()
+        finally:
+            done[item_id].set()
+
+    def _process(self, items=None):
+        '''
+        Check the items of the list.
 
-            self.log.debug("[start] processing %i items" % checklist.count())
+        :param items: Ids of the items to check. If None, all items are checked.
+        '''
 
-            for item in checklist:
+        def process ():
+
+            self.checklist.mustStop.clear()
+
+            if items is None:
+                # Read the weather stations once for the whole cycle. In reactive mode this is also done by the
+                # watcher, partial cycles use its readings.
                 try:
-                    self.log.debug("[start] Checking %s"%item)
-                    self.checklist.check(item)
-                    session.commit()
-                except CheckAborted:
-                    self.state(State.OFF)
-                    self.log.debug("[aborted by user] %s" % str(item))
-                    break
+                    self.checklist.weather.refresh()
                 except Exception, e:
                     self.log.exception(e)
-                    pass
+                self._lastSweep = time.time()
+
+            session = Session()
+
+            # Items that read an instrument must wait for the items before them that write to it (in their responses).
+            # All the others are checked concurrently.
+            tasks = []
             try:
+                checklist = session.query(List).order_by(List.id)
+                if items is not None:
+                    checklist = checklist.filter(List.id.in_(list(items)))
+                else:
+                    with self._triggerLock:
+                        self._inputs = {}
+                        self._deadlines = {}
+                writers = []
+                for item in checklist:
+                    with self._triggerLock:
+                        self._inputs[item.id] = self.checklist.itemInputs(item)
+                    reads, writes = self.checklist.itemInstruments(item)
+                    dependencies = [item_id for item_id, item_writes in writers if item_writes & reads]
+                    tasks.append((item.id, dependencies))
+                    writers.append((item.id, writes))
                 session.commit()
             except Exception, e:
                 self.log.exception(e)
                 session.rollback()
-                session.commit()
+                self.state(State.OFF)
+                return
+
+            self.log.debug("[start] processing %i items" % len(tasks))
+
+            t0 = time.time()
+            done = dict([(item_id, threading.Event()) for item_id, dependencies in tasks])
+            # Dependencies are always submitted first, so a worker never waits on an item that is not running.
+            results = [self._pool.apply_async(self._checkItem, (item_id, dependencies, done))
+                       for item_id, dependencies in tasks]
+            for result in results:
+                try:
+                    result.get()
+                except Exception, e:
+                    self.log.exception(e)
+
+            self.log.debug("[finish] checklist took: %f s" % (time.time() - t0))
 
-            self.state(State.IDLE)
+            # Do not override a stop/shutdown requested while the items were being checked. Items triggered while
+            # busy are checked right away.
+            if self.state() == State.BUSY:
+                with self._triggerLock:
+                    waiting = self._fullSweep or len(self._pending) > 0
+                self.state(State.START if waiting else State.IDLE)
 
         t = threading.Thread(target=process)
         t.setDaemon(False)
@@ -5,12 +5,19 @@ import time
 import numpy as np
 import threading
 import inspect
+from collections import OrderedDict
+
+from sqlalchemy.orm import joinedload
 
 from chimera_supervisor.controllers.scheduler.model import Session as RSession
 from chimera_supervisor.controllers.scheduler.model import (Program, Targets, BlockPar, ObsBlock,
                                                             ObservingLog, AutoFocus, Point, Expose)
 from chimera_supervisor.controllers.scheduler.machine import Machine
+from chimera_supervisor.controllers.scheduler.planner import Planner
 from chimera_supervisor.controllers.scheduler import algorithms
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.cache import ConditionsCache
+from chimera_supervisor.core.database import databaseStats
 
 from chimera.core.chimeraobject import ChimeraObject
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
@@ -38,6 +45,15 @@ class RobObs(ChimeraObject):
                   "weatherstations" : None,
                   "seeingmonitors"  : None,
                   "cloudsensors"    : None,
+                  "moon_table_step" : 600., # moon ephemeris grid step (in seconds)
+                  "conditions_cache_size" : 4096, # max number of cached condition verdicts
+                  "conditions_cache_quantum" : 60., # time bucket of cached verdicts (in seconds)
+                  "slew_search_step" : 60., # grid step when looking for an earlier slew time (in seconds)
+                  "slew_search_tolerance" : 1., # precision of the earlier slew time (in seconds)
+                  "machine_busy_timeout" : 300., # check the scheduler state if no event arrives for this long (in seconds)
+                  "planner_lookahead" : True, # select the next program while the current one executes
+                  "planner_tolerance" : 600., # max drift of a look-ahead program from the time it was selected for (in seconds)
+                  "planner_retry" : 300., # wait before resheduling again when there is nothing to observe (in seconds)
                   }
 
     def __init__(self):
@@ -48,6 +64,9 @@ class RobObs(ChimeraObject):
         self._no_program_on_queue = False
         self._debuglog = None
         self.machine = None
+        self._planner = None
+        self._moon_table = None
+        self._conditions_cache = None
 
     def __start__(self):
 
@@ -55,6 +74,9 @@ class RobObs(ChimeraObject):
 
         self._scheduler_list = self["schedulers"].split(',')
 
+        self._conditions_cache = ConditionsCache(self["conditions_cache_size"],
+                                                 self["conditions_cache_quantum"])
+
         self._connectSchedulerEvents()
 
         self._debuglog = logging.getLogger('_robobs_debug_')
@@ -71,14 +93,21 @@ class RobObs(ChimeraObject):
         self._debuglog.addHandler(_log_handler)
         self.log.setLevel(logging.INFO)
 
-        self.machine = Machine(self)
+        self.machine = Machine(self, busy_timeout=self["machine_busy_timeout"])
         self.machine.start()
 
+        self._planner = Planner(self,
+                                lookahead=self["planner_lookahead"],
+                                tolerance=self["planner_tolerance"],
+                                retry=self["planner_retry"])
+        self._planner.start()
+
         self._injectInstrument()
 
     def __stop__(self):
         self._disconnectSchedulerEvents()
         self._debuglog.debug("Shuting down machine...")
+        self._planner.stop()
         self.machine.state(SchedState.SHUTDOWN)
 
     def start(self):
@@ -90,9 +119,14 @@ class RobObs(ChimeraObject):
     def stop(self):
         self._debuglog.debug("Switching robstate off...")
         self.rob_state = RobState.OFF
+        if self._planner is not None:
+            self._planner.invalidate()
 
         return True
 
+    def isOn(self):
+        return self.rob_state == RobState.ON
+
     def wake(self):
         self._debuglog.debug("Waking machine up...")
         self.machine.state(SchedState.START)
@@ -116,6 +150,17 @@ class RobObs(ChimeraObject):
     def getSite(self):
         return self.getManager().getProxy(self["site"])
 
+    def getMoonTable(self, jd):
+        '''
+        Return the moon ephemeris table for the night that contains jd (julian date). Table is built once per night,
+        from local noon to local noon.
+        '''
+        if self._moon_table is None or not self._moon_table.covers(jd):
+            site = self.getSite()
+            start = ephemeris.localNoon(jd, ephemeris.siteLongitude(site))
+            self._moon_table = ephemeris.MoonTable.cached(site, start, start+1., self["moon_table_step"])
+        return self._moon_table
+
     def getSched(self,index=0):
         self.log.debug("%s" % self._scheduler_list[index])
         if self._debuglog is not None:
@@ -237,89 +282,99 @@ class RobObs(ChimeraObject):
 
         self._debuglog.debug("State changed %s -> %s..." % (oldState,
                                                             newState))
+        self.machine.schedulerStateChanged(newState, oldState)
+
         if oldState == SchedState.IDLE and newState == SchedState.OFF:
             if self.rob_state == RobState.ON:
-                self._debuglog.debug("Scheduler went from BUSY to OFF. Needs resheduling...")
-
-                # if self._current_program is not None:
-                #     self._debuglog.warning("Wait for last program to be updated")
-                #     self._current_program_condition.acquire()
-                #     self._current_program_condition.wait(30) # wait 10s most!
-                #     self._current_program_condition.release()
-                session = RSession()
-                csession = model.Session()
-
-                # cprog = model.Program(  name =  "CALIB",
-                #                         pi = "Tiago Ribeiro",
-                #                         priority = 1 )
-                # cprog.actions.append(model.Expose(frames = 3,
-                #                                   exptime = 10,
-                #                                   imageType = "DARK",
-                #                                   shutter = "CLOSE",
-                #                                   filename = "dark-$DATE-$TIME"))
-                # cprog.actions.append(model.Expose(frames = 1,
-                #                                   exptime = 0,
-                #                                   imageType = "DARK",
-                #                                   shutter = "CLOSE",
-                #                                   filename = "bias-$DATE-$TIME"))
-                #
-                # csession.add(cprog)
-                # self._current_program = cprog
-                # self._debuglog.debug("Added: %s" % cprog)
-                program_info = self.reshedule()
-                #
-                if program_info is not None:
-                    program = session.merge(program_info[0])
-                    obs_block = session.merge(program_info[2])
-                    self._debuglog.debug("Adding program %s to scheduler and starting." % program)
-                    cprogram = program.chimeraProgram()
-                    for act in obs_block.actions:
-                        cact = getattr(sys.modules[__name__],act.action_type).chimeraAction(act)
-                        cprogram.actions.append(cact)
-                    cprogram = csession.merge(cprogram)
-                    csession.add(cprogram)
-                    csession.commit()
-                    program.finished = True
-                    session.commit()
-                    # sched = self.getSched()
-                    self._current_program = program_info
-                    self._no_program_on_queue = False
-                    # sched.start()
-                    # self._current_program_condition.release()
-                    self._debuglog.debug("Done")
-                elif self._no_program_on_queue:
-                    self._debuglog.warning("No program on robobs queue, waiting for 5 min.")
-                    time.sleep(300)
-                else:
-                    self._debuglog.warning("No program on robobs queue. Sending telescope to park position.")
-                    # ToDo: Run an action from the database to send telescope to park position.
-                    cprog = model.Program(  name =  "SAFETY",
-                                            pi = "ROBOBS",
-                                            priority = 1 )
-                    to_park_position =  model.Point()
-                    to_park_position.targetAltAz = Position.fromAltAz(Coord.fromD(88.),
-                                                               Coord.fromD(89.))
-                    cprog.actions.append(to_park_position)
-
-                    csession.add(cprog)
-                    self._no_program_on_queue = True
-                    # self.stop()
-
-                csession.commit()
-                session.commit()
-                # for i in range(10):
-                #     self.log.debug('Waiting %i/10' % i)
-                #     time.sleep(1.0)
-                # sched = self.getSched()
-                # sched.start()
-                self.wake()
-                self._debuglog.debug("Done")
+                # Resheduling runs on the planner thread, this is the scheduler event thread
+                self._debuglog.debug("Scheduler went from BUSY to OFF. Handing over next program...")
+                self._planner.handOver()
             else:
                 self._debuglog.debug("Current state is off. Won't respond.")
 
-    def reshedule(self,now=None):
-
+    def submit(self, program_info):
+        '''
+        Add a program, as returned by reshedule, to the scheduler queue and mark it as finished on the robobs queue.
+        '''
         session = RSession()
+        csession = model.Session()
+        try:
+            program = session.merge(program_info[0])
+            obs_block = session.merge(program_info[2])
+            self._debuglog.debug("Adding program %s to scheduler and starting." % program)
+            cprogram = program.chimeraProgram()
+            for act in obs_block.actions:
+                cact = getattr(sys.modules[__name__],act.action_type).chimeraAction(act)
+                cprogram.actions.append(cact)
+            cprogram = csession.merge(cprogram)
+            csession.add(cprogram)
+            csession.commit()
+            program.finished = True
+            session.commit()
+            self._current_program = program_info
+            self._no_program_on_queue = False
+            self._debuglog.debug("Done")
+        finally:
+            csession.commit()
+            session.commit()
+
+    def parkIfIdle(self):
+        '''
+        Called when there is nothing to observe. The first time, sends the telescope to park position.
+
+        :return: True if a park program was added to the scheduler queue.
+        '''
+        if self._no_program_on_queue:
+            return False
+
+        self._debuglog.warning("No program on robobs queue. Sending telescope to park position.")
+        csession = model.Session()
+        try:
+            # ToDo: Run an action from the database to send telescope to park position.
+            cprog = model.Program(  name =  "SAFETY",
+                                    pi = "ROBOBS",
+                                    priority = 1 )
+            to_park_position =  model.Point()
+            to_park_position.targetAltAz = Position.fromAltAz(Coord.fromD(88.),
+                                                       Coord.fromD(89.))
+            cprog.actions.append(to_park_position)
+
+            csession.add(cprog)
+        finally:
+            csession.commit()
+        self._no_program_on_queue = True
+        return True
+
+    def programLength(self, program):
+        '''
+        Exposure time, in seconds, of a program (Program, BlockPar, ObsBlock, Targets).
+        '''
+        dT = 0.
+        for act in program[2].actions:
+            if act.__tablename__ == 'action_expose':
+                dT += act.exptime*act.frames
+        return dT
+
+    def reshedule(self,now=None,dryRun=False):
+        '''
+        Select the next program to observe.
+
+        :param now: Time (MJD) to select the program for. Defaults to the current time.
+        :param dryRun: Do not store the changes made while selecting (like the earlier slewAt found by getProgram).
+                       Used to look ahead for a time that may never happen.
+        :return: (Program, BlockPar, ObsBlock, Targets) or None.
+        '''
+
+        # Programs are read once per reshedule, objects must stay loaded after commit.
+        session = RSession(expire_on_commit=False)
+
+        def close():
+            if dryRun:
+                # Detach the programs first, so they keep the values found for this time after the rollback
+                session.expunge_all()
+                session.rollback()
+            else:
+                session.commit()
 
         site = self.getSite()
         if now is None:
@@ -329,15 +384,17 @@ class RobObs(ChimeraObject):
 
         program = None
 
-        # Get a list of priorities
-        plist = self.getPList()
+        # Load all programs and get a list of priorities
+        programs = self.loadPrograms(session)
+        plist = list(programs.keys())
 
         if len(plist) == 0:
+            close()
             return None
 
         # Get project with highest priority as reference
         priority = plist[0]
-        program,plen = self.getProgram(nowmjd,plist[0])
+        program,plen = self.getProgram(nowmjd,plist[0],programs[plist[0]])
 
         waittime=0
 
@@ -345,6 +402,7 @@ class RobObs(ChimeraObject):
             # program = session.merge(program)
             if ( (not program[0].slewAt) and (self.checkConditions(program, nowmjd, plen))):
                 # Program should be done right away!
+                close()
                 return program
 
             self._debuglog.info('Current program length: %.2f m. Slew@: %.3f'%(plen/60., program[0].slewAt))
@@ -362,7 +420,7 @@ class RobObs(ChimeraObject):
 
             # Get program and program duration (lenght)
 
-            aprogram,aplen = self.getProgram(nowmjd,p)
+            aprogram,aplen = self.getProgram(nowmjd,p,programs[p])
 
             # aprogram = session.merge(aprogram)
 
@@ -447,31 +505,72 @@ class RobObs(ChimeraObject):
             # if project cannot be executed return nothing.
             # [TO-CHECK] What the scheduler will do? should sleep for a while and
             # [TO-CHECK] try again.
-            session.commit()
+            close()
             return None
         checktime = nowmjd if nowmjd > program[0].slewAt else program[0].slewAt
         if not self.checkConditions(program,checktime,plen):
-            session.commit()
+            close()
             return None
 
         self._debuglog.info('Choose program with priority %i'%priority)
-        session.commit()
+        close()
         return program
 
-    def getProgram(self, nowmjd, priority):
+    def loadPrograms(self, session):
+        '''
+        Load all unfinished programs, together with their block parameters, observing blocks, targets and actions, in
+        a single query.
 
-        session = RSession()
+        :param session: Session the programs are loaded in. Changes to the programs are committed with it.
+        :return: OrderedDict mapping priority to the list of (Program, BlockPar, ObsBlock, Targets), ordered by
+                 priority and slewAt.
+        '''
+        query = self._programQuery(session).order_by(Program.priority, Program.slewAt)
 
-        self._debuglog.debug('Looking for program with priority %i to observe @ %.3f '%(priority,nowmjd))
+        programs = OrderedDict()
+        for program in query:
+            programs.setdefault(program[0].priority, []).append(program)
+
+        return programs
+
+    def loadProgram(self, program_id):
+        '''
+        Load an unfinished program as stored in the database, with its block parameters, observing block, target and
+        actions. Objects stay loaded after the session is closed.
+
+        :return: (Program, BlockPar, ObsBlock, Targets) or None if the program is finished or does not exist.
+        '''
+        session = RSession(expire_on_commit=False)
+        try:
+            return self._programQuery(session).filter(Program.id == program_id).first()
+        finally:
+            session.commit()
 
-        programs = session.query(Program,
-                                 BlockPar,
-                                 ObsBlock,
-                                 Targets).join(
+    @staticmethod
+    def _programQuery(session):
+        return session.query(Program,
+                             BlockPar,
+                             ObsBlock,
+                             Targets).join(
             BlockPar,Program.blockpar_id == BlockPar.id).join(
             ObsBlock,Program.obsblock_id == ObsBlock.id).join(
-            Targets, Program.tid == Targets.id).filter(Program.priority == priority,
-                                                       Program.finished == False).order_by(Program.slewAt)
+            Targets, Program.tid == Targets.id).filter(Program.finished == False).options(
+            joinedload(ObsBlock.actions))
+
+    def getProgram(self, nowmjd, priority, programs=None):
+        '''
+        Select the next program to observe from the ones with the given priority.
+
+        :param programs: List of (Program, BlockPar, ObsBlock, Targets) with this priority, as returned by
+                         loadPrograms. If None, programs are loaded from the database.
+        '''
+
+        session = RSession()
+
+        self._debuglog.debug('Looking for program with priority %i to observe @ %.3f '%(priority,nowmjd))
+
+        if programs is None:
+            programs = self.loadPrograms(session).get(priority, [])
 
         schedAlgList = np.array([t[1].schedalgorith for t in programs])
         unique_shed_algorithm_list = np.unique(schedAlgList)
@@ -490,20 +589,17 @@ class RobObs(ChimeraObject):
 
             if program is not None:
                 self._debuglog.debug('Found program %s' % program[0])
-                dT = 0.
-
-                for ii,act in enumerate(program[2].actions):
-                    if act.__tablename__ == 'action_expose':
-                        dT+=act.exptime*act.frames
+                dT = self.programLength(program)
 
                 if not sched.timed_constraint() and program[0].slewAt > nowmjd:
                     self._debuglog.debug('Checking if program can be observed earlier...')
                     # Check if program can be observed earlier, in case slewTime larger than mjd
-                    for dt in np.linspace(nowmjd, program[0].slewAt):
-                        if self.checkConditions(program, dt, dT):
-                            self._debuglog.debug('Replacing program slewAt %.2f -> %.2f' % (program[0].slewAt,
-                                                                                            dt))
-                            program[0].slewAt = dt
+                    slewAt = self.earliestSlew(program, nowmjd, program[0].slewAt)
+                    if slewAt is not None and slewAt < program[0].slewAt and \
+                            self.checkConditions(program, slewAt, dT):
+                        self._debuglog.debug('Replacing program slewAt %.4f -> %.4f' % (program[0].slewAt,
+                                                                                        slewAt))
+                        program[0].slewAt = slewAt
 
                 session.commit()
                 return program,dT
@@ -514,6 +610,38 @@ class RobObs(ChimeraObject):
         return None,0.
 
 
+    def earliestSlew(self, program, start, end):
+        '''
+        Find the earliest time, between start and end (MJD), from which the program satisfies its airmass and moon
+        restrictions until end. Airmass and moon are computed from the precomputed ephemeris, so the site is
+        contacted only once, to anchor the sidereal time.
+
+        :return: Earliest time (MJD) or None if the program does not satisfy its restrictions at end.
+        '''
+        blockpar = program[1]
+        target = program[3]
+
+        ra, dec = ephemeris.catalogArrays(target.targetRa, target.targetDec)
+        ephem = ephemeris.Ephemeris.fromSite(self.getSite(), start+2400000.5)
+        moon = self.getMoonTable(start+2400000.5)
+
+        def condition(jd):
+            alt = ephemeris.altitude(ephem.lstAt(jd)[:, np.newaxis], ephem.latitude,
+                                     ra[np.newaxis, :], dec[np.newaxis, :])
+            airmass = ephemeris.airmass(alt)
+            mask = np.bitwise_and(blockpar.minairmass < airmass, airmass < blockpar.maxairmass)
+            mask &= moon.moonMask(jd, ra, dec, [blockpar.minmoonDist],
+                                  [blockpar.minmoonBright], [blockpar.maxmoonBright])
+            return mask[:, 0]
+
+        jd = ephemeris.earliestFeasible(condition,
+                                        start+2400000.5,
+                                        end+2400000.5,
+                                        self["slew_search_step"],
+                                        self["slew_search_tolerance"])
+
+        return None if jd is None else jd-2400000.5
+
     def getPList(self):
 
         session = RSession()
@@ -534,6 +662,63 @@ class RobObs(ChimeraObject):
         :return: True (Program can be executed) | False (Program cannot be executed)
         '''
 
+        # Airmass, moon and night end only depend on the target, block parameters and time, so they are cached. The
+        # values used by the checks are part of the key, so changes made to the database in any way are seen.
+        target, blockpar = program[3], program[1]
+        key = self._conditions_cache.key(target.id, blockpar.id, time, program_length,
+                                         (target.targetRa, target.targetDec,
+                                          blockpar.minairmass, blockpar.maxairmass,
+                                          blockpar.minmoonBright, blockpar.maxmoonBright,
+                                          blockpar.minmoonDist))
+        verdict = self._conditions_cache.get(key)
+        if verdict is None:
+            verdict = self._checkSkyConditions(program, time, program_length)
+            self._conditions_cache.put(key, verdict)
+        else:
+            self._debuglog.debug('Using cached conditions for target %i @ %.4f: %s' % (program[3].id, time, verdict))
+
+        if not verdict:
+            return False
+
+        session = RSession()
+        blockpar = session.merge(program[1])
+
+        # 4) check seeing
+
+        if self["seeingmonitors"] is not None:
+
+            seeing = self.getSM().seeing()
+
+            if seeing > blockpar.maxseeing:
+                self._debuglog.warning('Seeing higher than specified... sm = %f | max = %f'%(seeing,
+                                                                                  blockpar.maxseeing))
+                return False
+            elif seeing < 0.:
+                self._debuglog.warning('No seeing measurement...')
+            else:
+                self._debuglog.debug('Seeing %.3f'%seeing)
+        # 5) check cloud cover
+        if self["cloudsensors"] is not None:
+            pass
+
+        if self["weatherstations"] is not None:
+            pass
+
+        if external_checker is not None:
+            # Todo: add a 3rd option which is a function to check if program is ok from the algorithm itself.
+            pass
+
+        self._debuglog.debug('Target OK!')
+
+        return True
+
+    def _checkSkyConditions(self, program, time, program_length = 0.):
+        '''
+        Check airmass, moon and night end restrictions of a program.
+
+        :return: True (Program can be executed) | False (Program cannot be executed)
+        '''
+
         site = self.getSite()
         # 1) check airmass
         session = RSession()
@@ -588,12 +773,13 @@ class RobObs(ChimeraObject):
                 pass
 
         # 2) check moon Brightness
-        moonPos = site.moonpos(dateTime)
-        moonBrightness = site.moonphase(dateTime)*100.
+        moon = self.getMoonTable(time+2400000.5)
+        moonAlt = moon.altitude(time+2400000.5)
+        moonBrightness = moon.brightness(time+2400000.5)
         if blockpar.minmoonBright < moonBrightness < blockpar.maxmoonBright:
             self._debuglog.debug('\tMoon brightness:%.2f'%moonBrightness)
             pass
-        elif moonPos.alt < 0.:
+        elif moonAlt < 0.:
             self._debuglog.warning('\tMoon bellow horizon. Moon brightness:%.2f'%moonBrightness)
         else:
             self._debuglog.warning('Wrong Moon Brightness... (%f < %f < %f)'%(blockpar.minmoonBright,
@@ -602,7 +788,7 @@ class RobObs(ChimeraObject):
             return False
 
         # 3) check moon distance
-        moonRaDec = site.altAzToRaDec(moonPos,lst)
+        moonRaDec = moon.position(time+2400000.5)
 
         moonDist = raDec.angsep(moonRaDec)
 
@@ -615,34 +801,42 @@ class RobObs(ChimeraObject):
             return False
         else:
             self._debuglog.debug('\tMoon distance:%.3f'%moonDist)
-        # 4) check seeing
 
-        if self["seeingmonitors"] is not None:
+        return True
 
-            seeing = self.getSM().seeing()
+    def invalidateConditionsCache(self, blockpar_id=None):
+        '''
+        Drop cached condition verdicts. Entries of changed blocks are never used (see ConditionsCache), this only
+        frees them before they age out.
 
-            if seeing > blockpar.maxseeing:
-                self._debuglog.warning('Seeing higher than specified... sm = %f | max = %f'%(seeing,
-                                                                                  blockpar.maxseeing))
-                return False
-            elif seeing < 0.:
-                self._debuglog.warning('No seeing measurement...')
-            else:
-                self._debuglog.debug('Seeing %.3f'%seeing)
-        # 5) check cloud cover
-        if self["cloudsensors"] is not None:
-            pass
+        :param blockpar_id: BlockPar id to invalidate. If None, the whole cache is cleared.
+        '''
+        self._debuglog.debug('Invalidating conditions cache (blockpar: %s)' % blockpar_id)
+        self._conditions_cache.invalidate(blockpar_id)
 
-        if self["weatherstations"] is not None:
-            pass
+    def getConditionsCacheStats(self):
+        '''
+        Return hits, misses, size and hit ratio of the conditions cache.
+        '''
+        return self._conditions_cache.stats()
 
-        if external_checker is not None:
-            # Todo: add a 3rd option which is a function to check if program is ok from the algorithm itself.
-            pass
+    def getPlannerStats(self):
+        '''
+        Return the hand over stats of the planner: look-ahead hits and misses and the dead time between programs.
+        '''
+        return self._planner.stats()
 
-        self._debuglog.debug('Target OK!')
+    def getMachineStats(self):
+        '''
+        Return the time spent, and number of wake ups, in each state of the robobs machine.
+        '''
+        return self.machine.stats()
 
-        return True
+    def getDatabaseStats(self):
+        '''
+        Return the commit latency stats of each database, by name.
+        '''
+        return databaseStats()
 
     def getLogger(self):
         return self._debuglog
@@ -5,6 +5,10 @@ from sqlalchemy import or_, and_
 import datetime
 
 from chimera_supervisor.controllers.scheduler.model import ObsBlock, ExtMoniDB, ObservedAM, TimedDB, RecurrentDB, Session
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.executor import SchedulerExecutor
+from chimera_supervisor.controllers.scheduler.catalog import TargetCatalog, mjdFromDatetime
+from chimera_supervisor.controllers.scheduler.skyindex import SkyIndex
 from chimera.util.enum import Enum
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 from chimera.core.site import datetimeFromJD
@@ -67,6 +71,21 @@ class BaseScheduleAlgorith():
         '''
         pass
 
+    @staticmethod
+    def simulatedNext(time, queue, index):
+        '''
+        Select the program to observe in a simulation (see simulator.NightSimulator). Must not use the database or the
+        site. Defaults to the program with the closest slew time, as selected by Higher.next.
+
+        :param time: Current time (MJD).
+        :param queue: Columnar queue (simulator.QUEUE_DTYPE).
+        :param index: Queue indexes of the candidate programs.
+        :return: Queue index of the selected program or None.
+        '''
+        if len(index) == 0:
+            return None
+        return index[np.argmin(np.abs(time - queue['slewAt'][index]))]
+
     @staticmethod
     def observed(time, program, site = None, soft = False):
         '''
@@ -117,3 +136,88 @@ def Airmass(alt):
     if am < 0.:
         am = 999.
     return am
+
+class SlotEvaluator(object):
+    '''
+    Altitudes and moon restrictions of a set of blocks on each observing slot.
+
+    Small catalogs are evaluated at once, as dense (slots x blocks) matrices split across the executor workers. For
+    large catalogs (more than index_threshold blocks) a SkyIndex is used instead and, on each slot, only the blocks
+    that can be above the lowest allowed altitude at the middle of the block are evaluated. The middle of the block
+    is where the algorithms compare altitudes, so both ways select the same blocks.
+    '''
+
+    def __init__(self, ephem, moon, blockPar, executor, index_threshold=5000):
+        '''
+        :param ephem: Ephemeris for the slot grid.
+        :param moon: MoonTable for the night.
+        :param blockPar: Catalog entries, one per block.
+        :param executor: SchedulerExecutor used for the dense matrices.
+        :param index_threshold: Number of blocks above which the sky index is used.
+        '''
+        self.ephem = ephem
+        self.moon = moon
+        self.blockPar = blockPar
+        self.ra = blockPar['ra']
+        self.dec = blockPar['dec']
+        self.index = None
+
+        if len(blockPar) > index_threshold:
+            self.index = SkyIndex.cached(self.ra, self.dec)
+            # Lowest altitude any block can be observed at
+            maxairmass = blockPar['maxairmass'].max()
+            self.minAltitude = 90.-np.degrees(np.arccos(1./maxairmass)) if maxairmass >= 1. else 0.
+            # Hour angle offset of the middle of the blocks. The window is centered on the mean offset and widened
+            # to cover the shortest and longest blocks.
+            offset = ephemeris.hourAngleOffset(blockPar['length']/2.)
+            self.middleOffset = (offset.min() + offset.max())/2.
+            self.middleSpread = (offset.max() - offset.min())/2.
+        else:
+            self.altitudeMatrix = executor.altitude(ephem, self.ra, self.dec, blockPar['length']/2.)
+            self.startAltitudeMatrix = executor.altitude(ephem, self.ra, self.dec)
+            self.endAltitudeMatrix = executor.altitude(ephem, self.ra, self.dec, blockPar['length'])
+            self.moonMaskMatrix = executor.moonMask(moon, ephem.jd, self.ra, self.dec,
+                                                    blockPar['minmoonDist'],
+                                                    blockPar['minmoonBright'],
+                                                    blockPar['maxmoonBright'])
+
+    def evaluate(self, itr, available=None):
+        '''
+        Blocks that satisfy the moon restrictions on slot itr, with their altitudes at the start, middle and end of
+        the block.
+
+        :param itr: Slot index.
+        :param available: Optional boolean mask of the blocks that can still be scheduled.
+        :return: selected, alt, start_alt, end_alt
+        '''
+        if self.index is None:
+            mask = self.moonMaskMatrix[itr]
+            if available is not None:
+                mask = np.bitwise_and(available, mask)
+            selected = np.where(mask)[0]
+            return (selected,
+                    self.altitudeMatrix[itr][selected],
+                    self.startAltitudeMatrix[itr][selected],
+                    self.endAltitudeMatrix[itr][selected])
+
+        jd = self.ephem.jd[itr]
+        lst = self.ephem.lst[itr]
+
+        candidates = self.index.hourAngleWindow(lst + self.middleOffset, self.ephem.latitude, self.minAltitude,
+                                                self.middleSpread)
+        if available is not None:
+            candidates = candidates[available[candidates]]
+
+        mask = self.moon.moonMask(jd, self.ra[candidates], self.dec[candidates],
+                                  self.blockPar['minmoonDist'][candidates],
+                                  self.blockPar['minmoonBright'][candidates],
+                                  self.blockPar['maxmoonBright'][candidates])[0]
+        selected = candidates[mask]
+
+        length = self.blockPar['length'][selected]
+        ra = self.ra[selected]
+        dec = self.dec[selected]
+        return (selected,
+                ephemeris.altitude(lst + ephemeris.hourAngleOffset(length/2.), self.ephem.latitude, ra, dec),
+                ephemeris.altitude(lst, self.ephem.latitude, ra, dec),
+                ephemeris.altitude(lst + ephemeris.hourAngleOffset(length), self.ephem.latitude, ra, dec))
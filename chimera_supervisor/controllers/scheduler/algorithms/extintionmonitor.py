@@ -80,8 +80,7 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         nightstart = kwargs['obsStart']
         nightend   = kwargs['obsEnd']
         time_grid = np.arange(nightstart,nightend,slotLen/60./60./24.)
-        site = kwargs['site']
-        targets = kwargs['query']
+        site = kwargs.get('site')
 
         nstars = 3 # if 'nstars' not in kwargs else kwargs['nstars']
         nairmass = 3 # if 'nairmass' not in kwargs else kwargs['nairmass']
@@ -92,10 +91,14 @@ class ExtintionMonitor(BaseScheduleAlgorith):
                      }
 
         if 'overheads' in kwargs:
-            overheads.update(kwargs)
+            overheads.update(kwargs['overheads'])
 
+        moon_table_step = 600.
         if 'config' in kwargs:
             config = kwargs['config']
+            if 'moon_table_step' in config:
+                moon_table_step = config['moon_table_step']
+
             if 'nstars' in config:
                 nstars = config['nstars']
 
@@ -105,13 +108,10 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         MINALTITUDE = 10.
         MAXAIRMASS = 1./np.cos(np.pi/2.-np.pi/18.)
 
-        radecArray = np.array([Position.fromRaDec(targets[:][0][2].targetRa,
-                                                  targets[:][0][2].targetDec)])
-
-        # sort = np.argsort(targets[:][0][2].targetRa)
-        # radecArray = radecArray[sort]
-
-        targetNameArray = np.array([targets[:][0][2].name])
+        if 'catalog' in kwargs:
+            catalog = kwargs['catalog']
+        else:
+            catalog = TargetCatalog.fromQuery(kwargs['query'])
 
         # Creat observation slots.
         slotDtype = [ ('start',np.float),
@@ -122,68 +122,64 @@ class ExtintionMonitor(BaseScheduleAlgorith):
         obsSlots = np.array([],
                               dtype= slotDtype)
 
-
-        blockid = targets[:][0][0].blockid
-        radecPos = np.array([0])
-        blockidList = np.array([blockid])
-        blockDuration = np.array([0]) # store duration of each block
-        maxAirmass = np.array([targets[:][0][1].maxairmass]) # store max airmass of each block
-        minAirmass = np.array([targets[:][0][1].minairmass]) # store max airmass of each block
-        if maxAirmass[0] < 0:
-            maxAirmass[0] = MAXAIRMASS
-        if minAirmass[0] < 0:
-            minAirmass[0] = MAXAIRMASS # ignore minAirmaa if not set
+        if len(catalog) == 0:
+            log.warning('No targets to schedule.')
+            return obsSlots
 
         # Get single block ids and determine block duration
-        for itr,target in enumerate(targets):
-            if blockid != target[0].blockid:
-                radecArray =  np.append(radecArray,Position.fromRaDec(target[2].targetRa,
-                                                                      target[2].targetDec))
-                targetNameArray = np.append(targetNameArray,target[2].name)
-                blockid = target[0].blockid
-                radecPos = np.append(radecPos,itr)
-                blockidList = np.append(blockidList,blockid)
-                if target[1].maxairmass > 0:
-                    maxAirmass = np.append(maxAirmass,target[1].maxairmass)
-                else:
-                    maxAirmass = np.append(maxAirmass,
-                                           MAXAIRMASS)
-
-                if target[1].minairmass > 0:
-                    minAirmass = np.append(minAirmass,target[1].minairmass)
-                else:
-                    minAirmass = np.append(minAirmass,
-                                           MAXAIRMASS) # ignored if not set
-
-                blockDuration = np.append(blockDuration,0.)
-
-            for blk_actions in target[0].actions:
-                if blk_actions.__tablename__ == 'action_expose':
-                    blockDuration[-1]+=((blk_actions.exptime+overheads['readout'])*blk_actions.frames)
-                elif blk_actions.__tablename__ == 'action_focus':
-                    if blk_actions.step > 0:
-                        blockDuration[-1]+=overheads['autofocus']['align']
-                    elif blk_actions.step == 0:
-                        blockDuration[-1]+=overheads['autofocus']['set']
-
-
+        radecPos = catalog.blocks()
+        blockPar = catalog[radecPos]
+        targetNameArray = blockPar['name']
+        blockidList = blockPar['blockid']
+        # Duration of each block: open shutter time plus the overheads given (none by default). Not the block length
+        # (ObsBlock.length), that has its own read out and focus estimates.
+        duration = (catalog['exptime'] +
+                    overheads['readout']*catalog['frames'] +
+                    overheads['autofocus']['align']*catalog['focusAlign'] +
+                    overheads['autofocus']['set']*catalog['focusSet'])
+        blockDuration = np.add.reduceat(duration, radecPos) # store duration of each block
+        maxAirmass = np.where(blockPar['maxairmass'] > 0, blockPar['maxairmass'], MAXAIRMASS)
+        minAirmass = np.where(blockPar['minairmass'] > 0, blockPar['minairmass'], MAXAIRMASS) # ignored if not set
+        ra = blockPar['ra']
+        dec = blockPar['dec']
+
+        # Airmass of every block over the whole night, computed once. Allocated slots are removed from the grid by
+        # indexing into it.
+        if 'ephem' in kwargs:
+            ephem = kwargs['ephem'].regrid(time_grid)
+        else:
+            ephem = ephemeris.Ephemeris.fromSite(site, time_grid)
+        if 'executor' in kwargs:
+            airmassMatrix = ephemeris.airmass(kwargs['executor'].altitude(ephem, ra, dec))
+        else:
+            airmassMatrix = ephem.airmass(ra, dec)
+        airmassMatrix[airmassMatrix < 0.] = 999.
+        grid_index = np.arange(len(time_grid))
+
+        # Times already taken by programs in the queue (incremental scheduling) are not available.
+        if 'occupied' in kwargs and kwargs['occupied'] is not None:
+            for start, end in kwargs['occupied']:
+                grid_index = grid_index[np.bitwise_not(np.bitwise_and(time_grid[grid_index] > start,
+                                                                      time_grid[grid_index] < end))]
+
+        if 'moon' in kwargs:
+            moon = kwargs['moon']
+        else:
+            moon = ephemeris.MoonTable.cached(site, nightstart, nightend, moon_table_step)
 
         # Start allocating
         ## get lst at meadle of the observing window
         midnight = (nightstart+nightend)/2.
-        dateTime = datetimeFromJD(midnight)
-        lstmid = site.LST_inRads(dateTime) # in radians
+        lstmid = ephem.lstAt(midnight) # in radians
 
         nalloc = 0 # number of stars allocated
         nblock = 0 # block iterator
         nballoc = 0 # total number of blocks allocated
 
-        while nalloc < nstars and nblock < len(radecArray):
-        # while nblock < len(radecArray):
+        while nalloc < nstars and nblock < len(blockPar):
             # get airmasses
-            olst = np.float(radecArray[nblock].ra)*np.pi/180.*0.999
-            maxAltitude = float(site.raDecToAltAz(radecArray[nblock],
-                                                  olst).alt)
+            olst = ra[nblock]*0.999
+            maxAltitude = float(ephemeris.altitude(olst, ephem.latitude, ra[nblock], dec[nblock]))
             minAM = 1./np.cos(np.pi/2.-maxAltitude*np.pi/180.)
 
             log.debug("Altitute max/min: %.2f/%.2f" % (maxAltitude,MINALTITUDE))
@@ -192,8 +188,8 @@ class ExtintionMonitor(BaseScheduleAlgorith):
             log.debug('Working on: %s'%targetNameArray[nblock])
 
             if maxAltitude < MINALTITUDE:
+                log.debug('Max altitude %6.2f lower than minimum: %s'%(maxAltitude,targetNameArray[nblock]))
                 nblock+=1
-                log.debug('Max altitude %6.2f lower than minimum: %s'%(float(radecArray[nblock].ra),radecArray[nblock]))
                 continue
             elif minAM > minAirmass[nblock]:
             #    nblock+=1
@@ -222,12 +218,11 @@ class ExtintionMonitor(BaseScheduleAlgorith):
 
             start = nightstart if start < nightstart else start
             end = nightend if end > nightend else end
-            log.debug('Trying to allocate %s'%(radecArray[nblock]))
+            log.debug('Trying to allocate %s'%(targetNameArray[nblock]))
             nballoc_tmp = nballoc
 
-            lst_grid = [site.LST_inRads(datetimeFromJD(tt)) for tt in time_grid]
-            airmass_grid = np.array([Airmass(float(site.raDecToAltAz(radecArray[nblock],
-                                                         lst).alt)) for lst in lst_grid])
+            time_grid = ephem.jd[grid_index]
+            airmass_grid = airmassMatrix[grid_index, nblock]
             min_amidx = np.argmin(airmass_grid)
             for dam in dairMass:
                 converged = False
@@ -328,29 +323,25 @@ class ExtintionMonitor(BaseScheduleAlgorith):
                     # moonRaDec = self.site.altAzToRaDec(self.site.moonpos(dateTime),lst)
                     # moonDist = raDec.angsep(moonRaDec)
 
-                    _dateTime = datetimeFromJD(time)
-                    lst = site.LST_inRads(_dateTime)
-                    moonpos = site.moonpos(_dateTime)
                     #check that moon is above horizon!
-                    if moonpos.alt > 0.:
-
-                        moonRaDec = site.altAzToRaDec(moonpos,lst)
-
+                    if moon.altitude(time) > 0.:
 
+                        moonRaDec = moon.position(time)
+                        moonDist = float(moon.separation(time, ra[nblock], dec[nblock]))
 
-                        moonBrightness = site.moonphase(_dateTime)*100.
-                        s_target = targets[:][nblock]
+                        moonBrightness = moon.brightness(time)
+                        s_target = blockPar[nblock]
 
-                        if (radecArray[nblock].angsep(moonRaDec) < s_target[1].minmoonDist) or not (s_target[1].minmoonBright < moonBrightness < s_target[1].maxmoonBright):
+                        if (moonDist < s_target['minmoonDist']) or not (s_target['minmoonBright'] < moonBrightness < s_target['maxmoonBright']):
                             log.warning('Cannot allocate target due to moon restrictions...')
                             log.debug("Moon Conditions @ %s: Target@ %s | Moon@: %s | AngSep: %.2f (min.: %.2f) |Moon Brightness: %.2f (%.2f:%.2f) "%(time,
-                                                                                                       radecArray[nblock],
+                                                                                                       targetNameArray[nblock],
                                                                                                        moonRaDec,
-                                                                                                       radecArray[nblock].angsep(moonRaDec),
-                                                                                                    s_target[1].minmoonDist,
+                                                                                                       moonDist,
+                                                                                                    s_target['minmoonDist'],
                                                                                        moonBrightness,
-                                                                                       s_target[1].minmoonBright,
-                                                                                       s_target[1].maxmoonBright))
+                                                                                       s_target['minmoonBright'],
+                                                                                       s_target['maxmoonBright']))
                             break
 
 
@@ -382,14 +373,14 @@ class ExtintionMonitor(BaseScheduleAlgorith):
             if len(allocateSlot) == nairmass:
                 log.info('Allocating...')
                 obsSlots = np.append(obsSlots,allocateSlot)
-                keep_mask = np.zeros_like(time_grid) == 0
+                keep_mask = np.ones(len(time_grid), dtype=np.bool)
                 for islot in range(len(obsSlots)):
                     keep_mask = np.bitwise_and(keep_mask,
                                                np.bitwise_not(np.bitwise_and(time_grid > obsSlots['start'][islot],
                                                                              time_grid < obsSlots['end'][islot])
                                                               )
                                                   )
-                time_grid = time_grid[keep_mask]
+                grid_index = grid_index[keep_mask]
                 nalloc+=1
                 nballoc += nballoc_tmp
             else:
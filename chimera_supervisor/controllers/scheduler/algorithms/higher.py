@@ -26,6 +26,8 @@ class Higher(BaseScheduleAlgorith):
 
         pool_size = 1
         max_sched_blocks = -1
+        moon_table_step = 600.
+        index_threshold = 5000
         if 'config' in kwargs:
             config = kwargs['config']
             if 'pool_size' in config:
@@ -38,9 +40,15 @@ class Higher(BaseScheduleAlgorith):
             if 'max_sched_blocks' in config:
                 max_sched_blocks = config['max_sched_blocks']
 
+            if 'moon_table_step' in config:
+                moon_table_step = config['moon_table_step']
+
+            if 'index_threshold' in config:
+                index_threshold = config['index_threshold']
+
         nightstart = kwargs['obsStart']
         nightend   = kwargs['obsEnd']
-        site = kwargs['site']
+        site = kwargs.get('site')
 
         # Creat observation slots.
 
@@ -56,6 +64,11 @@ class Higher(BaseScheduleAlgorith):
         obsSlots['slotid'] = np.arange(len(obsSlots))
         obsSlots['blockid'] = np.zeros(len(obsSlots))-1
 
+        # Slots already taken by programs in the queue (incremental scheduling) are marked as filled.
+        if 'occupied' in kwargs and kwargs['occupied'] is not None:
+            for start, end in kwargs['occupied']:
+                obsSlots['blockid'][np.bitwise_and(obsSlots['end'] > start, obsSlots['start'] < end)] = -2
+
         '''
         obsTargets = np.array([],dtype=[('obsblock',ObsBlock),
                                         ('targets',Targets),
@@ -65,37 +78,50 @@ class Higher(BaseScheduleAlgorith):
 
         # For each slot select the higher in the sky...
 
-        targets = kwargs['query']
-
-        radecArray = np.array([Position.fromRaDec(targets[:][0][2].targetRa,
-                                                  targets[:][0][2].targetDec)])
-
-        moonPar = np.array([( target[1].minmoonDist,
-                              target[1].minmoonBright ,
-                              target[1].maxmoonBright,
-                              target[0].length) for target in targets[:]],
-                           dtype=[('minmoonDist',np.float),
-                                  ('minmoonBright',np.float),
-                                  ('maxmoonBright',np.float),
-                                  ('lenght',np.float)])
-
-        radecPos = np.array([0])
-
-        blockid = targets[:][0][0].blockid
-
-        for itr,target in enumerate(targets):
-            if blockid != target[0].blockid:
-                radecArray =  np.append(radecArray,Position.fromRaDec(target[2].targetRa,
-                                                                      target[2].targetDec))
-                blockid = target[0].blockid
-                radecPos = np.append(radecPos,itr)
-
-        '''
-        radecArray = np.array([Position.fromRaDec(target[2].targetRa,
-                                                 target[2].targetDec) for target in targets])'''
-
-        mask = np.zeros(len(radecArray)) == 0
-        #radecPos = np.arange(len(radecArray))
+        if 'catalog' in kwargs:
+            catalog = kwargs['catalog']
+        else:
+            catalog = TargetCatalog.fromQuery(kwargs['query'])
+
+        if len(catalog) == 0:
+            log.warning('No targets to schedule.')
+            return obsSlots
+
+        # One entry per block (first target of the block).
+        blockIndex = catalog.blocks()
+        blockPar = catalog[blockIndex]
+        ra = blockPar['ra']
+        dec = blockPar['dec']
+
+        # Altitude of every block on every slot. Start, middle and end refer to the block length. An ephemeris can
+        # be given instead of the site (e.g. simulations).
+        if 'ephem' in kwargs:
+            ephem = kwargs['ephem'].regrid(obsSlots['start'])
+        else:
+            ephem = ephemeris.Ephemeris.fromSite(site, obsSlots['start'])
+
+        if 'moon' in kwargs:
+            moon = kwargs['moon']
+        else:
+            moon = ephemeris.MoonTable.cached(site, nightstart, nightend, moon_table_step)
+        moonAltitude = moon.altitude(obsSlots['start'])
+        moonBrightnessArray = moon.brightness(obsSlots['start'])
+
+        # Targets are split across the executor workers. If no executor is given, use a private one.
+        if 'executor' in kwargs:
+            executor = kwargs['executor']
+        else:
+            executor = SchedulerExecutor(pool_size)
+
+        try:
+            log.debug('Evaluating %i slots x %i blocks' % (len(obsSlots), len(ra)))
+            evaluator = SlotEvaluator(ephem, moon, blockPar, executor, index_threshold)
+        finally:
+            if 'executor' not in kwargs:
+                executor.close()
+
+        # Blocks that were not scheduled yet
+        available = np.ones(len(ra), dtype=np.bool)
         nblocks_scheduled = 0
 
         for itr in range(len(obsSlots)):
@@ -103,99 +129,36 @@ class Higher(BaseScheduleAlgorith):
             # this "if" is the key to multitarget blocks...
             if obsSlots['blockid'][itr] == -1:
 
-                dateTime = datetimeFromJD(obsSlots['start'][itr])
-
-                lst = site.LST_inRads(dateTime) # in radians
+                # Check moon brightness..
+                moonAlt = moonAltitude[itr]
 
-                # This loop is really slow! Must think of a way to speed
-                # things up...
-
-                # Apply moon exclusion radius..
-                moonPos = site.moonpos(dateTime)
-                moonRaDec = site.altAzToRaDec(moonPos,lst)
-
-                moonBrightness = site.moonphase(dateTime)*100.
+                moonBrightness = moonBrightnessArray[itr]
 
                 if (
-                    (not (moonPar['minmoonBright'].max() < moonBrightness < moonPar['maxmoonBright'].min())) and
-                        (moonPos.alt > 0.)
+                    (not (blockPar['minmoonBright'].max() < moonBrightness < blockPar['maxmoonBright'].min())) and
+                        (moonAlt > 0.)
                     ):
                     log.warning('Slot[%03i]: Moon brightness (%5.1f%%) out of range (%5.1f%% -> %5.1f%%). \
     Moon alt. = %6.2f. Skipping this slot...'%(itr+1,
                                       moonBrightness,
-                                      moonPar['minmoonBright'].max(),
-                                      moonPar['maxmoonBright'].min(),
-                                      moonPos.alt))
+                                      blockPar['minmoonBright'].max(),
+                                      blockPar['maxmoonBright'].min(),
+                                      moonAlt))
                     continue
 
-                # Calculate target parameters
-                log.debug('Starting slow loop')
-
-                targetPar = np.zeros(len(radecArray),
-                                     dtype=[('altitude', np.float),
-                                            ('start_altitude', np.float),
-                                            ('end_altitude', np.float),
-                                            ('moonD', np.float),
-                                            ('minmoonD', np.float),
-                                            ('mask_moonBright', np.bool)])
-
-                def worker(index):
-                    try:
-                        time_offset = Coord.fromAS(moonPar['lenght'][index])
-                        log.debug('%s %s %s' % (lst, time_offset.R, time_offset.H))
-                        targetPar[index] = (
-                            float(site.raDecToAltAz(radecArray[index],lst+time_offset.R/2.).alt),
-                            float(site.raDecToAltAz(radecArray[index],lst).alt),
-                            float(site.raDecToAltAz(radecArray[index],lst+time_offset.R).alt),
-                            radecArray[index].angsep(moonRaDec),
-                            moonPar['minmoonDist'][index],
-                            ((moonPar['minmoonBright'][index] < moonBrightness < moonPar['maxmoonBright'][index])
-                             or (moonPos.alt < 0.))
-                        )
-                    except Exception, e:
-                        log.exception(e)
-
-                # for item in items:
-                #     pool.apply_async(worker, (item,))
-                #
-                # pool.close()
-                # pool.join()
-                pool = Pool(pool_size)
-
-                for i in range(len(radecArray)):
-                    # if i % 100 == 0:
-                    #     log.debug('%i/%i'%(i,len(radecArray)))
-                    #
-                    # targetPar[i] = ( float(site.raDecToAltAz(radecArray[i],lst).alt),
-                    #                  radecArray[i].angsep(moonRaDec),
-                    #                  targets[i][1].minmoonDist,
-                    #                  targets[i][1].minmoonBright < moonBrightness < targets[i][1].maxmoonBright )
-                    pool.apply_async(worker,(i,))
-
-                log.debug('Starting pool')
-                pool.close()
-                pool.join()
-                log.debug('Pool done')
-
-                # Create moon mask
-                moonMask = np.bitwise_and(targetPar['moonD'] > targetPar['minmoonD'],targetPar['mask_moonBright'])
-
-                # guarantee it is a copy not a reference...
-                # tmp_Mask = np.bitwise_and(moonMask)
-                mapping = np.arange(len(mask))[moonMask]
-                tmp_radecArray = np.array(radecArray[moonMask], copy=True)
-                tmp_radecPos = np.array(radecPos[moonMask], copy=True)
-
-                if len(tmp_radecArray) == 0:
+                # Apply moon restrictions to the remaining blocks
+                selected, alt, start_alt, end_alt = evaluator.evaluate(itr, available)
+
+                if len(selected) == 0:
                     log.warning('Slot[%03i]: Could not find suitable target'%(itr+1))
                     continue
 
-                #sitelat = np.sum(np.array([float(tt) / 60.**i for i,tt in enumerate(str(site['latitude']).split(':'))]))
-                alt = targetPar['altitude'][moonMask]
-
                 stg = alt.argmax()
-                start_alt = targetPar['start_altitude'][moonMask][stg]
-                end_alt = targetPar['end_altitude'][moonMask][stg]
+                iblock = selected[stg]
+                start_alt = start_alt[stg]
+                end_alt = end_alt[stg]
+
+                s_target = blockPar[iblock]
 
                 # Check airmass
                 airmass = 1./np.cos(np.pi/2.-alt[stg]*np.pi/180.)
@@ -203,60 +166,26 @@ class Higher(BaseScheduleAlgorith):
                 end_airmass = 1./np.cos(np.pi/2.-end_alt*np.pi/180.)
                 # Since this is the highest at this time, doesn't make
                 # sense to iterate over it
-                if start_airmass > targets[:][radecPos[stg]][1].maxairmass or \
-                                end_airmass > targets[:][radecPos[stg]][1].maxairmass or airmass < 0. or start_alt < 0.:
+                if start_airmass > s_target['maxairmass'] or \
+                                end_airmass > s_target['maxairmass'] or airmass < 0. or start_alt < 0.:
                     log.info('Object too low in the sky, (Alt.=%6.2f) airmass = %5.2f/%5.2f/%5.2f (max = %5.2f)... '
                              'Skipping this slot..' % (alt[stg], start_airmass, airmass, end_airmass,
-                                                     targets[:][radecPos[stg]][1].maxairmass))
+                                                     s_target['maxairmass']))
                     continue
 
-                # Now, this one makes sense to iterate over.. But, a target
-                # that is too close to the moon now, may not be in the
-                # future, so, need to keep it in the list. That's why we
-                # use temporary arrays...
-                # s_target = targets[:][tmp_radecPos[stg]]
-
-                # while ( (tmp_radecArray[stg].angsep(moonRaDec) < s_target[1].minmoonDist)  ):
-                #     if len(tmp_Mask) == 0:
-                #         break
-                #     msg = '''Target %s %s cannot be observed due to moon restrictions (d = %.2f < %.2f). Moon @ %s (Phase: %.2f)'''
-                #     log.warning(msg%(s_target[0],
-                #                      s_target[2],
-                #                      tmp_radecArray[stg].angsep(moonRaDec),
-                #                      s_target[1].minmoonDist,
-                #                      moonRaDec,
-                #                      moonBrightness))
-                #     tmp_Mask[stg] = False
-                #     tmp_radecArray = tmp_radecArray[tmp_Mask]
-                #     tmp_radecPos = tmp_radecPos[tmp_Mask]
-                #     alt = alt[tmp_Mask]
-                #     stg = alt.argmax()
-                #     tmp_Mask = tmp_Mask[tmp_Mask]
-                #     # Check airmass
-                #     airmass = 1./np.cos(np.pi/2.-alt[stg]*np.pi/180.)
-                #     if airmass > targets[:][radecPos[stg]][1].maxairmass:
-                #         log.info('New object too low in the sky, (Alt.=%6.2f) airmass = %5.2f (max = %5.2f)...'%(alt[stg],airmass,targets[:][radecPos[stg]][1].maxairmass))
-                #
-                #         tmp_Mask = [] # empty tmp mask. This is the highest! No sense going on...
-                #         break
-                #     s_target = targets[:][tmp_radecPos[stg]]
-
-                s_target = targets[tmp_radecPos[stg]]
-
-                log.info('Slot[%03i] @%.3f: %s %s (Alt.=%6.2f, airmass=%5.2f (max=%5.2f))' % (itr+1,
+                # A target that is too close to the moon now, may not be in the future, so it is only removed from
+                # the list once it is scheduled.
+
+                log.info('Slot[%03i] @%.3f: %s[%i] (Alt.=%6.2f, airmass=%5.2f (max=%5.2f))' % (itr+1,
                                                                                               obsSlots['start'][itr],
-                                                                                              s_target[0],
-                                                                                              s_target[2],
+                                                                                              s_target['name'],
+                                                                                              s_target['blockid'],
                                                                                               start_alt,
                                                                                               airmass,
-                                                                                              s_target[1].maxairmass))
-
-                mask[mapping[stg]] = False
-                radecArray = radecArray[mask]
-                radecPos = radecPos[mask]
-                moonPar = moonPar[mask]
-                mask = mask[mask]
-                obsSlots['blockid'][itr] = s_target[0].blockid
+                                                                                              s_target['maxairmass']))
+
+                available[iblock] = False
+                obsSlots['blockid'][itr] = s_target['blockid']
                 nblocks_scheduled += 1
                 if max_sched_blocks > 0 and nblocks_scheduled >= max_sched_blocks:
                     log.info('Maximum number of scheduled blocks (%i) reached. Stopping.' % max_sched_blocks)
@@ -264,31 +193,15 @@ class Higher(BaseScheduleAlgorith):
 
 
                 # Check if this block has more targets...
-                secTargets = targets.filter(ObsBlock.blockid == s_target[0].blockid,
-                                            ObsBlock.objid != s_target[0].objid)
-
-                if secTargets.count() > 0:
+                if catalog.secondary(blockIndex[iblock]) > 0:
                     log.debug(red('Secondary targets not implemented yet...'))
                     pass
 
-                if len(mask) == 0:
+                if not available.any():
                     break
 
-                '''
-                if not targets[stg][0].blockid in obsTargets['blockid']:
-                    #log.debug('#%s %i %i %f: lst = %f | ra = %f | scheduled = %i'%(s_target[0].pid,stg,targets[:][stg][0].blockid,obsSlots['start'][itr],lst,s_target[1].targetRa,targets[:][stg][0].scheduled))
-                    log.info('Slot[%03i]: %s'%(itr+1,s_target[2]))
-
-                    #obsTargets = np.append( obsTargets, np.array((s_target[0],s_target[1],targets[stg][0].blockid),dtype=[('obsblock',ObsBlock),('targets',Targets),('blockid',np.int)]))
-
-                    #self.addObservation(s_target[0],obsSlots['start'][itr])
-                    targets[stg][0].scheduled = True
-
-                else:
-                    log.debug('#Block already scheduled#%s %i %i %f: lst = %f | ra = %f | scheduled = %i'%(s_target[0].pid,stg,targets[stg][0].blockid,obsSlots['start'][itr],lst,s_target[1].targetRa,targets[stg][0].scheduled))
-                '''
-            #targets = targets.filter(ObsBlock.scheduled == False)
-            else:
+            elif obsSlots['blockid'][itr] != -2:
+                # Slots taken by programs already in the queue (-2) are expected, skip them quietly
                 log.warning('Observing slot[%i]@%.4f is already filled with block id %i...'%(itr,
                                                                                              obsSlots['start'][itr],
                                                                                              obsSlots['blockid'][itr]))
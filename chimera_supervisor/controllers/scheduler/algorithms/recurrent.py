@@ -43,19 +43,23 @@ class Recurrent(BaseScheduleAlgorith):
                 slotLen = 1800.
         elif 'slotLen' in config:
             slotLen = config['slotLen']
-        from chimera_supervisor.controllers.scheduler.model import Targets,ObsBlock
         # Filter target by observing data. Leave "NeverObserved" and those observed more than recurrence_time days ago
-        today = kwargs['site'].ut().replace(tzinfo=None)
         if 'today' in kwargs: # Needed for simulations...
             today = kwargs['today'].replace(tzinfo=None)
-        reference_date = today - datetime.timedelta(days=recurrence_time)
+        else:
+            today = kwargs['site'].ut().replace(tzinfo=None)
+        reference_date = mjdFromDatetime(today - datetime.timedelta(days=recurrence_time))
+
+        if 'catalog' in kwargs:
+            catalog = kwargs['catalog']
+        else:
+            catalog = TargetCatalog.fromQuery(kwargs['query'])
 
-        ntargets = len(kwargs['query'][:])
+        ntargets = len(catalog)
         # Exclude targets that where observed less then a specified ammount of time
-        kwargs['query'] = kwargs['query'].filter(or_(ObsBlock.observed == False,
-                                                     and_(ObsBlock.observed == True,
-                                                          ObsBlock.lastObservation < reference_date)))
-        new_ntargets = len(kwargs['query'][:])
+        kwargs['catalog'] = catalog.select(np.bitwise_or(np.bitwise_not(catalog['observed']),
+                                                         catalog['lastObservation'] < reference_date))
+        new_ntargets = len(kwargs['catalog'])
         log.debug('Filtering %i of %i targets' % (new_ntargets, ntargets))
         # Select targets with the Higher algorithm
         programs = Higher.process(slotLen=slotLen,*args,**kwargs)
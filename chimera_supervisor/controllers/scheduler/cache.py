@@ -0,0 +1,72 @@
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+class ConditionsCache(object):
+    '''
+    Bounded LRU cache for the observing condition verdicts (airmass, moon and night end) of a program. Entries are keyed
+    by target id, blockpar id, the values the verdict depends on (target coordinates and block restrictions), time
+    bucket (of quantum seconds) and program length. Since the values are part of the key, a target or BlockPar changed
+    anywhere gets new entries and the old ones are evicted as they age.
+    '''
+
+    def __init__(self, size=4096, quantum=60.):
+        '''
+        :param size: Maximum number of entries.
+        :param quantum: Time bucket size in seconds.
+        '''
+        self.size = int(size)
+        self.quantum = float(quantum)
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, tid, blockpar_id, mjd, length=0., restrictions=()):
+        '''
+        :param restrictions: Tuple with the values the verdict depends on.
+        '''
+        return (tid, blockpar_id, tuple(restrictions), int(np.floor(mjd*86400./self.quantum)), int(round(length)))
+
+    def get(self, key):
+        '''
+        Return the cached verdict or None if key is not in the cache.
+        '''
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            value = self._entries.pop(key)
+            self._entries[key] = value # most recently used goes to the end
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+            elif len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+            self._entries[key] = value
+
+    def invalidate(self, blockpar_id=None):
+        '''
+        Drop the entries of a blockpar or, if blockpar_id is None, all entries.
+        '''
+        with self._lock:
+            if blockpar_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[1] == blockpar_id]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'hit_ratio': float(self.hits)/total if total > 0 else 0.}
@@ -0,0 +1,157 @@
+
+'''
+Columnar, in-memory view of the observing blocks selected for scheduling.
+
+The scheduling algorithms used to walk the SQLAlchemy query row by row (and re-execute it every time it was sliced).
+TargetCatalog loads everything the algorithms need in a single SELECT into a numpy structured array, so the
+algorithms only index arrays.
+'''
+
+import datetime
+
+import numpy as np
+from sqlalchemy import func, case, select
+
+from chimera_supervisor.controllers.scheduler.model import ObsBlock, BlockPar, Targets, Expose, AutoFocus
+from chimera_supervisor.controllers.scheduler import ephemeris
+
+MJD0 = datetime.datetime(1858, 11, 17)
+
+def mjdFromDatetime(date):
+    '''
+    Modified julian date of a (naive, UT) datetime. Returns NaN for None.
+    '''
+    if date is None:
+        return np.nan
+    delta = date.replace(tzinfo=None) - MJD0
+    return delta.days + (delta.seconds + delta.microseconds/1e6)/86400.
+
+class TargetCatalog(object):
+    '''
+    One entry per query row (ObsBlock, BlockPar, Targets). Coordinates are stored in radians.
+    '''
+
+    dtype = [('id', np.int64),              # ObsBlock.id
+             ('blockid', np.int64),         # ObsBlock.blockid
+             ('tid', np.int64),             # Targets.id
+             ('name', object),
+             ('ra', np.float64),
+             ('dec', np.float64),
+             ('minmoonDist', np.float64),
+             ('minmoonBright', np.float64),
+             ('maxmoonBright', np.float64),
+             ('minairmass', np.float64),
+             ('maxairmass', np.float64),
+             ('length', np.float64),        # block length in seconds
+             ('exptime', np.float64),       # open shutter time of the block actions, in seconds
+             ('frames', np.int64),          # number of frames of the block actions
+             ('focusAlign', np.int64),      # number of focus runs (step > 0)
+             ('focusSet', np.int64),        # number of focus sets (step == 0)
+             ('observed', np.bool_),
+             ('lastObservation', np.float64)]  # MJD, NaN if never observed
+
+    def __init__(self, data):
+        self.data = data
+
+    @staticmethod
+    def fromQuery(query):
+        '''
+        Load the catalog from a query on (ObsBlock, BlockPar, Targets), keeping its filters and ordering. Exposure
+        times and focus runs of the block actions are summed in the database, with one query each.
+        '''
+        rows = query.with_entities(ObsBlock.id,
+                                   ObsBlock.blockid,
+                                   Targets.id,
+                                   Targets.name,
+                                   Targets.targetRa,
+                                   Targets.targetDec,
+                                   BlockPar.minmoonDist,
+                                   BlockPar.minmoonBright,
+                                   BlockPar.maxmoonBright,
+                                   BlockPar.minairmass,
+                                   BlockPar.maxairmass,
+                                   ObsBlock.length,
+                                   ObsBlock.observed,
+                                   ObsBlock.lastObservation).all()
+
+        data = np.array([row[:12] + (0., 0, 0, 0, bool(row[12]), mjdFromDatetime(row[13])) for row in rows],
+                        dtype=TargetCatalog.dtype)
+
+        # Columns stored as NULL come back as NaN. Use the model defaults instead.
+        for column, default in (('minmoonDist', -1.),
+                                ('minmoonBright', 0.),
+                                ('maxmoonBright', 100.),
+                                ('minairmass', -1.),
+                                ('maxairmass', 2.5),
+                                ('length', 0.)):
+            data[column][np.isnan(data[column])] = default
+
+        data['ra'], data['dec'] = ephemeris.catalogArrays(data['ra'], data['dec'])
+
+        if len(data) > 0:
+            index = dict([(block_id, i) for i, block_id in enumerate(data['id'])])
+            blocks = select([query.with_entities(ObsBlock.id).order_by(None).subquery().c.id])
+            session = query.session
+
+            for block_id, exptime, frames in session.query(Expose.block_id,
+                                                           func.sum(Expose.exptime*Expose.frames),
+                                                           func.sum(Expose.frames)).filter(
+                    Expose.block_id.in_(blocks)).group_by(Expose.block_id):
+                data['exptime'][index[block_id]] = exptime or 0.
+                data['frames'][index[block_id]] = frames or 0
+
+            for block_id, align, focusSet in session.query(AutoFocus.block_id,
+                                                           func.sum(case([(AutoFocus.step > 0, 1)], else_=0)),
+                                                           func.sum(case([(AutoFocus.step == 0, 1)], else_=0))).filter(
+                    AutoFocus.block_id.in_(blocks)).group_by(AutoFocus.block_id):
+                data['focusAlign'][index[block_id]] = align or 0
+                data['focusSet'][index[block_id]] = focusSet or 0
+
+        return TargetCatalog(data)
+
+    @staticmethod
+    def fromQueue(queue, lastObservation=None):
+        '''
+        Load the catalog from a columnar queue (simulator.QUEUE_DTYPE), one entry per program. Used to schedule the
+        nights of a simulation, blocks are identified by ObsBlock.id.
+
+        :param lastObservation: Time (MJD) each program was last observed, NaN if never.
+        '''
+        data = np.zeros(len(queue), dtype=TargetCatalog.dtype)
+        data['id'] = queue['blockid']
+        data['blockid'] = queue['blockid']
+        for column in ('tid', 'name', 'ra', 'dec', 'minmoonDist', 'minmoonBright', 'maxmoonBright', 'minairmass',
+                       'maxairmass', 'length', 'exptime'):
+            data[column] = queue[column]
+        data['lastObservation'] = np.nan if lastObservation is None else lastObservation
+        data['observed'] = np.bitwise_not(np.isnan(data['lastObservation']))
+
+        return TargetCatalog(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def select(self, mask):
+        '''
+        Return a new catalog with the entries selected by mask (boolean mask or index array).
+        '''
+        return TargetCatalog(self.data[mask])
+
+    def blocks(self):
+        '''
+        Index of the first entry of each observing block. Entries of a block are expected to be contiguous, as
+        returned by the query.
+        '''
+        if len(self.data) == 0:
+            return np.array([], dtype=int)
+        return np.append(0, np.where(np.diff(self.data['blockid']) != 0)[0]+1)
+
+    def secondary(self, index):
+        '''
+        Number of other targets in the same block as entry index.
+        '''
+        return int(np.sum(np.bitwise_and(self.data['blockid'] == self.data['blockid'][index],
+                                         self.data['tid'] != self.data['tid'][index])))
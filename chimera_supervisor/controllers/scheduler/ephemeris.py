@@ -0,0 +1,397 @@
+
+'''
+Vectorized ephemeris for the scheduling algorithms.
+
+The slot loops used to ask the remote Site object for the altitude of every target on every slot. Here local sidereal
+time is anchored with a single call to the site and propagated analytically over the whole time grid, so altitudes
+and airmasses for every (slot, target) pair come out of one array operation.
+'''
+
+import os
+import glob
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from chimera_supervisor.core.constants import DEFAULT_ROBOBS_DATABASE
+
+from chimera.core.site import datetimeFromJD
+from chimera.util.position import Position
+from chimera.util.coord import Coord
+
+# Ratio between sidereal and solar time rates.
+SIDEREAL_RATE = 1.00273790935
+
+def siteLatitude(site):
+    '''
+    Return site latitude in radians. Works with the remote Site proxy or any object that can be indexed with
+    'latitude'.
+    '''
+    latitude = site['latitude']
+    if not isinstance(latitude, Coord):
+        latitude = Coord.fromDMS(str(latitude))
+    return float(latitude.R)
+
+def siteLongitude(site):
+    '''
+    Return site longitude in degrees.
+    '''
+    longitude = site['longitude']
+    if not isinstance(longitude, Coord):
+        longitude = Coord.fromDMS(str(longitude))
+    return float(longitude.D)
+
+def localNoon(jd, longitude):
+    '''
+    Julian date of the local (mean) noon preceding jd, for a site at longitude (in degrees, east positive). Used to
+    define the "night" a given time belongs to.
+    '''
+    return np.floor(jd + longitude/360.) - longitude/360.
+
+def hourAngleOffset(seconds):
+    '''
+    Convert a time interval, in seconds, to the corresponding increase in hour angle, in radians.
+    '''
+    return np.asarray(seconds, dtype=np.float64)*2.*np.pi*SIDEREAL_RATE/86400.
+
+def catalogArrays(ra, dec):
+    '''
+    Convert target coordinates, as stored in the Targets table (RA in hours, Dec in degrees), to contiguous float64
+    arrays in radians.
+    '''
+    return (np.ascontiguousarray(np.radians(15.*np.asarray(ra, dtype=np.float64))),
+            np.ascontiguousarray(np.radians(np.asarray(dec, dtype=np.float64))))
+
+def angularSeparation(ra1, dec1, ra2, dec2):
+    '''
+    Angular separation, in degrees, between (ra1, dec1) and (ra2, dec2) using the haversine formula. All inputs are in
+    radians and are broadcast against each other.
+    '''
+    hav = np.sin((dec2 - dec1)/2.)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2.)**2
+    return np.degrees(2.*np.arcsin(np.sqrt(np.clip(hav, 0., 1.))))
+
+def altitude(lst, latitude, ra, dec):
+    '''
+    Altitude, in degrees, of targets at (ra, dec) for a site at latitude with local sidereal time lst. All inputs are
+    in radians and are broadcast against each other.
+    '''
+    sinalt = np.sin(latitude)*np.sin(dec) + np.cos(latitude)*np.cos(dec)*np.cos(lst - ra)
+    return np.degrees(np.arcsin(np.clip(sinalt, -1., 1.)))
+
+def altitudeGrid(lst, latitude, ra, dec, offset=0.):
+    '''
+    Altitude, in degrees, of every target on every local sidereal time of lst.
+
+    :param offset: Time offset, in seconds, to add to each time. Either a scalar or one value per target.
+    :return: Array with shape (ntimes, ntargets).
+    '''
+    return altitude(np.atleast_1d(lst)[:, np.newaxis] + hourAngleOffset(offset),
+                    latitude,
+                    np.atleast_1d(ra)[np.newaxis, :],
+                    np.atleast_1d(dec)[np.newaxis, :])
+
+def moonMaskGrid(moonRa, moonDec, brightness, below, ra, dec, minDist, minBright=None, maxBright=None):
+    '''
+    Moon restrictions for every target on every moon position given (see MoonTable.moonMask).
+
+    :param brightness: Moon brightness, in percent, on each time.
+    :param below: True on the times the moon is below the horizon.
+    :return: Boolean array with shape (ntimes, ntargets).
+    '''
+    mask = angularSeparation(np.atleast_1d(moonRa)[:, np.newaxis],
+                             np.atleast_1d(moonDec)[:, np.newaxis],
+                             np.atleast_1d(ra)[np.newaxis, :],
+                             np.atleast_1d(dec)[np.newaxis, :]) > np.atleast_1d(minDist)[np.newaxis, :]
+
+    if minBright is not None and maxBright is not None:
+        brightness = np.atleast_1d(brightness)[:, np.newaxis]
+        below = np.atleast_1d(below)[:, np.newaxis]
+        mask &= (((np.atleast_1d(minBright)[np.newaxis, :] < brightness) &
+                  (brightness < np.atleast_1d(maxBright)[np.newaxis, :])) | below)
+
+    return mask
+
+def airmass(alt):
+    '''
+    Plane-parallel airmass for altitudes in degrees. Same convention as the scalar computation used by the
+    algorithms, so targets below the horizon have negative airmass.
+    '''
+    with np.errstate(divide='ignore'):
+        return 1./np.cos(np.pi/2.-np.radians(alt))
+
+def earliestFeasible(condition, start, end, step=60., tolerance=1.):
+    '''
+    Earliest time in [start, end] from which condition holds continuously up to end. The condition is first evaluated
+    on a grid of step seconds, to find the feasible window that contains end, and the window start is refined by
+    bisection.
+
+    :param condition: Function of an array of julian dates returning a boolean array. Must be vectorized.
+    :param start: Start of the search (julian date).
+    :param end: End of the search (julian date).
+    :param step: Grid step in seconds.
+    :param tolerance: Precision of the result in seconds.
+    :return: Julian date or None if condition does not hold at end.
+    '''
+    grid = np.append(np.arange(start, end, step/86400.), end)
+    feasible = np.asarray(condition(grid), dtype=bool)
+
+    if not feasible[-1]:
+        return None
+
+    infeasible = np.where(np.bitwise_not(feasible))[0]
+    if len(infeasible) == 0:
+        return float(start)
+
+    low, high = grid[infeasible[-1]], grid[infeasible[-1]+1]
+    while (high - low)*86400. > tolerance:
+        middle = (low + high)/2.
+        if condition(np.array([middle]))[0]:
+            high = middle
+        else:
+            low = middle
+
+    return float(high)
+
+class Ephemeris(object):
+    '''
+    Local sidereal time and target altitudes over a grid of julian dates.
+    '''
+
+    def __init__(self, jd, latitude, lst0):
+        '''
+        :param jd: Time grid (julian dates).
+        :param latitude: Site latitude in radians.
+        :param lst0: Local sidereal time, in radians, at jd[0].
+        '''
+        self.jd = np.atleast_1d(np.asarray(jd, dtype=np.float64))
+        self.latitude = float(latitude)
+
+        self._jd0 = self.jd[0]
+        self._lst0 = float(lst0)
+
+        self.lst = self.lstAt(self.jd)
+
+    @staticmethod
+    def fromSite(site, jd):
+        '''
+        Build the ephemeris for a time grid using the remote site only once, to anchor the sidereal time.
+        '''
+        jd = np.atleast_1d(np.asarray(jd, dtype=np.float64))
+        lst0 = float(site.LST_inRads(datetimeFromJD(jd[0])))
+        return Ephemeris(jd, siteLatitude(site), lst0)
+
+    def regrid(self, jd):
+        '''
+        Ephemeris of the same site on another time grid, without going back to the site.
+        '''
+        jd = np.atleast_1d(np.asarray(jd, dtype=np.float64))
+        return Ephemeris(jd, self.latitude, self.lstAt(jd[0]))
+
+    def lstAt(self, jd):
+        '''
+        Local sidereal time, in radians, for any julian date.
+        '''
+        return np.mod(self._lst0 + 2.*np.pi*SIDEREAL_RATE*(np.asarray(jd, dtype=np.float64) - self._jd0),
+                      2.*np.pi)
+
+    def altitude(self, ra, dec, offset=0., slots=None):
+        '''
+        Altitude (in degrees) of every target on every time of the grid.
+
+        :param ra: Target right ascensions in radians.
+        :param dec: Target declinations in radians.
+        :param offset: Time offset, in seconds, to add to each grid time. Either a scalar or one value per target
+                       (e.g. block length).
+        :param slots: Optional index or mask selecting a subset of the time grid.
+        :return: Array with shape (ntimes, ntargets).
+        '''
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        lst = self.lst if slots is None else np.atleast_1d(self.lst[slots])
+
+        return altitudeGrid(lst, self.latitude, ra, dec, offset)
+
+    def airmass(self, ra, dec, offset=0., slots=None):
+        '''
+        Same as altitude but returning airmasses.
+        '''
+        return airmass(self.altitude(ra, dec, offset, slots))
+
+class MoonTable(object):
+    '''
+    Moon ephemeris for one night. Position, altitude and illumination are sampled on a regular grid with the remote
+    site and interpolated on lookup, so the slot loops and the condition checks never go back to the site for the
+    moon. Tables are cached on disk, next to the scheduler database, and in memory.
+    '''
+
+    # Most recently used last. Only the last few nights are kept in memory.
+    _tables = OrderedDict()
+    MAX_TABLES = 4
+
+    def __init__(self, jd, ra, dec, alt, illumination):
+        '''
+        :param jd: Time grid (julian dates).
+        :param ra: Moon right ascension in radians.
+        :param dec: Moon declination in radians.
+        :param alt: Moon altitude in degrees.
+        :param illumination: Illuminated fraction of the moon (0-1).
+        '''
+        self.jd = np.asarray(jd, dtype=np.float64)
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.alt = np.asarray(alt, dtype=np.float64)
+        self.illumination = np.asarray(illumination, dtype=np.float64)
+
+        # Unwrapped so interpolation does not go around the circle when RA crosses 0h.
+        self._ra = np.unwrap(self.ra)
+
+    @staticmethod
+    def fromSite(site, start, end, step=600.):
+        '''
+        Sample the moon ephemeris from the remote site.
+
+        :param start: Start of the night (julian date).
+        :param end: End of the night (julian date).
+        :param step: Grid step in seconds.
+        '''
+        jd = np.arange(start, end, step/86400.)
+        jd = np.append(jd, end)
+
+        ra = np.zeros_like(jd)
+        dec = np.zeros_like(jd)
+        alt = np.zeros_like(jd)
+        illumination = np.zeros_like(jd)
+
+        for i in range(len(jd)):
+            dateTime = datetimeFromJD(jd[i])
+            lst = site.LST_inRads(dateTime)
+            moonPos = site.moonpos(dateTime)
+            moonRaDec = site.altAzToRaDec(moonPos, lst)
+            ra[i] = float(moonRaDec.ra.R)
+            dec[i] = float(moonRaDec.dec.R)
+            alt[i] = float(moonPos.alt.D)
+            illumination[i] = float(site.moonphase(dateTime))
+
+        return MoonTable(jd, ra, dec, alt, illumination)
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        return MoonTable(data['jd'], data['ra'], data['dec'], data['alt'], data['illumination'])
+
+    def save(self, filename):
+        np.savez(filename, jd=self.jd, ra=self.ra, dec=self.dec, alt=self.alt, illumination=self.illumination)
+
+    @staticmethod
+    def cached(site, start, end, step=600., directory=None, keep=7.):
+        '''
+        Return the moon table for the night, building it with the site only if it is not already cached in memory
+        or on disk.
+
+        :param directory: Where to store the table. Defaults to the directory of the scheduler database.
+        :param keep: Tables older than this, in days, are removed from the directory when a new one is stored.
+        '''
+        if directory is None:
+            directory = os.path.dirname(DEFAULT_ROBOBS_DATABASE)
+
+        # The site is part of the key, a table built for another site configuration is not reused
+        filename = os.path.join(directory, 'moon_%+.4f_%+.4f_%.4f_%.4f_%i.npz' % (np.degrees(siteLatitude(site)),
+                                                                                  siteLongitude(site),
+                                                                                  start, end, step))
+
+        if filename in MoonTable._tables:
+            table = MoonTable._tables.pop(filename)
+            MoonTable._tables[filename] = table
+            return table
+
+        table = None
+        if os.path.exists(filename):
+            try:
+                table = MoonTable.load(filename)
+            except Exception:
+                table = None
+
+        if table is None:
+            table = MoonTable.fromSite(site, start, end, step)
+            MoonTable.prune(directory, keep)
+            try:
+                table.save(filename)
+            except IOError:
+                pass
+
+        MoonTable._tables[filename] = table
+        while len(MoonTable._tables) > MoonTable.MAX_TABLES:
+            MoonTable._tables.popitem(last=False)
+        return table
+
+    @staticmethod
+    def prune(directory, keep=7.):
+        '''
+        Remove the tables stored in directory more than keep days ago.
+        '''
+        limit = time.time() - keep*86400.
+        for filename in glob.glob(os.path.join(directory, 'moon_*.npz')):
+            try:
+                if os.path.getmtime(filename) < limit:
+                    os.remove(filename)
+            except OSError:
+                pass
+
+    def covers(self, jd):
+        return self.jd[0] <= jd <= self.jd[-1]
+
+    def raDec(self, jd):
+        '''
+        Interpolated moon right ascension and declination, in radians.
+        '''
+        return (np.mod(np.interp(jd, self.jd, self._ra), 2.*np.pi),
+                np.interp(jd, self.jd, self.dec))
+
+    def position(self, jd):
+        '''
+        Interpolated moon position, as a Position object, for a single julian date.
+        '''
+        ra, dec = self.raDec(jd)
+        return Position.fromRaDec(Coord.fromR(float(ra)), Coord.fromR(float(dec)))
+
+    def altitude(self, jd):
+        '''
+        Interpolated moon altitude in degrees.
+        '''
+        return np.interp(jd, self.jd, self.alt)
+
+    def separation(self, jd, ra, dec):
+        '''
+        Angular distance, in degrees, between the moon and every target on every time of jd.
+
+        :param ra: Target right ascensions in radians.
+        :param dec: Target declinations in radians.
+        :return: Array with shape (ntimes, ntargets).
+        '''
+        moonRa, moonDec = self.raDec(np.atleast_1d(jd))
+        return angularSeparation(moonRa[:, np.newaxis],
+                                 moonDec[:, np.newaxis],
+                                 np.atleast_1d(ra)[np.newaxis, :],
+                                 np.atleast_1d(dec)[np.newaxis, :])
+
+    def moonMask(self, jd, ra, dec, minDist, minBright=None, maxBright=None):
+        '''
+        Moon restrictions for every target on every time of jd. The brightness limits are only applied while the moon
+        is above the horizon.
+
+        :param minDist: Minimum moon distance (degrees), one per target.
+        :param minBright: Minimum moon brightness (percent), one per target.
+        :param maxBright: Maximum moon brightness (percent), one per target.
+        :return: Boolean array with shape (ntimes, ntargets). True where target satisfies the moon restrictions.
+        '''
+        jd = np.atleast_1d(jd)
+        moonRa, moonDec = self.raDec(jd)
+        return moonMaskGrid(moonRa, moonDec, self.brightness(jd), self.altitude(jd) < 0., ra, dec, minDist,
+                            minBright, maxBright)
+
+    def brightness(self, jd):
+        '''
+        Interpolated moon brightness in percent, same scale used for the block moon brightness limits.
+        '''
+        return np.interp(jd, self.jd, self.illumination)*100.
@@ -0,0 +1,102 @@
+
+'''
+Process pool shared by the scheduling algorithms.
+
+The (slots x targets) matrices used by the algorithms are split by target across worker processes. The executor is
+created once (e.g. per makeQueue run) and passed to the algorithms with the "executor" keyword, so the cost of
+starting the workers is paid only once.
+
+Tasks do not carry the Ephemeris and MoonTable objects. The sidereal time and the moon position and brightness are
+computed once, on the time grid, by the calling process and each task gets those arrays and its slice of the targets.
+'''
+
+import multiprocessing
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler.ephemeris import altitudeGrid, moonMaskGrid
+
+def _altitudeChunk(args):
+    return altitudeGrid(*args)
+
+def _moonMaskChunk(args):
+    return moonMaskGrid(*args)
+
+class SchedulerExecutor(object):
+    '''
+    Partition the target catalog across worker processes. With a single process everything runs in the calling
+    process, without a pool.
+    '''
+
+    def __init__(self, processes=None, chunksize=256):
+        '''
+        :param processes: Number of worker processes. Defaults to the number of cores.
+        :param chunksize: Minimum number of targets per task.
+        '''
+        if processes is None or processes < 1:
+            processes = multiprocessing.cpu_count()
+
+        self.processes = int(processes)
+        self.chunksize = int(chunksize)
+        self._pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def partition(self, ntargets):
+        '''
+        Split range(ntargets) in contiguous slices, at most one per process.
+        '''
+        nchunks = max(1, min(self.processes, int(np.ceil(float(ntargets)/self.chunksize))))
+        bounds = np.linspace(0, ntargets, nchunks+1).astype(int)
+        return [slice(bounds[i], bounds[i+1]) for i in range(nchunks)]
+
+    def _map(self, function, tasks):
+        if self._pool is None or len(tasks) == 1:
+            return [function(task) for task in tasks]
+        return self._pool.map(function, tasks)
+
+    def altitude(self, ephem, ra, dec, offset=0.):
+        '''
+        Same as Ephemeris.altitude, with targets distributed over the workers.
+        '''
+        ra = np.atleast_1d(ra)
+        dec = np.atleast_1d(dec)
+        offset = np.asarray(offset)
+
+        tasks = []
+        for chunk in self.partition(len(ra)):
+            tasks.append((ephem.lst, ephem.latitude, ra[chunk], dec[chunk],
+                          offset[chunk] if offset.ndim > 0 else offset))
+
+        return np.hstack(self._map(_altitudeChunk, tasks))
+
+    def moonMask(self, moon, jd, ra, dec, minDist, minBright=None, maxBright=None):
+        '''
+        Same as MoonTable.moonMask, with targets distributed over the workers.
+        '''
+        ra = np.atleast_1d(ra)
+        dec = np.atleast_1d(dec)
+        minDist = np.atleast_1d(minDist)
+
+        jd = np.atleast_1d(jd)
+        moonRa, moonDec = moon.raDec(jd)
+        brightness = moon.brightness(jd)
+        below = moon.altitude(jd) < 0.
+
+        tasks = []
+        for chunk in self.partition(len(ra)):
+            tasks.append((moonRa, moonDec, brightness, below, ra[chunk], dec[chunk], minDist[chunk],
+                          None if minBright is None else np.atleast_1d(minBright)[chunk],
+                          None if maxBright is None else np.atleast_1d(maxBright)[chunk]))
+
+        return np.hstack(self._map(_moonMaskChunk, tasks))
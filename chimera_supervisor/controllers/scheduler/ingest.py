@@ -0,0 +1,476 @@
+'''
+Bulk loading of targets and observing blocks into the robobs database.
+
+Catalogs are read in chunks, the coordinates of a whole chunk are parsed with numpy and each chunk is written with a
+single executemany, all in one transaction. Coordinates follow Position.fromRaDec: sexagesimal (with ':', ' ' or
+h/m/s, d/m/s separators) or decimal, RA in hours and Dec in degrees.
+
+Observing blocks refer to a yaml file with the actions to run. Each file is read once and turned into rows that are
+copied for every block using it.
+'''
+
+import csv
+import time
+
+import yaml
+import numpy as np
+from sqlalchemy import bindparam, select, func
+
+from chimera.util.position import Position
+from chimera.util.coord import Coord
+
+from chimera_supervisor.controllers.scheduler.model import Targets, ObsBlock, Action
+
+# Maximum number of values in an IN clause (SQLite limits the number of variables of a statement)
+MAX_IN = 500
+
+# Column of the input file (lower case) -> Targets attribute and default
+TARGET_COLUMNS = [('name', 'name', 'Program'),
+                  ('type', 'type', 'OBJECT'),
+                  ('mag', 'targetMag', 0.0),
+                  ('epoch', 'targetEpoch', 2000.),
+                  ('magfilter', 'magFilter', None),
+                  ('link', 'link', None)]
+
+# Precision used to compare coordinates on upsert (hours and degrees, well below an arcsecond)
+KEY_DECIMALS = 7
+
+def toFloat(values, empty=np.nan):
+    '''
+    Convert an array of strings to float. Invalid entries are NaN, blank ones are set to empty.
+    '''
+    values = np.char.strip(np.asarray(values, dtype=str))
+    result = np.zeros(len(values)) + np.nan
+    blank = values == ''
+    result[blank] = empty
+    try:
+        result[~blank] = values[~blank].astype(np.float64)
+    except ValueError:
+        # Only chunks with invalid entries go through here
+        for i in np.where(~blank)[0]:
+            try:
+                result[i] = float(values[i])
+            except ValueError:
+                pass
+    return result
+
+def parseSexagesimal(values):
+    '''
+    Parse an array of sexagesimal (or decimal) strings.
+
+    :return: Array of values in the unit of the first field and a mask of the entries that could be parsed.
+    '''
+    values = np.char.strip(np.char.lower(np.asarray(values, dtype=str)))
+    for separator in ('h', 'd', 'm', 's', "'", '"', ' '):
+        values = np.char.replace(values, separator, ':')
+    while np.any(np.char.count(values, '::') > 0):
+        values = np.char.replace(values, '::', ':')
+    values = np.char.strip(values, ':')
+
+    negative = np.char.startswith(values, '-')
+    values = np.char.lstrip(values, '+-')
+
+    parts = np.char.partition(values, ':')
+    first, rest = parts[:, 0], parts[:, 2]
+    parts = np.char.partition(rest, ':')
+    second, third = parts[:, 0], parts[:, 2]
+
+    first = toFloat(first)
+    second = toFloat(second, 0.)
+    third = toFloat(third, 0.)
+
+    valid = (np.isfinite(first) & np.isfinite(second) & np.isfinite(third) &
+             (second >= 0.) & (second < 60.) & (third >= 0.) & (third < 60.))
+    result = first + second/60. + third/3600.
+    result[negative] *= -1.
+
+    return result, valid
+
+def parseRaDec(ra, dec):
+    '''
+    Parse arrays of RA and Dec strings.
+
+    :return: RA (hours), Dec (degrees) and a mask of the valid coordinates.
+    '''
+    ra, valid_ra = parseSexagesimal(ra)
+    dec, valid_dec = parseSexagesimal(dec)
+
+    with np.errstate(invalid='ignore'):
+        valid = valid_ra & valid_dec & (ra >= 0.) & (ra < 24.) & (dec >= -90.) & (dec <= 90.)
+
+    return ra, dec, valid
+
+def readChunks(filename, chunksize=10000):
+    '''
+    Read a CSV file (with header) in chunks.
+
+    :return: Generator of (line number of the first row, dict of lower case column name -> array of strings).
+    '''
+    with open(filename) as fp:
+        reader = csv.reader(fp)
+        header = [name.strip().lower() for name in reader.next()]
+        line = 2
+        rows = []
+        for row in reader:
+            if len(row) == 0:
+                continue
+            rows.append(row)
+            if len(rows) == chunksize:
+                yield line, _columns(header, rows)
+                line += len(rows)
+                rows = []
+        if len(rows) > 0:
+            yield line, _columns(header, rows)
+
+def _columns(header, rows):
+    ncol = len(header)
+    rows = [(row + ['']*ncol)[:ncol] for row in rows]
+    return dict(zip(header, np.array(rows, dtype=str).T))
+
+class TargetIngest(object):
+    '''
+    Write chunks of targets to the database, in the transaction of the given session.
+    '''
+
+    def __init__(self, session, upsert=False):
+        '''
+        :param session: Session used to write the targets. Commit it when done.
+        :param upsert: If True, targets already in the database with the same name and coordinates are updated
+                       instead of added again.
+        '''
+        self.session = session
+        self.upsert = upsert
+
+        self.inserted = 0
+        self.updated = 0
+        self.invalid = 0
+        self.duplicated = 0
+        self.elapsed = 0.
+
+        self._existing = {}
+        if upsert:
+            for tid, name, ra, dec in session.query(Targets.id, Targets.name, Targets.targetRa, Targets.targetDec):
+                self._existing[self.key(name, ra, dec)] = tid
+
+    @staticmethod
+    def key(name, ra, dec):
+        return name, round(ra, KEY_DECIMALS), round(dec, KEY_DECIMALS)
+
+    def add(self, columns):
+        '''
+        Add a chunk of targets.
+
+        :param columns: dict of lower case column name -> array of strings. Must have ra and dec.
+        :return: Indexes of the rows with invalid coordinates.
+        '''
+        start = time.time()
+
+        ra, dec, valid = parseRaDec(columns['ra'], columns['dec'])
+
+        values = {}
+        for column, attribute, default in TARGET_COLUMNS:
+            if column not in columns:
+                values[attribute] = [default]*len(ra)
+            elif isinstance(default, float):
+                value = toFloat(columns[column], default)
+                values[attribute] = np.where(np.isfinite(value), value, default).tolist()
+            else:
+                values[attribute] = [value if value != '' else default for value in columns[column].tolist()]
+
+        inserts = []
+        updates = []
+        for i in np.where(valid)[0]:
+            row = dict([(attribute, values[attribute][i]) for column, attribute, default in TARGET_COLUMNS])
+            row['targetRa'] = float(ra[i])
+            row['targetDec'] = float(dec[i])
+
+            if self.upsert:
+                key = self.key(row['name'], row['targetRa'], row['targetDec'])
+                tid = self._existing.get(key)
+                if tid is not None:
+                    row['_id'] = tid
+                    updates.append(row)
+                    continue
+                elif key in self._existing:
+                    # Same target twice in the input
+                    self.duplicated += 1
+                    continue
+                self._existing[key] = None
+            inserts.append(row)
+
+        if len(inserts) > 0:
+            self.session.execute(Targets.__table__.insert(), inserts)
+        if len(updates) > 0:
+            table = Targets.__table__
+            self.session.execute(table.update().where(table.c.id == bindparam('_id')),
+                                 updates)
+
+        self.inserted += len(inserts)
+        self.updated += len(updates)
+        self.invalid += int(np.sum(~valid))
+        self.elapsed += time.time()-start
+
+        return np.where(~valid)[0]
+
+    def throughput(self):
+        '''
+        Targets written per second.
+        '''
+        return (self.inserted + self.updated)/self.elapsed if self.elapsed > 0. else 0.
+
+def readBlocks(filename, chunksize=10000):
+    '''
+    Read an observing block file in chunks. Each line has: project id, block id, target id, action file, block
+    parameters id.
+
+    :return: Generator of lists of (pid, blockid, objid, action file, bparid).
+    '''
+    with open(filename) as fp:
+        blocks = []
+        for line in fp:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            blocks.append((fields[0], int(fields[1]), int(fields[2]), fields[3], int(fields[4])))
+            if len(blocks) == chunksize:
+                yield blocks
+                blocks = []
+        if len(blocks) > 0:
+            yield blocks
+
+def parseOffset(value):
+    '''
+    Offset given in arcseconds or as a DMS string.
+    '''
+    try:
+        offset = Coord.fromAS(int(value))
+    except ValueError:
+        offset = Coord.fromDMS(value)
+
+    return offset
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), MAX_IN):
+        yield values[i:i+MAX_IN]
+
+def _default(column):
+    if column.default is not None and column.default.is_scalar:
+        return column.default.arg
+    return None
+
+class BlockIngest(object):
+    '''
+    Write observing blocks, and their actions, in the transaction of the given session.
+
+    A block that is already in the database (same project, block and target ids) is replaced, unless it was observed,
+    in which case it is left as is.
+    '''
+
+    def __init__(self, session, actions):
+        '''
+        :param session: Session used to write the blocks. Commit it when done.
+        :param actions: dict of action name (as used in the yaml files) -> Action class.
+        '''
+        self.session = session
+        self.actions = actions
+
+        self.added = 0
+        self.replaced = 0
+        self.observed = 0
+        self.elapsed = 0.
+
+        self.templates = {}
+        self._positions = {}
+        self._existing = {}
+        self._projects = set()
+        self._nextBlock = None
+        self._nextAction = None
+
+        self._slew = self._compile(dict(action='point'), False)
+
+    def template(self, filename):
+        '''
+        Pre and pos slew actions of an action file, each as (class, row, formatted attributes, point to target,
+        length). The file is only read the first time.
+        '''
+        if filename not in self.templates:
+            with open(filename) as fp:
+                config = yaml.load(fp)
+            self.templates[filename] = ([self._compile(actconfig, False)
+                                          for actconfig in config.get('pre-actions') or []],
+                                         [self._compile(actconfig, True)
+                                          for actconfig in config.get('pos-actions') or []])
+        return self.templates[filename]
+
+    def _compile(self, actconfig, pos):
+        cls = self.actions[actconfig['action']]
+        table = cls.__table__
+
+        row = dict([(column.name, _default(column)) for column in table.columns if column.name != 'id'])
+        formatted = {}
+        target = False
+        length = 0.
+
+        if actconfig['action'] == 'point':
+            if 'ra' in actconfig and 'dec' in actconfig:
+                epoch = 'J2000' if 'epoch' not in actconfig else actconfig['epoch']
+                row['targetRaDec'] = Position.fromRaDec(actconfig['ra'], actconfig['dec'], epoch)
+            elif 'alt' in actconfig and 'az' in actconfig:
+                row['targetAltAz'] = Position.fromAltAz(actconfig['alt'], actconfig['az'])
+            elif 'name' in actconfig:
+                row['targetName'] = actconfig['name']
+            elif not pos or 'offset' not in actconfig:
+                target = True
+
+            if pos and 'offset' in actconfig:
+                offset = actconfig['offset']
+                if 'north' in offset:
+                    row['offsetNS'] = parseOffset(offset['north'])
+                elif 'south' in offset:
+                    row['offsetNS'] = Coord.fromAS(-parseOffset(offset['south']).AS)
+
+                if 'west' in offset:
+                    row['offsetEW'] = parseOffset(offset['west'])
+                elif 'east' in offset:
+                    row['offsetEW'] = Coord.fromAS(-parseOffset(offset['east']).AS)
+        else:
+            for key, value in actconfig.items():
+                if key in row and key != 'action':
+                    if type(value) == str and '{' in value:
+                        # Filled in with the target and block of each row
+                        formatted[key] = value
+                    else:
+                        row[key] = value
+
+            if pos:
+                if table.name == 'action_expose':
+                    length = (row['exptime']+12.)*row['frames'] # FIXME: read-out-time hard coded
+                elif table.name == 'action_focus' and row['step'] > 0:
+                    length = 600. # FIXME: focus hard coded
+
+        return cls, row, formatted, target, length
+
+    def _targets(self, ids):
+        targets = {}
+        table = Targets.__table__
+        for chunk in _chunks(ids):
+            for row in self.session.execute(select([table]).where(table.c.id.in_(chunk))):
+                targets[row['id']] = dict(row.items())
+        return targets
+
+    def _position(self, target):
+        if target['id'] not in self._positions:
+            self._positions[target['id']] = Position.fromRaDec(target['targetRa'], target['targetDec'], 'J2000')
+        return self._positions[target['id']]
+
+    def _loadExisting(self, pids):
+        # One query per project, the first time it shows up
+        pids = [pid for pid in pids if pid not in self._projects]
+        if len(pids) == 0:
+            return
+        table = ObsBlock.__table__
+        query = select([table.c.id, table.c.pid, table.c.blockid, table.c.objid,
+                        table.c.observed]).where(table.c.pid.in_(pids))
+        for row in self.session.execute(query):
+            self._existing.setdefault((row['pid'], row['blockid'], row['objid']), []).append((row['id'],
+                                                                                             row['observed']))
+        self._projects.update(pids)
+
+    def _delete(self, ids):
+        obsblock = ObsBlock.__table__
+        action = Action.__table__
+        for chunk in _chunks(ids):
+            actions = select([action.c.id]).where(action.c.block_id.in_(chunk))
+            for cls in set(self.actions.values()):
+                self.session.execute(cls.__table__.delete().where(cls.__table__.c.id.in_(actions)))
+            self.session.execute(action.delete().where(action.c.block_id.in_(chunk)))
+            self.session.execute(obsblock.delete().where(obsblock.c.id.in_(chunk)))
+
+    def add(self, blocks):
+        '''
+        Add a chunk of observing blocks.
+
+        :param blocks: list of (pid, blockid, objid, action file, bparid).
+        :return: Blocks whose target is not in the database. If any, nothing is written.
+        '''
+        start = time.time()
+
+        targets = self._targets(set([block[2] for block in blocks]))
+        missing = [block for block in blocks if block[2] not in targets]
+        if len(missing) > 0:
+            return missing
+
+        self._loadExisting(set([block[0] for block in blocks]))
+
+        # Last entry wins if a block is given more than once
+        write = {}
+        delete = []
+        for block in blocks:
+            key = tuple(block[:3])
+            current = self._existing.get(key, [])
+            if True in [observed for id, observed in current]:
+                self.observed += 1
+                continue
+            delete.extend([id for id, observed in current])
+            self._existing[key] = []
+            if key not in write and len(current) > 0:
+                self.replaced += 1
+            elif key not in write:
+                self.added += 1
+            write[key] = block
+
+        self._delete(delete)
+
+        if self._nextBlock is None:
+            self._nextBlock = (self.session.execute(select([func.max(ObsBlock.__table__.c.id)])).scalar() or 0) + 1
+            self._nextAction = (self.session.execute(select([func.max(Action.__table__.c.id)])).scalar() or 0) + 1
+
+        blockRows = []
+        actionRows = []
+        subRows = {}
+        for key, (pid, blockid, objid, filename, bparid) in write.items():
+            target = targets[objid]
+            pre, pos = self.template(filename)
+
+            fmt = dict(target)
+            fmt.update(objid=objid, blockid=blockid, pid=pid, bparid=bparid)
+
+            bid = self._nextBlock
+            self._nextBlock += 1
+
+            length = 0.
+            for cls, row, formatted, pointTarget, actionLength in pre + [self._slew] + pos:
+                aid = self._nextAction
+                self._nextAction += 1
+
+                actionRows.append(dict(id=aid, block_id=bid, type=cls.__mapper_args__['polymorphic_identity']))
+
+                row = dict(row, id=aid)
+                for attribute, value in formatted.items():
+                    row[attribute] = value.format(**fmt)
+                if pointTarget:
+                    row['targetRaDec'] = self._position(target)
+                subRows.setdefault(cls.__table__, []).append(row)
+
+                length += actionLength
+
+            blockRows.append(dict(id=bid, objid=objid, blockid=blockid, pid=pid, bparid=bparid, observed=False,
+                                  completed=False, scheduled=False, lastObservation=None, length=length))
+            self._existing[key] = [(bid, False)]
+
+        if len(blockRows) > 0:
+            self.session.execute(ObsBlock.__table__.insert(), blockRows)
+            self.session.execute(Action.__table__.insert(), actionRows)
+            for table, rows in subRows.items():
+                self.session.execute(table.insert(), rows)
+
+        self.elapsed += time.time()-start
+
+        return []
+
+    def throughput(self):
+        '''
+        Blocks written per second.
+        '''
+        return (self.added + self.replaced)/self.elapsed if self.elapsed > 0. else 0.
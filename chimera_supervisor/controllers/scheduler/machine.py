@@ -14,32 +14,74 @@ import time
 # log = logging.getLogger(__name__.replace('chimera_manager','chimera.robobs'))
 
 class Machine(threading.Thread):
-
-    __state = None
-    __stateLock = threading.Lock()
-    __wakeUpCall = threading.Condition()
-
-    def __init__(self, controller):
+    '''
+    RobObs state machine. It never polls: every state blocks until the state changes, either by a RobObs request
+    (wake, shutdown) or by the scheduler stateChanged events, forwarded with schedulerStateChanged.
+
+     - OFF/IDLE: wait for a wake up call (START).
+     - START: start the scheduler and go BUSY.
+     - BUSY: the scheduler runs the programs RobObs added. Waits for the scheduler to empty its queue (OFF) and goes
+             IDLE, so RobObs can reshedule and wake the machine again.
+     - SHUTDOWN: ends the thread.
+    '''
+
+    def __init__(self, controller, busy_timeout=300.):
+        '''
+        :param controller: RobObs.
+        :param busy_timeout: Time, in seconds, after which a BUSY machine asks the scheduler for its state, in case a
+                             stateChanged event was lost.
+        '''
         threading.Thread.__init__(self)
 
         self.controller = controller
+        self.busy_timeout = busy_timeout
 
         self.currentProgram = None
 
+        self.__state = None
+        self.__wakeUpCall = threading.Condition()
+
+        # Time spent in each state and number of times the loop ran in it
+        self.__stateSince = time.time()
+        self.__stateTimes = {}
+        self.__stateWakeups = {}
+
         self.setDaemon(False)
 
     def state(self, state=None):
         log = self.controller.getLogger()
-        self.__stateLock.acquire()
-        try:
+        with self.__wakeUpCall:
             if not state: return self.__state
             if state == self.__state: return
             # self.controller.stateChanged(state, self.__state)
             log.debug("Changing state, from %s to %s." % (self.__state, state))
+            now = time.time()
+            if self.__state is not None:
+                key = str(self.__state)
+                self.__stateTimes[key] = self.__stateTimes.get(key, 0.) + now - self.__stateSince
+            self.__stateSince = now
             self.__state = state
-            self.wakeup()
-        finally:
-            self.__stateLock.release()
+            self.__wakeUpCall.notifyAll()
+
+    def schedulerStateChanged(self, newState, oldState):
+        '''
+        Scheduler stateChanged event. The scheduler going OFF means its queue is done.
+        '''
+        with self.__wakeUpCall:
+            if newState == State.OFF and self.__state == State.BUSY:
+                self.state(State.IDLE)
+
+    def stats(self):
+        '''
+        Time, in seconds, spent in each state and number of times the machine woke up in it.
+        '''
+        with self.__wakeUpCall:
+            times = dict(self.__stateTimes)
+            if self.__state is not None:
+                key = str(self.__state)
+                times[key] = times.get(key, 0.) + time.time() - self.__stateSince
+            return dict([(key, {'time': times.get(key, 0.), 'wakeups': self.__stateWakeups.get(key, 0)})
+                         for key in set(times.keys()) | set(self.__stateWakeups.keys())])
 
     def run(self):
         log = self.controller.getLogger()
@@ -48,38 +90,81 @@ class Machine(threading.Thread):
 
         self.state(State.OFF)
 
-        while self.state() != State.SHUTDOWN:
+        while True:
+
+            state = self.state()
+            with self.__wakeUpCall:
+                self.__stateWakeups[str(state)] = self.__stateWakeups.get(str(state), 0) + 1
 
-            if self.state() == State.OFF:
+            if state == State.OFF:
                 log.debug("[off] will just sleep..")
-                self.sleep()
+                self.sleep(state)
 
-            elif self.state() == State.START:
-                log.debug("[start] waking scheduler...")
-                # for i in range(10):
-                #     log.debug('Waiting %i...' % i)
-                #     time.sleep(1)
+            elif state == State.IDLE:
+                log.debug("[idle] waiting for wake-up call..")
+                self.sleep(state)
 
+            elif state == State.START:
+                log.debug("[start] waking scheduler...")
                 sched.start()
                 self.state(State.BUSY)
 
-            elif self.state() == State.SHUTDOWN:
+            elif state == State.BUSY:
+                log.debug("[busy] waiting for the scheduler to finish..")
+                if not self.sleep(state, self.busy_timeout):
+                    self._checkScheduler(sched)
+
+            elif state == State.SHUTDOWN:
                 log.debug("[shutdown] should die soon.")
                 break
 
+            else:
+                log.warning("Unexpected state %s, going idle." % state)
+                self.state(State.IDLE)
+
         log.debug('[shutdown] thread ending...')
+        log.debug('[shutdown] time in each state: %s' % ', '.join(['%s %.1f s (%i wakeups)' % (key, value['time'],
+                                                                                               value['wakeups'])
+                                                                  for key, value in self.stats().items()]))
 
-    def sleep(self):
+    def _checkScheduler(self, sched):
+        # No stateChanged event for a while, make sure the scheduler is still running
         log = self.controller.getLogger()
-        self.__wakeUpCall.acquire()
-        log.debug("Sleeping")
-        self.__wakeUpCall.wait()
-        self.__wakeUpCall.release()
+        try:
+            schedState = sched.state()
+        except Exception, e:
+            log.exception(e)
+            return
+        log.debug("[busy] scheduler state is %s." % schedState)
+        if schedState == State.OFF:
+            log.warning("[busy] scheduler is off but no event was received, going idle.")
+            self.schedulerStateChanged(State.OFF, None)
+
+    def sleep(self, state=None, timeout=None):
+        '''
+        Wait until the state changes from state (any wake up call if state is None).
+
+        :return: False if it timed out.
+        '''
+        log = self.controller.getLogger()
+        with self.__wakeUpCall:
+            log.debug("Sleeping")
+            if state is None:
+                self.__wakeUpCall.wait(timeout)
+                return True
+            deadline = time.time() + timeout if timeout is not None else None
+            while self.__state == state:
+                if deadline is None:
+                    self.__wakeUpCall.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0.:
+                        return False
+                    self.__wakeUpCall.wait(remaining)
+            return True
 
     def wakeup(self):
         log = self.controller.getLogger()
-        self.__wakeUpCall.acquire()
-        log.debug("Waking up")
-        self.__wakeUpCall.notifyAll()
-        self.__wakeUpCall.release()
-
+        with self.__wakeUpCall:
+            log.debug("Waking up")
+            self.__wakeUpCall.notifyAll()
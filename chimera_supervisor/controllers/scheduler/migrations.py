@@ -0,0 +1,71 @@
+'''
+Schema migrations of the robobs scheduler database.
+
+metaData.create_all only creates missing tables, so changes to existing tables (like new indexes) are applied here. The
+schema version is kept in the SQLite user_version pragma, each migration runs once, in order, and bumps it.
+'''
+
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+def _quote(name):
+    return '"%s"' % name
+
+def createIndexes(connection, metaData):
+    '''
+    Create the indexes declared in the model that do not exist yet.
+    '''
+    for table in metaData.sorted_tables:
+        for index in table.indexes:
+            connection.execute('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)' % ('UNIQUE ' if index.unique else '',
+                                                                               _quote(index.name),
+                                                                               _quote(table.name),
+                                                                               ', '.join([_quote(column.name) for column
+                                                                                          in index.columns])))
+    # Give the query planner statistics for the new indexes
+    connection.execute('ANALYZE')
+
+def dropIndexes(connection, metaData):
+    '''
+    Drop the indexes declared in the model. Used by the benchmark to measure the schema before the indexes.
+    '''
+    for table in metaData.sorted_tables:
+        for index in table.indexes:
+            connection.execute('DROP INDEX IF EXISTS %s' % _quote(index.name))
+
+# (version, description, function(connection, metaData))
+MIGRATIONS = [(1, 'indexes on the scheduler query paths', createIndexes),
+              ]
+
+def schemaVersion(connection):
+    return connection.execute('PRAGMA user_version').scalar()
+
+def migrate(engine, metaData):
+    '''
+    Apply the pending migrations.
+
+    :return: Schema version after the migrations.
+    '''
+    connection = engine.connect()
+    try:
+        version = schemaVersion(connection)
+        for mversion, description, function in MIGRATIONS:
+            if mversion <= version:
+                continue
+            log.info('Migrating robobs database to version %i: %s' % (mversion, description))
+            start = time.time()
+            function(connection, metaData)
+            connection.execute('PRAGMA user_version = %i' % mversion)
+            version = mversion
+            log.debug('Migration %i took %.3f s' % (mversion, time.time()-start))
+        return version
+    finally:
+        connection.close()
+
+def queryPlan(connection, query, *params):
+    '''
+    Plan SQLite chooses for a query, one line per step.
+    '''
+    return [str(row[-1]) for row in connection.execute('EXPLAIN QUERY PLAN ' + query, *params)]
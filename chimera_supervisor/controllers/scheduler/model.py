@@ -1,9 +1,10 @@
 from chimera_supervisor.core.constants import DEFAULT_ROBOBS_DATABASE
+from chimera_supervisor.core.database import Database
 
 from sqlalchemy import (Column, String, Integer, DateTime, Boolean, ForeignKey,
-                        Float, PickleType, MetaData, Text, create_engine)
+                        Float, PickleType, Text, Index)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relation, backref
+from sqlalchemy.orm import relation, backref
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from chimera.controllers.scheduler.model import (Program as CProgram,
@@ -16,18 +17,20 @@ from chimera.util.position import Position
 
 import logging as log
 
-engine = create_engine('sqlite:///%s' % DEFAULT_ROBOBS_DATABASE, echo=False)
-# log.debug('-- engine created with sqlite:///%s' % DEFAULT_PROGRAM_DATABASE)
-metaData = MetaData()
-metaData.bind = engine
+database = Database('robobs', DEFAULT_ROBOBS_DATABASE)
 
-Session = sessionmaker(bind=engine)
+engine = database.engine
+metaData = database.metaData
+
+Session = database.Session
+ScopedSession = database.ScopedSession
 Base = declarative_base(metadata=metaData)
 
 import datetime as dt
 
 class ExtMoniDB(Base):
     __tablename__ = 'extmonidb'
+    __table_args__ = (Index('ix_extmonidb_pid_tid', 'pid', 'tid'),)
 
     id = Column(Integer, primary_key=True)
 
@@ -66,6 +69,7 @@ class ObservedAM(Base):
 
 class TimedDB(Base):
     __tablename__ = 'timeddb'
+    __table_args__ = (Index('ix_timeddb_pid_finished_execute_at', 'pid', 'finished', 'execute_at'),)
 
     id = Column(Integer, primary_key=True)
 
@@ -94,6 +98,7 @@ class TimedDB(Base):
 
 class RecurrentDB(Base):
     __tablename__ = 'recurrent'
+    __table_args__ = (Index('ix_recurrent_pid_blockid_tid', 'pid', 'blockid', 'tid'),)
 
     id = Column(Integer, primary_key=True)
 
@@ -150,6 +155,7 @@ class Targets(Base):
 
 class BlockPar(Base):
     __tablename__ = "blockpar"
+    __table_args__ = (Index('ix_blockpar_pid_bid', 'pid', 'bid'),)
     id = Column(Integer, primary_key=True)
     bid = Column(Integer)
     pid = Column(String, default='')
@@ -172,6 +178,9 @@ class BlockPar(Base):
 
 class ObsBlock(Base):
     __tablename__ = "obsblock"
+    __table_args__ = (Index('ix_obsblock_pid_blockid_objid', 'pid', 'blockid', 'objid'),
+                      Index('ix_obsblock_objid', 'objid'),
+                      Index('ix_obsblock_pid_scheduled_completed', 'pid', 'scheduled', 'completed'))
     id = Column(Integer, primary_key=True)
     objid = Column(Integer, ForeignKey("targets.id"))
     blockid = Column(Integer)
@@ -220,6 +229,12 @@ class Projects(Base):
 
 class Program(Base):
     __tablename__ = "program"
+    # finished/priority/slewAt is the queue order (see RobObs.loadPrograms and getProgram).
+    __table_args__ = (Index('ix_program_finished_priority_slewat', 'finished', 'priority', 'slewAt'),
+                      Index('ix_program_priority', 'priority'),
+                      Index('ix_program_slewat', 'slewAt'),
+                      Index('ix_program_pid', 'pid'),
+                      Index('ix_program_obsblock_id', 'obsblock_id'))
     print "model.py"
 
     id = Column(Integer, primary_key=True)
@@ -272,6 +287,8 @@ class Program(Base):
 
 class ObservingLog(Base):
     __tablename__ = "observinglog"
+    __table_args__ = (Index('ix_observinglog_time', 'time'),
+                      Index('ix_observinglog_tid_time', 'tid', 'time'))
 
     id = Column(Integer, primary_key=True)
     time = Column(DateTime, default=dt.datetime.today())
@@ -461,3 +478,7 @@ class Expose(Action):
 #metaData.drop_all(engine)
 metaData.create_all(engine)
 
+# create_all does not touch tables that already exist, bring older databases up to date.
+from chimera_supervisor.controllers.scheduler.migrations import migrate
+migrate(engine, metaData)
+
@@ -0,0 +1,219 @@
+'''
+RobObs planner worker.
+
+Resheduling used to run inside the scheduler stateChanged callback, so it blocked the Pyro event thread (and every
+other event delivered to RobObs) while programs were selected and converted, and for 5 minutes when the queue was
+empty. The Planner does that work in its own thread:
+
+ - When the scheduler runs out of programs, RobObs asks the planner for a hand over and returns right away.
+ - Once a program is handed over, the planner selects the program to run after it (look-ahead), for the time the
+   current one is expected to end, while the telescope is busy observing.
+ - On the next hand over the look-ahead program is used if it is still valid, so the scheduler gets it without waiting
+   for a reshedule. Otherwise (it was observed meanwhile, programs were added to or removed from the queue, a program
+   with higher priority is due, the current program ended much earlier or later than expected or its conditions do
+   not hold anymore) a regular reshedule is done.
+
+The look-ahead is a dry run of reshedule: nothing it finds for the hypothetical time is stored in the database. On a
+hit the program is loaded again, so it is handed over as stored and not with the values of the dry run.
+'''
+
+import threading
+import time
+import logging
+
+from sqlalchemy import func
+
+from chimera_supervisor.controllers.scheduler.model import Session as RSession
+from chimera_supervisor.controllers.scheduler.model import Program
+
+def _queueState(session):
+    # Number of unfinished programs and highest program id, changes whenever programs are added or removed
+    return tuple(session.query(func.count(Program.id), func.max(Program.id)).filter(Program.finished == False).one())
+
+class Planner(threading.Thread):
+    '''
+    Worker thread that selects the programs of RobObs and adds them to the scheduler queue.
+    '''
+
+    def __init__(self, controller, lookahead=True, tolerance=600., retry=300.):
+        '''
+        :param controller: RobObs.
+        :param lookahead: Select the next program while the current one executes.
+        :param tolerance: Maximum difference, in seconds, between the time a look-ahead program was selected for and
+                          the time it is handed over.
+        :param retry: Time, in seconds, to wait before resheduling again when there is nothing to observe.
+        '''
+        threading.Thread.__init__(self, name='RobObsPlanner')
+
+        self.controller = controller
+        self.lookahead = lookahead
+        self.tolerance = tolerance
+        self.retry = retry
+
+        self._cond = threading.Condition()
+        self._requested = None
+        self._stop = False
+        self._next = None
+
+        self._stats = {'handovers': 0, 'lookaheadHits': 0, 'lookaheadMisses': 0, 'empty': 0, 'deadTime': 0.,
+                       'maxDeadTime': 0.}
+
+        self.setDaemon(True)
+
+    @property
+    def log(self):
+        return self.controller.getLogger() or logging.getLogger(__name__)
+
+    def handOver(self):
+        '''
+        Ask for the next program. Returns immediately, the program is added to the scheduler queue by the planner
+        thread.
+        '''
+        with self._cond:
+            if self._requested is None:
+                self._requested = time.time()
+            self._cond.notifyAll()
+
+    def invalidate(self):
+        '''
+        Drop the look-ahead program (e.g. RobObs was stopped or the queue changed).
+        '''
+        with self._cond:
+            self._next = None
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notifyAll()
+
+    def stats(self):
+        '''
+        Number of hand overs, look-ahead hits and misses, hand overs with nothing to observe and the mean and maximum
+        time, in seconds, between the hand over request and the program being queued.
+        '''
+        with self._cond:
+            stats = dict(self._stats)
+        served = stats['handovers'] - stats['empty']
+        stats['meanDeadTime'] = stats['deadTime']/served if served > 0 else 0.
+        return stats
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._requested is None and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    break
+                requested = self._requested
+                self._requested = None
+
+            try:
+                self._serve(requested)
+            except Exception, e:
+                self.log.exception(e)
+
+        self.log.debug('[planner] thread ending...')
+
+    def _serve(self, requested):
+        controller = self.controller
+        nowmjd = controller.getSite().MJD()
+
+        program_info = self._takeLookAhead(nowmjd)
+        if program_info is None:
+            program_info = controller.reshedule(nowmjd)
+
+        with self._cond:
+            self._stats['handovers'] += 1
+
+        if program_info is None:
+            with self._cond:
+                self._stats['empty'] += 1
+            if controller.parkIfIdle():
+                controller.wake()
+            else:
+                self.log.warning("No program on robobs queue, waiting for %.0f s." % self.retry)
+                with self._cond:
+                    if self._requested is None and not self._stop:
+                        self._cond.wait(self.retry)
+                if controller.isOn():
+                    self.handOver()
+            return
+
+        controller.submit(program_info)
+        controller.wake()
+
+        deadTime = time.time() - requested
+        with self._cond:
+            self._stats['deadTime'] += deadTime
+            self._stats['maxDeadTime'] = max(self._stats['maxDeadTime'], deadTime)
+        self.log.debug('[planner] program handed over in %.3f s.' % deadTime)
+
+        if self.lookahead:
+            self._lookAhead(program_info, max(nowmjd, program_info[0].slewAt or nowmjd))
+
+    def _lookAhead(self, current, start):
+        # Next program, for when the current one is expected to end
+        end = start + self.controller.programLength(current)/86400.
+        self.log.debug('[planner] looking ahead for a program @ %.4f' % end)
+
+        session = RSession()
+        try:
+            state = _queueState(session)
+        finally:
+            session.commit()
+
+        program_info = self.controller.reshedule(end, dryRun=True)
+        with self._cond:
+            self._next = (program_info, end, state) if program_info is not None else None
+
+    def _takeLookAhead(self, nowmjd):
+        with self._cond:
+            ahead = self._next
+            self._next = None
+
+        if ahead is None:
+            return None
+
+        program_info, plannedFor, state = ahead
+
+        if abs(nowmjd - plannedFor)*86400. > self.tolerance:
+            self.log.debug('[planner] look-ahead planned for %.4f, now is %.4f. Resheduling.' % (plannedFor, nowmjd))
+            return self._miss()
+
+        # The dry run objects may hold values that were never stored (like an earlier slewAt), submit the program as
+        # it is in the database.
+        program_info = self.controller.loadProgram(program_info[0].id)
+        if program_info is None:
+            self.log.debug('[planner] look-ahead program no longer in the queue. Resheduling.')
+            return self._miss()
+
+        session = RSession()
+        try:
+            changed = _queueState(session) != state
+            # Programs with higher priority (lower value) that came due after the time the look-ahead was done for
+            due = session.query(func.count(Program.id)).filter(Program.finished == False,
+                                                               Program.priority < program_info[0].priority,
+                                                               Program.slewAt > plannedFor,
+                                                               Program.slewAt <= nowmjd).scalar()
+        finally:
+            session.commit()
+        if changed:
+            self.log.debug('[planner] queue changed since the look-ahead. Resheduling.')
+            return self._miss()
+        if due > 0:
+            self.log.debug('[planner] %i program(s) with higher priority are due. Resheduling.' % due)
+            return self._miss()
+
+        checktime = max(nowmjd, program_info[0].slewAt or nowmjd)
+        if not self.controller.checkConditions(program_info, checktime, self.controller.programLength(program_info)):
+            self.log.debug('[planner] look-ahead program can not be observed now. Resheduling.')
+            return self._miss()
+
+        with self._cond:
+            self._stats['lookaheadHits'] += 1
+        return program_info
+
+    def _miss(self):
+        with self._cond:
+            self._stats['lookaheadMisses'] += 1
+        return None
@@ -0,0 +1,338 @@
+'''
+Monte Carlo simulation of an observing season.
+
+The input is the robobs queue, as built by makeQueue (or updateQueue) for one night. Blocks of the projects that are
+not in the queue are not simulated, so a season is a replay of the programs of that queue over consecutive nights,
+not of the whole project.
+
+Every night the queue is scheduled again, as makeQueue would do for that night: the unfinished programs go through the
+process of their algorithm with the night start, end and moon, and get the slew time of the slot they were given.
+Programs that get no slot are left out of the night. Each night is then simulated with NightSimulator, so programs
+observed on one night are not available on the next. Weather closures are drawn from a WeatherModel and each
+realization of the weather is an independent season, so realizations run in parallel in a process pool. The results
+are aggregated per project: completion rate, visit cadence of the recurrent blocks and airmass coverage of the
+extinction monitor targets.
+'''
+
+import datetime
+import multiprocessing
+
+import numpy as np
+import yaml
+
+from chimera_supervisor.controllers.scheduler.simulator import NightSimulator, MJD0
+from chimera_supervisor.controllers.scheduler.catalog import TargetCatalog
+from chimera_supervisor.controllers.scheduler.executor import SchedulerExecutor
+
+MJD_EPOCH = datetime.datetime(1858, 11, 17)
+
+def _monthly(value, month):
+    # A single value or one value per month (January first)
+    if isinstance(value, (list, tuple)):
+        return float(value[month-1])
+    return float(value)
+
+class WeatherModel(object):
+    '''
+    Weather statistics. A night is either lost (closed from start to end) or has a number of closures, drawn from a
+    Poisson distribution, starting at random times with exponentially distributed lengths. Every parameter is either
+    a single value or a list with one value per month.
+    '''
+
+    def __init__(self, lost=0.3, closures=0.5, closure_length=2.):
+        '''
+        :param lost: Probability of losing the whole night.
+        :param closures: Mean number of closures on a night that is not lost.
+        :param closure_length: Mean length of a closure, in hours.
+        '''
+        self.lost = lost
+        self.closures = closures
+        self.closure_length = closure_length
+
+    @staticmethod
+    def fromFile(filename):
+        '''
+        Load the model from a yaml file with (any of) the keys lost, closures and closure_length.
+        '''
+        with open(filename) as fp:
+            config = yaml.load(fp) or {}
+        return WeatherModel(**dict([(key, config[key]) for key in ('lost', 'closures', 'closure_length')
+                                    if key in config]))
+
+    def sample(self, start, end, random):
+        '''
+        Draw the closures of a night.
+
+        :param start: Start of the night (MJD).
+        :param end: End of the night (MJD).
+        :param random: numpy RandomState.
+        :return: List of (start, end), in MJD, sorted and not overlapping.
+        '''
+        month = (MJD_EPOCH + datetime.timedelta(days=start)).month
+
+        if random.random_sample() < _monthly(self.lost, month):
+            return [(start, end)]
+
+        closures = []
+        for i in range(random.poisson(_monthly(self.closures, month))):
+            begin = random.uniform(start, end)
+            length = random.exponential(_monthly(self.closure_length, month))/24.
+            closures.append((begin, min(begin+length, end)))
+        closures.sort()
+
+        merged = []
+        for begin, finish in closures:
+            if len(merged) > 0 and begin <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], finish))
+            else:
+                merged.append((begin, finish))
+        return merged
+
+class SeasonResult(object):
+    '''
+    One realization of a season: the result of each night and the number of visits of each program of the queue.
+    '''
+
+    def __init__(self, nights, visits, closures):
+        self.nights = nights
+        self.visits = visits
+        self.closures = closures
+
+class SeasonSimulator(object):
+    '''
+    Simulate consecutive nights of the same queue with closures drawn from the weather model. The queue is scheduled
+    again for every night (see plan).
+    '''
+
+    def __init__(self, queue, algorithms, ephem, nights, weather, seed=None, revisit=(), maxVisits=None,
+                 slewModel=None, replan=None, config=None, slotLen=15.):
+        '''
+        :param queue: Columnar queue (simulator.QUEUE_DTYPE).
+        :param algorithms: dict of algorithm id -> scheduling algorithm class.
+        :param ephem: Ephemeris used for the sidereal time.
+        :param nights: List of (start, end, MoonTable) of each night, start and end in MJD.
+        :param weather: WeatherModel.
+        :param seed: Random seed of this realization.
+        :param revisit: Ids of the algorithms whose programs go back to the queue every night (e.g. Recurrent).
+        :param maxVisits: Maximum number of visits of each program of the queue (0 means unrestricted). Only used for
+                          programs that are revisited.
+        :param replan: Ids of the algorithms whose programs are scheduled again every night. Their process must not
+                       use the database nor the site. Defaults to every algorithm.
+        :param config: Configuration passed to the algorithms process, as the project configuration of makeQueue.
+        :param slotLen: Slot length passed to the algorithms process.
+        '''
+        self.queue = queue
+        self.algorithms = algorithms
+        self.ephem = ephem
+        self.nights = nights
+        self.weather = weather
+        self.seed = seed
+        self.revisit = list(revisit)
+        self.maxVisits = maxVisits if maxVisits is not None else np.zeros(len(queue), dtype=int)
+        self.slewModel = slewModel
+        self.replan = list(replan) if replan is not None else list(algorithms.keys())
+        self.config = dict(config) if config is not None else {}
+        # Revisited programs are scheduled every night, unless a recurrence is configured
+        self.config.setdefault('recurrence', 0.)
+        self.slotLen = slotLen
+
+    def plan(self, queue, start, end, moon, lastVisit):
+        '''
+        Queue of one night, as makeQueue would build it. The unfinished programs of the algorithms in replan go
+        through the process of their algorithm for the night and get the start of the slot they were given, programs
+        given no slot are left out of the night. Programs of the other algorithms keep their time with respect to the
+        start of the night.
+
+        :param queue: Columnar queue, with the programs observed so far finished.
+        :param start: Start of the night (MJD).
+        :param end: End of the night (MJD).
+        :param moon: MoonTable covering the night.
+        :param lastVisit: Time (MJD) of the last visit of each program, NaN if it was never observed.
+        :return: Columnar queue of the night.
+        '''
+        night = np.array(queue)
+        night['slewAt'] += start - self.nights[0][0]
+
+        replan = np.in1d(night['schedalgorith'], self.replan) & np.bitwise_not(night['finished'])
+        night['finished'][replan] = True
+
+        today = MJD_EPOCH + datetime.timedelta(days=start)
+
+        executor = SchedulerExecutor(1)
+        try:
+            for algorithm_id in np.unique(night['schedalgorith'][replan]):
+                # Programs of each block. A block gets at most one slot per program.
+                programs = {}
+                for i in np.where(replan & (night['schedalgorith'] == algorithm_id))[0]:
+                    programs.setdefault(night['blockid'][i], []).append(i)
+
+                first = []
+                last = []
+                for blockid in sorted(programs.keys()):
+                    visited = lastVisit[programs[blockid]]
+                    visited = visited[np.bitwise_not(np.isnan(visited))]
+                    first.append(programs[blockid][0])
+                    last.append(visited.max() if len(visited) > 0 else np.nan)
+
+                catalog = TargetCatalog.fromQueue(night[first], np.array(last))
+
+                slots = self.algorithms[algorithm_id].process(self.slotLen,
+                                                              obsStart=start+MJD0,
+                                                              obsEnd=end+MJD0,
+                                                              catalog=catalog,
+                                                              ephem=self.ephem,
+                                                              moon=moon,
+                                                              config=dict(self.config),
+                                                              executor=executor,
+                                                              today=today)
+
+                for slot in np.sort(slots, order='start'):
+                    group = programs.get(slot['blockid'])
+                    if group:
+                        i = group.pop(0)
+                        night['slewAt'][i] = slot['start'] - MJD0
+                        night['finished'][i] = False
+        finally:
+            executor.close()
+
+        return night
+
+    def run(self):
+        random = np.random.RandomState(self.seed)
+        queue = np.array(self.queue)
+        index = dict([(pid, i) for i, pid in enumerate(queue['id'])])
+        revisit = np.in1d(queue['schedalgorith'], self.revisit)
+        visits = np.zeros(len(queue), dtype=int)
+        lastVisit = np.zeros(len(queue)) + np.nan
+
+        results = []
+        closures = []
+        for start, end, moon in self.nights:
+            reopen = revisit & ((self.maxVisits == 0) | (visits < self.maxVisits))
+            queue['finished'][reopen] = False
+
+            nightQueue = self.plan(queue, start, end, moon, lastVisit)
+
+            nightClosures = self.weather.sample(start, end, random)
+            night = NightSimulator(nightQueue, self.algorithms, self.ephem, moon, start, end,
+                                   slewModel=self.slewModel, closures=nightClosures)
+            result = night.run()
+
+            for entry in result.log:
+                i = index[entry['id']]
+                visits[i] += 1
+                lastVisit[i] = entry['start']
+                queue['finished'][i] = True
+
+            results.append(result)
+            closures.append(nightClosures)
+
+        return SeasonResult(results, visits, closures)
+
+def _run(simulator):
+    return simulator.run()
+
+def simulateSeasons(simulators, processes=None):
+    '''
+    Run the realizations in a process pool.
+
+    :return: List of SeasonResult, in the same order.
+    '''
+    if processes is None or processes < 1:
+        processes = multiprocessing.cpu_count()
+
+    if processes == 1 or len(simulators) == 1:
+        return [simulator.run() for simulator in simulators]
+
+    pool = multiprocessing.Pool(min(processes, len(simulators)))
+    try:
+        return pool.map(_run, simulators)
+    finally:
+        pool.close()
+        pool.join()
+
+def airmassBins(maxairmass, dec, latitude, nairmass):
+    '''
+    Altitude bins used by ExtintionMonitor: nairmass bins from the lowest altitude allowed (with a 10% margin) to the
+    culmination of the target.
+
+    :param dec: Target declination in radians.
+    :param latitude: Site latitude in radians.
+    '''
+    minalt = (90.-np.degrees(np.arccos(1./maxairmass)))*1.1
+    maxalt = 90.-np.degrees(np.abs(latitude-dec))
+    return np.linspace(minalt, maxalt, nairmass+1)
+
+def aggregate(queue, results, latitude, recurrent=(), extmoni=(), nairmass=None):
+    '''
+    Aggregate the realizations of a season per project.
+
+    :param queue: Columnar queue the seasons were simulated with.
+    :param results: List of SeasonResult.
+    :param latitude: Site latitude in radians.
+    :param recurrent: Ids of the recurrent algorithms.
+    :param extmoni: Ids of the extinction monitor algorithms.
+    :param nairmass: dict of (pid, tid) -> number of airmass bins of the extinction monitor targets.
+    :return: dict of pid -> dict with completion (mean and std over realizations), visits and cadence (days) of the
+             recurrent programs and airmass coverage of the extinction monitor targets.
+    '''
+    nairmass = nairmass if nairmass is not None else {}
+    index = dict([(program_id, i) for i, program_id in enumerate(queue['id'])])
+    isRecurrent = np.in1d(queue['schedalgorith'], list(recurrent))
+    isExtMoni = np.in1d(queue['schedalgorith'], list(extmoni))
+
+    summary = {}
+    for pid in np.unique(queue['pid']):
+        programs = queue['pid'] == pid
+        completion = []
+        visits = []
+        cadence = []
+        coverage = []
+
+        for result in results:
+            completion.append(np.mean(result.visits[programs] > 0))
+
+            if np.any(programs & isRecurrent):
+                visits.append(np.mean(result.visits[programs & isRecurrent]))
+
+            # Observation times and altitudes of each program
+            times = {}
+            altitudes = {}
+            for night in result.nights:
+                for entry in night.log:
+                    i = index[entry['id']]
+                    if not programs[i]:
+                        continue
+                    times.setdefault(i, []).append(entry['start'])
+                    if isExtMoni[i]:
+                        altitudes.setdefault(queue['tid'][i], []).append(
+                            90.-np.degrees(np.arccos(1./entry['airmass'])))
+
+            for i, t in times.items():
+                if isRecurrent[i] and len(t) > 1:
+                    cadence.append(np.mean(np.diff(np.sort(t))))
+
+            for tid in np.unique(queue['tid'][programs & isExtMoni]):
+                nbins = nairmass.get((pid, tid), 1)
+                i = np.where(programs & isExtMoni & (queue['tid'] == tid))[0][0]
+                bins = airmassBins(queue['maxairmass'][i], queue['dec'][i], latitude, nbins)
+                observed = np.digitize(altitudes.get(tid, []), bins)
+                covered = len(np.unique(observed[(observed > 0) & (observed <= nbins)]))
+                coverage.append(float(covered)/nbins)
+
+        summary[pid] = {'programs': int(np.sum(programs)),
+                        'completion': (float(np.mean(completion)), float(np.std(completion))),
+                        'visits': float(np.mean(visits)) if len(visits) > 0 else None,
+                        'cadence': float(np.mean(cadence)) if len(cadence) > 0 else None,
+                        'coverage': float(np.mean(coverage)) if len(coverage) > 0 else None}
+
+    return summary
+
+def weatherLoss(results):
+    '''
+    Mean fraction of the night time lost to weather and mean open shutter time per night, in hours.
+    '''
+    night = np.array([[n.end - n.start for n in result.nights] for result in results])*86400.
+    weather = np.array([[n.weather for n in result.nights] for result in results])
+    shutter = np.array([[n.shutter for n in result.nights] for result in results])
+    return float(np.sum(weather)/np.sum(night)), float(np.mean(shutter))/3600.
@@ -0,0 +1,396 @@
+'''
+Discrete-event simulation of the robobs queue.
+
+processQueue used to simulate a night by asking the RobObs object for every program over Pyro, storing each step in
+the database and then cleaning up after itself. NightSimulator runs the same selection logic as RobObs.reshedule in
+process, over an in-memory copy of the queue, with the ephemeris and moon tables used by the algorithms and a simple
+slew-time model. Nothing is written to the database and a simulator can be pickled, so many nights (or
+configurations) can be run in parallel with simulate().
+'''
+
+import multiprocessing
+
+import numpy as np
+from sqlalchemy.orm import joinedload
+
+from chimera_supervisor.controllers.scheduler.model import Program, BlockPar, ObsBlock, Targets
+from chimera_supervisor.controllers.scheduler import ephemeris
+
+# MJD -> JD
+MJD0 = 2400000.5
+
+QUEUE_DTYPE = [('id', np.int64),              # Program.id
+               ('tid', np.int64),             # Targets.id
+               ('blockid', np.int64),         # ObsBlock.id
+               ('pid', object),
+               ('name', object),
+               ('priority', np.int64),
+               ('slewAt', np.float64),        # MJD
+               ('exptime', np.float64),       # open shutter time, in seconds
+               ('length', np.float64),        # exposures plus overheads, in seconds
+               ('ra', np.float64),            # radians
+               ('dec', np.float64),           # radians
+               ('minairmass', np.float64),
+               ('maxairmass', np.float64),
+               ('minmoonDist', np.float64),
+               ('minmoonBright', np.float64),
+               ('maxmoonBright', np.float64),
+               ('schedalgorith', np.int64),
+               ('finished', bool)]
+
+LOG_DTYPE = [('id', np.int64),                # Program.id
+             ('tid', np.int64),
+             ('priority', np.int64),
+             ('slewAt', np.float64),          # requested slew time (MJD)
+             ('start', np.float64),           # acquisition start (MJD)
+             ('end', np.float64),             # acquisition end (MJD)
+             ('wait', np.float64),            # seconds waiting before the slew
+             ('slew', np.float64),            # slew time in seconds
+             ('airmass', np.float64)]         # airmass at start
+
+def blockLength(actions, overhead=0.):
+    '''
+    Exposure time and total length, in seconds, of the actions of an observing block. Same estimate used by
+    processQueue: overhead is added to every frame and a focus run takes 10 minutes.
+    '''
+    exptime = 0.
+    length = 0.
+    for act in actions:
+        if act.__tablename__ == 'action_expose':
+            exptime += act.exptime*act.frames
+            length += (act.exptime+overhead)*act.frames
+        elif act.__tablename__ == 'action_focus' and act.step > 0:
+            length += 600.
+    return exptime, length
+
+def loadQueue(session, overhead=20.):
+    '''
+    Load the unfinished programs in a columnar queue, ordered by priority and slewAt (as RobObs.loadPrograms).
+
+    :param overhead: Time, in seconds, added to each frame (read out, etc).
+    '''
+    query = session.query(Program,
+                          BlockPar,
+                          ObsBlock,
+                          Targets).join(
+        BlockPar, Program.blockpar_id == BlockPar.id).join(
+        ObsBlock, Program.obsblock_id == ObsBlock.id).join(
+        Targets, Program.tid == Targets.id).filter(Program.finished == False).options(
+        joinedload(ObsBlock.actions)).order_by(Program.priority, Program.slewAt)
+
+    rows = []
+    for program, blockpar, obsblock, target in query:
+        exptime, length = blockLength(obsblock.actions, overhead)
+        ra, dec = ephemeris.catalogArrays([target.targetRa], [target.targetDec])
+        rows.append((program.id, target.id, obsblock.id, program.pid, target.name, program.priority,
+                     program.slewAt or 0., exptime, length, float(ra[0]), float(dec[0]),
+                     blockpar.minairmass, blockpar.maxairmass, blockpar.minmoonDist,
+                     blockpar.minmoonBright, blockpar.maxmoonBright, blockpar.schedalgorith, False))
+
+    return np.array(rows, dtype=QUEUE_DTYPE)
+
+class SlewModel(object):
+    '''
+    Slew at a constant rate plus a settling time.
+    '''
+
+    def __init__(self, rate=1., settle=0.):
+        '''
+        :param rate: Slew rate in degrees per second.
+        :param settle: Settling time in seconds.
+        '''
+        self.rate = float(rate)
+        self.settle = float(settle)
+
+    def slewTime(self, ra1, dec1, ra2, dec2):
+        '''
+        Time, in seconds, to go from (ra1, dec1) to (ra2, dec2), in radians.
+        '''
+        return float(ephemeris.angularSeparation(ra1, dec1, ra2, dec2))/self.rate + self.settle
+
+class SimulationResult(object):
+    '''
+    Outcome of a simulated night: columnar log of the observed programs and time accounting, in seconds.
+    '''
+
+    def __init__(self, start, end, log, idle, slew, shutter, overhead, weather=0.):
+        self.start = start
+        self.end = end
+        self.log = log
+        self.idle = idle
+        self.slew = slew
+        self.shutter = shutter
+        self.overhead = overhead
+        self.weather = weather
+
+    def stats(self):
+        night = (self.end - self.start)*86400.
+        return {'start': self.start,
+                'end': self.end,
+                'programs': len(self.log),
+                'night': night,
+                'idle': self.idle,
+                'slew': self.slew,
+                'shutter': self.shutter,
+                'overhead': self.overhead,
+                'weather': self.weather,
+                'efficiency': self.shutter/night if night > 0. else 0.}
+
+class NightSimulator(object):
+    '''
+    Simulate one night of the queue. The selection follows RobObs.reshedule and getProgram; the algorithms select
+    programs with simulatedNext and conditions (airmass, night end and moon) are computed from the ephemeris. The
+    queue is copied, so the same queue can be used by several simulators.
+    '''
+
+    def __init__(self, queue, algorithms, ephem, moon, start, end, slewModel=None, retry=300., step=60.,
+                 tolerance=1., closures=None):
+        '''
+        :param queue: Columnar queue (QUEUE_DTYPE), as returned by loadQueue.
+        :param algorithms: dict of algorithm id -> scheduling algorithm class.
+        :param ephem: Ephemeris used for the sidereal time (any grid, only lstAt is used).
+        :param moon: MoonTable covering the night.
+        :param start: Start of the night (MJD).
+        :param end: End of the night (MJD).
+        :param slewModel: SlewModel. Defaults to 1 degree per second.
+        :param retry: Time, in seconds, to wait when no program can be observed.
+        :param step: Grid step, in seconds, used to look for earlier slew times.
+        :param tolerance: Precision, in seconds, of the earlier slew times.
+        :param closures: List of (start, end), in MJD, of weather closures. A program that would still be running
+                         when the dome closes is lost (stays in the queue).
+        '''
+        self.queue = np.array(queue, dtype=QUEUE_DTYPE)
+        self.algorithms = algorithms
+        self.ephem = ephem
+        self.moon = moon
+        self.start = float(start)
+        self.end = float(end)
+        self.slewModel = slewModel if slewModel is not None else SlewModel()
+        self.retry = float(retry)
+        self.step = float(step)
+        self.tolerance = float(tolerance)
+        self.closures = sorted(closures) if closures is not None else []
+
+    def closedUntil(self, time):
+        '''
+        End of the closure going on at time or None if the dome is open.
+        '''
+        for start, end in self.closures:
+            if start <= time < end:
+                return end
+        return None
+
+    def nextClosure(self, time):
+        '''
+        Start of the first closure after time (self.end if there is none).
+        '''
+        for start, end in self.closures:
+            if start > time:
+                return min(start, self.end)
+        return self.end
+
+    def mask(self, jd, index):
+        '''
+        Airmass and moon restrictions of the programs in index at each julian date of jd.
+
+        :return: Boolean array with shape (ntimes, nprograms).
+        '''
+        jd = np.atleast_1d(jd)
+        queue = self.queue[np.atleast_1d(index)]
+
+        airmass = ephemeris.airmass(ephemeris.altitude(self.ephem.lstAt(jd)[:, np.newaxis],
+                                                       self.ephem.latitude,
+                                                       queue['ra'][np.newaxis, :],
+                                                       queue['dec'][np.newaxis, :]))
+        mask = (queue['minairmass'][np.newaxis, :] < airmass) & (airmass < queue['maxairmass'][np.newaxis, :])
+        mask &= self.moon.moonMask(jd, queue['ra'], queue['dec'], queue['minmoonDist'],
+                                   queue['minmoonBright'], queue['maxmoonBright'])
+        return mask
+
+    def checkConditions(self, index, time, length=0.):
+        '''
+        Same as RobObs.checkConditions, for a single program at time (MJD).
+        '''
+        if length > 0. and time + length/86400. > self.end:
+            return False
+        return bool(self.mask(time + MJD0, index)[0, 0])
+
+    def earliestSlew(self, index, start, end):
+        '''
+        Same as RobObs.earliestSlew.
+        '''
+        jd = ephemeris.earliestFeasible(lambda jd: self.mask(jd, index)[:, 0],
+                                        start + MJD0,
+                                        end + MJD0,
+                                        self.step,
+                                        self.tolerance)
+        return None if jd is None else jd - MJD0
+
+    def getProgram(self, time, candidates):
+        '''
+        Same as RobObs.getProgram, for the candidates (queue indexes) of one priority.
+
+        :return: Queue index of the program (or None) and its exposure time.
+        '''
+        algorithms = self.queue['schedalgorith'][candidates]
+        for algorithm_id in np.unique(algorithms):
+            algorithm = self.algorithms[algorithm_id]
+            index = algorithm.simulatedNext(time, self.queue, candidates[algorithms == algorithm_id])
+
+            if index is None:
+                continue
+
+            exptime = self.queue['exptime'][index]
+            slewAt = self.queue['slewAt'][index]
+            if not algorithm.timed_constraint() and slewAt > time:
+                earliest = self.earliestSlew(index, time, slewAt)
+                if earliest is not None and earliest < slewAt and self.checkConditions(index, earliest, exptime):
+                    self.queue['slewAt'][index] = earliest
+
+            return index, exptime
+
+        return None, 0.
+
+    def reshedule(self, time):
+        '''
+        Same as RobObs.reshedule: choose the next program at time (MJD).
+
+        :return: Queue index of the program or None.
+        '''
+        unfinished = np.where(np.bitwise_not(self.queue['finished']))[0]
+        if len(unfinished) == 0:
+            return None
+
+        priorities = self.queue['priority'][unfinished]
+        plist = np.unique(priorities)
+
+        slewAt = self.queue['slewAt']
+
+        program, plen = self.getProgram(time, unfinished[priorities == plist[0]])
+        waittime = 0.
+        if program is not None:
+            if not slewAt[program] and self.checkConditions(program, time, plen):
+                return program
+            waittime = (slewAt[program] - time)*86.4e3
+
+        waittime = max(waittime, 0.)
+
+        for p in plist[1:]:
+            aprogram, aplen = self.getProgram(time, unfinished[priorities == p])
+
+            if aprogram is None:
+                continue
+
+            can_observe = self.checkConditions(aprogram, max(time, slewAt[aprogram]), aplen)
+            if program is None and can_observe:
+                program, plen = aprogram, aplen
+                waittime = max((slewAt[program] - time)*86.4e3, 0.)
+                continue
+            elif not can_observe:
+                continue
+
+            awaittime = max((slewAt[aprogram] - time)*86.4e3, 0.)
+
+            if awaittime + aplen < waittime:
+                program, plen, waittime = aprogram, aplen, awaittime
+            elif awaittime < waittime and self.checkConditions(program, time + (awaittime+aplen)/86400., plen):
+                program, plen, waittime = aprogram, aplen, awaittime
+
+        if program is None or not self.checkConditions(program, max(time, slewAt[program]), plen):
+            return None
+
+        return program
+
+    def run(self):
+        '''
+        Simulate the night.
+
+        :return: SimulationResult.
+        '''
+        time = self.start
+        log = []
+        idle = slew = shutter = overhead = weather = 0.
+        position = None
+
+        while time < self.end:
+            closed = self.closedUntil(time)
+            if closed is not None:
+                closed = min(closed, self.end)
+                weather += (closed - time)*86400.
+                time = closed
+                continue
+
+            closure = self.nextClosure(time)
+
+            index = self.reshedule(time)
+
+            if index is None:
+                # Nothing can be observed now, try again later
+                wait = min(self.retry, (closure - time)*86400.)
+                idle += wait
+                time += wait/86400.
+                continue
+
+            program = self.queue[index]
+
+            wait = max(program['slewAt'] - time, 0.)*86400.
+            slewtime = 0. if position is None else self.slewModel.slewTime(position[0], position[1],
+                                                                           program['ra'], program['dec'])
+            start = time + max(wait, slewtime)/86400.
+            if start >= self.end:
+                break
+            end = start + program['length']/86400.
+
+            if end > closure and closure < self.end:
+                # Dome closes before the program is done, everything up to the closure is lost
+                weather += (closure - time)*86400.
+                time = closure
+                continue
+
+            airmass = float(ephemeris.airmass(ephemeris.altitude(self.ephem.lstAt(start + MJD0),
+                                                                 self.ephem.latitude,
+                                                                 program['ra'],
+                                                                 program['dec'])))
+
+            log.append((program['id'], program['tid'], program['priority'], program['slewAt'], start, end, wait,
+                        slewtime, airmass))
+
+            # Slewing is done while waiting
+            idle += max(wait, slewtime) - slewtime
+            slew += slewtime
+            shutter += program['exptime']
+            overhead += program['length'] - program['exptime']
+
+            self.queue['finished'][index] = True
+            position = (program['ra'], program['dec'])
+            time = end
+
+        if time < self.end:
+            idle += (self.end - time)*86400.
+
+        return SimulationResult(self.start, self.end, np.array(log, dtype=LOG_DTYPE), idle, slew, shutter, overhead,
+                                weather)
+
+def _run(simulator):
+    return simulator.run()
+
+def simulate(simulators, processes=None):
+    '''
+    Run independent simulations (e.g. different nights or configurations) in a process pool.
+
+    :param simulators: List of NightSimulator.
+    :param processes: Number of worker processes. Defaults to the number of cores. With 1, runs in this process.
+    :return: List of SimulationResult, in the same order.
+    '''
+    if processes is None or processes < 1:
+        processes = multiprocessing.cpu_count()
+
+    if processes == 1 or len(simulators) == 1:
+        return [simulator.run() for simulator in simulators]
+
+    pool = multiprocessing.Pool(min(processes, len(simulators)))
+    try:
+        return pool.map(_run, simulators)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,241 @@
+
+'''
+Spatial index over target coordinates.
+
+Targets are split in declination zones and sorted by right ascension inside each zone, so range queries in RA (hour
+angle windows, cones around the moon) are answered with a binary search per zone instead of a scan of the whole
+catalog. Indexes are cached on disk next to the scheduler database, keyed by a hash of the coordinates. Only the most
+recently used indexes are kept.
+'''
+
+import os
+import glob
+import hashlib
+
+import numpy as np
+
+from chimera_supervisor.core.constants import DEFAULT_ROBOBS_DATABASE
+from chimera_supervisor.controllers.scheduler.ephemeris import angularSeparation
+
+class SkyIndex(object):
+    '''
+    Zone index over (ra, dec) arrays in radians. Queries return indices into the original arrays.
+    '''
+
+    def __init__(self, ra, dec, zoneHeight=1.):
+        '''
+        :param ra: Right ascensions in radians.
+        :param dec: Declinations in radians.
+        :param zoneHeight: Height of the declination zones in degrees.
+        '''
+        self.ra = np.ascontiguousarray(ra, dtype=np.float64)
+        self.dec = np.ascontiguousarray(dec, dtype=np.float64)
+        self.zoneHeight = float(zoneHeight)
+
+        self.nzones = int(np.ceil(180./self.zoneHeight))
+        self.zoneEdges = np.radians(np.linspace(-90., -90.+self.nzones*self.zoneHeight, self.nzones+1))
+
+        zone = self._zone(self.dec)
+        # Sort by zone, then by RA inside each zone
+        self.order = np.lexsort((np.mod(self.ra, 2.*np.pi), zone))
+        self.zoneStart = np.searchsorted(zone[self.order], np.arange(self.nzones+1))
+        self._ra = np.mod(self.ra[self.order], 2.*np.pi)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def _zone(self, dec):
+        return np.clip(((np.degrees(dec)+90.)/self.zoneHeight).astype(int), 0, self.nzones-1)
+
+    @staticmethod
+    def key(ra, dec):
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(ra, dtype=np.float64).tostring())
+        digest.update(np.ascontiguousarray(dec, dtype=np.float64).tostring())
+        return digest.hexdigest()
+
+    @staticmethod
+    def cached(ra, dec, zoneHeight=1., directory=None, keep=8):
+        '''
+        Return the index for (ra, dec), loading it from disk if it was already built for the same coordinates.
+
+        :param directory: Where to store the index. Defaults to the directory of the scheduler database.
+        :param keep: Number of indexes kept in directory when a new one is stored, the least recently used are
+                     removed. makeQueue builds one catalog per algorithm, so this should be larger than the number of
+                     algorithms.
+        '''
+        if directory is None:
+            directory = os.path.dirname(DEFAULT_ROBOBS_DATABASE)
+
+        filename = os.path.join(directory, 'skyindex_%s_%.2f.npz' % (SkyIndex.key(ra, dec), zoneHeight))
+
+        if os.path.exists(filename):
+            try:
+                data = np.load(filename)
+                index = SkyIndex.__new__(SkyIndex)
+                index.ra = np.ascontiguousarray(ra, dtype=np.float64)
+                index.dec = np.ascontiguousarray(dec, dtype=np.float64)
+                index.zoneHeight = float(zoneHeight)
+                index.nzones = int(data['nzones'])
+                index.zoneEdges = data['zoneEdges']
+                index.order = data['order']
+                index.zoneStart = data['zoneStart']
+                index._ra = np.mod(index.ra[index.order], 2.*np.pi)
+                try:
+                    # Mark as recently used
+                    os.utime(filename, None)
+                except OSError:
+                    pass
+                return index
+            except Exception:
+                pass
+
+        index = SkyIndex(ra, dec, zoneHeight)
+        try:
+            np.savez(filename,
+                     nzones=index.nzones,
+                     zoneEdges=index.zoneEdges,
+                     order=index.order,
+                     zoneStart=index.zoneStart)
+        except IOError:
+            return index
+
+        SkyIndex.prune(directory, keep)
+
+        return index
+
+    @staticmethod
+    def prune(directory, keep=8):
+        '''
+        Remove the indexes stored in directory, except for the keep most recently used.
+        '''
+        used = []
+        for filename in glob.glob(os.path.join(directory, 'skyindex_*.npz')):
+            try:
+                used.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+        used.sort(reverse=True)
+
+        for mtime, filename in used[keep:]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def _raRange(self, zone, ra0, halfWidth):
+        '''
+        Indices of zone members with RA within halfWidth of ra0 (radians), wrapping around 0h.
+        '''
+        start, end = self.zoneStart[zone], self.zoneStart[zone+1]
+        if start == end:
+            return np.array([], dtype=int)
+        if halfWidth >= np.pi:
+            return self.order[start:end]
+
+        zra = self._ra[start:end]
+        low = np.mod(ra0 - halfWidth, 2.*np.pi)
+        high = np.mod(ra0 + halfWidth, 2.*np.pi)
+        ilow = np.searchsorted(zra, low, side='left')
+        ihigh = np.searchsorted(zra, high, side='right')
+
+        if low <= high:
+            return self.order[start+ilow:start+ihigh]
+        return np.append(self.order[start+ilow:end], self.order[start:start+ihigh])
+
+    def hourAngleWindow(self, lst, latitude, minAltitude=0., widen=0.):
+        '''
+        Targets that are above minAltitude at local sidereal time lst, for a site at latitude. The hour angle limit
+        is computed for the worst declination of each zone, so the result is a superset of the targets above
+        minAltitude (only a few close to the limit may be below it).
+
+        :param lst: Local sidereal time in radians.
+        :param latitude: Site latitude in radians.
+        :param minAltitude: Minimum altitude in degrees.
+        :param widen: Added to the hour angle limit, in radians. Targets above minAltitude at any time within widen
+                      of lst are returned.
+        :return: Indices of the targets inside the window.
+        '''
+        sinalt = np.sin(np.radians(minAltitude))
+        candidates = []
+
+        # The hour angle limit has a single extreme in declination, at sin(dec) = sin(latitude)/sin(minAltitude).
+        extreme = None
+        if sinalt != 0. and np.abs(np.sin(latitude)/sinalt) <= 1.:
+            extreme = np.arcsin(np.sin(latitude)/sinalt)
+
+        for zone in range(self.nzones):
+            if self.zoneStart[zone] == self.zoneStart[zone+1]:
+                continue
+
+            edges = self.zoneEdges[zone:zone+2]
+            if extreme is not None and edges[0] < extreme < edges[1]:
+                edges = np.append(edges, extreme)
+            cosdec = np.cos(edges)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cosH = (sinalt - np.sin(latitude)*np.sin(edges))/(np.cos(latitude)*cosdec)
+            cosH[cosdec < 1e-10] = -1. # poles are always at the same altitude
+
+            cosH = cosH.min()
+            if cosH > 1.:
+                # Zone never rises above minAltitude
+                continue
+
+            halfWidth = np.pi if cosH < -1. else np.arccos(cosH) + widen
+            candidates.append(self._raRange(zone, lst, halfWidth))
+
+        if len(candidates) == 0:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(candidates))
+
+    def cone(self, ra, dec, radius):
+        '''
+        Targets within radius (degrees) of (ra, dec) (radians).
+        '''
+        radius_r = np.radians(radius)
+        first = self._zone(np.array([max(dec - radius_r, -np.pi/2.)]))[0]
+        last = self._zone(np.array([min(dec + radius_r, np.pi/2.)]))[0]
+
+        # Maximum RA extent of the cone
+        if np.abs(dec) + radius_r >= np.pi/2. or radius_r >= np.pi/2.:
+            halfWidth = np.pi
+        else:
+            halfWidth = np.arcsin(min(1., np.sin(radius_r)/np.cos(dec)))
+
+        near = []
+        for zone in range(first, last+1):
+            near.append(self._raRange(zone, ra, halfWidth))
+
+        if len(near) == 0:
+            return np.array([], dtype=int)
+
+        near = np.concatenate(near)
+        sep = angularSeparation(ra, dec, self.ra[near], self.dec[near])
+        return np.sort(near[sep <= radius])
+
+    def farFrom(self, ra, dec, distance, candidates=None):
+        '''
+        Targets farther than distance (degrees) from (ra, dec) (radians). Only the targets inside the cone around
+        the point are tested.
+
+        :param distance: Scalar or one value per candidate.
+        :param candidates: Optional indices to restrict the query to. Defaults to all targets.
+        :return: Indices of the targets farther than distance.
+        '''
+        if candidates is None:
+            candidates = np.arange(len(self.ra))
+        candidates = np.asarray(candidates, dtype=int)
+        distance = np.asarray(distance, dtype=np.float64)
+        if len(candidates) == 0:
+            return candidates
+
+        radius = distance.max()
+        if radius <= 0.:
+            return candidates
+
+        near = np.in1d(candidates, self.cone(ra, dec, radius))
+        if distance.ndim > 0:
+            sep = angularSeparation(ra, dec, self.ra[candidates[near]], self.dec[candidates[near]])
+            near[near] = sep <= distance[near]
+
+        return candidates[np.bitwise_not(near)]
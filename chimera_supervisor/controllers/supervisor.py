@@ -1,14 +1,14 @@
 
 import os
 import shutil
-import contextlib
-import urllib
 
 from chimera_supervisor.controllers.machine import Machine
 from chimera_supervisor.controllers.checklist import CheckList
 from chimera_supervisor.controllers.status import OperationStatus, InstrumentOperationFlag
 from chimera_supervisor.controllers.states import State
+from chimera_supervisor.controllers.telegramgateway import TelegramGateway, CallbackDispatcher
 from chimera_supervisor.core.exceptions import StatusUpdateException
+from chimera_supervisor.core.database import databaseStats
 
 from chimera.core.constants import SYSTEM_CONFIG_DIRECTORY
 from chimera.core.chimeraobject import ChimeraObject
@@ -41,8 +41,19 @@ class Supervisor(ChimeraObject):
                     "telegram-token": None,          # Telegram bot token
                     "telegram-broascast-ids": None,  # Telegram broadcast ids
                     "telegram-listen-ids": None,     # Telegram listen ids
+                    "telegram-base-url": None,       # Telegram Bot API url (e.g. the fake bot server in tests/fakebot.py)
+                    "telegram-interval": 1.,         # Minimum time, in seconds, between messages to the same chat
+                    "telegram-retries": 3,           # Number of times a failed message is retried
+                    "telegram-photo-size": None,     # If given, photos are downsampled to this size (pixels) before sent
+                    "telegram-photo-quality": 85,    # Jpeg quality of the downsampled photos
                     "freq": 0.01  ,                  # Set manager watch frequency in Hz.
-                    "max_mins": 10                   # Maximum time, in minutes, data from weather station should have
+                    "max_mins": 10,                  # Maximum time, in minutes, data from weather station should have
+                    "checklist_workers": 4,          # Number of checklist items checked concurrently
+                    "weather_timeout": 5.,           # Maximum time, in seconds, to wait for a weather station
+                    "reactive": False,               # Only check the items affected by a change (see Machine.trigger)
+                    "sweep_period": 600.,            # In reactive mode, time (in seconds) between checks of all items
+                    "poll_period": 5.,               # In reactive mode, weather stations polling period (in seconds)
+                    "flag_flush_interval": 5.        # Time, in seconds, between commits of instrument flags to the database
                  }
 
     def __init__(self):
@@ -74,6 +85,8 @@ class Supervisor(ChimeraObject):
         self.checklist = None
         self.machine = None
         self.bot = None
+        self.gateway = None
+        self.questions = None
 
 
     def __start__(self):
@@ -120,6 +133,7 @@ class Supervisor(ChimeraObject):
 
         self.machine.state(State.SHUTDOWN)
         self.checklist.mustStop.set()
+        self.checklist.__stop__()
 
         if self.isTelegramConnected():
             self.disconnectTelegram()
@@ -130,7 +144,12 @@ class Supervisor(ChimeraObject):
 
         # self.log.debug('[control] current status is "%s"'%(self._operationStatus["site"]))
 
-        if self.machine.state() == State.IDLE:
+        if self["reactive"]:
+            # Items are checked when their inputs change. Check everything from time to time as a safety net.
+            if self.machine.state() == State.IDLE and self.machine.sweepAge() > self["sweep_period"]:
+                self.machine.sweep()
+                return True
+        elif self.machine.state() == State.IDLE:
             self.machine.state(State.START)
             return True
         # else:
@@ -176,7 +195,14 @@ class Supervisor(ChimeraObject):
     def connectTelegram(self):
 
         if self["telegram-token"] is not None:
-            self.bot = telegram.Bot(token=self["telegram-token"])
+            self.bot = telegram.Bot(token=self["telegram-token"], base_url=self["telegram-base-url"])
+            self.gateway = TelegramGateway(self.bot, self.log,
+                                           interval=self["telegram-interval"],
+                                           retries=self["telegram-retries"],
+                                           photoSize=self["telegram-photo-size"],
+                                           photoQuality=self["telegram-photo-quality"])
+            self.gateway.start()
+            self.questions = CallbackDispatcher(self.log)
             self.updater = telegram.ext.Updater(bot=self.bot)
 
             # self.updater.dispatcher.addHandler(CommandHandler('start', start))
@@ -187,6 +213,8 @@ class Supervisor(ChimeraObject):
             self.updater.dispatcher.add_handler(telegram.ext.CommandHandler('lock', self.telegramLock))
             self.updater.dispatcher.add_handler(telegram.ext.CommandHandler('unlock', self.telegramUnLock))
             self.updater.dispatcher.add_handler(telegram.ext.CommandHandler('help', self.telegramHelp))
+            # Answers to the inline keyboards of askWatcher and telegramList
+            self.updater.dispatcher.add_handler(telegram.ext.CallbackQueryHandler(self.questions.dispatch))
             # self.updater.dispatcher.addErrorHandler(error)
 
             # def start_telegram_polling():
@@ -202,6 +230,8 @@ class Supervisor(ChimeraObject):
             self.updater.start_polling()
 
     def disconnectTelegram(self):
+        self.questions.cancelAll()
+        self.gateway.stop()
         self.updater.stop()
 
     def telegramList(self, bot, update):
@@ -218,49 +248,25 @@ class Supervisor(ChimeraObject):
 
         reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-        updates = self.bot.getUpdates()
-        update_id=None
-        for update in updates:
-            update_id = updates[-1].update_id + 1
-
-        # bot.sendMessage(update.message.chat_id, text=msg)
-        msg_id = bot.sendMessage(chat_id=update.message.chat_id,
-                                 text=msg,
-                                 reply_markup=reply_markup
-                                 )
-
-        start_time = time.time()
-        while time.time() - start_time < 60:
-
-            updates = self.bot.getUpdates(offset = update_id)
-
-            for new_update in updates:
-                try:
-                    query = new_update.callback_query
-                    if query is None:
-                        continue
-                    dd = new_update.to_dict()
-
-                    answer = query.data
-                    if answer in items:
-                        self.bot.editMessageText(text='Running action %s...' % answer,
-                                            chat_id=msg_id.chat_id,
-                                            message_id=msg_id.message_id)
-                        self.machine.runAction(answer)
-                        return
-                    else:
-                        self.bot.editMessageText(text='Unidentified answer %s... Try again...' % answer,
-                                            chat_id=msg_id.chat_id,
-                                            message_id=msg_id.message_id)
-
-
-                except Exception, e:
-                    self.log.exception(e)
-
-        self.bot.editMessageText(text='Timed out...',
-                            chat_id=msg_id.chat_id,
-                            message_id=msg_id.message_id)
-
+        # This runs on the Updater thread, which also dispatches the answer, so it can not wait for it here
+        def answered(question):
+            msg_id = question.messages[0]
+            if question.answer is None:
+                bot.editMessageText(text='Timed out...',
+                                    chat_id=msg_id.chat_id,
+                                    message_id=msg_id.message_id)
+            else:
+                bot.editMessageText(text='Running action %s...' % question.answer,
+                                    chat_id=msg_id.chat_id,
+                                    message_id=msg_id.message_id)
+                self.machine.runAction(question.answer)
+
+        self.questions.ask(lambda: bot.sendMessage(chat_id=update.message.chat_id,
+                                                   text=msg,
+                                                   reply_markup=reply_markup),
+                           60.,
+                           accept=lambda answer: answer in items,
+                           callback=answered)
 
     def telegramRun(self, bot, update):
         # bot.sendMessage(update.message.chat_id, text="Running action \"%s\"." % update.message.text)
@@ -393,20 +399,14 @@ class Supervisor(ChimeraObject):
         else:
             self.log.info(msg)
 
-        if self.bot is not None and self["telegram-broascast-ids"] is not None:
-            for id in self._broadcast_ids:
-                self.bot.sendMessage(chat_id=id,
-                                     text=msg)
+        # Queued, a slow Telegram API must not delay the caller (e.g. a checklist response closing the dome)
+        if self.gateway is not None and self["telegram-broascast-ids"] is not None:
+            self.gateway.broadcast(self._broadcast_ids, msg)
 
     def broadCastPhoto(self,path,msg=''):
-        if self.bot is not None and self["telegram-broascast-ids"] is not None:
+        if self.gateway is not None and self["telegram-broascast-ids"] is not None:
             self.log.debug('Sending %s to %i listeners' % (path, len(self._broadcast_ids)))
-            try:
-                for id in self._broadcast_ids:
-                    with contextlib.closing(urllib.urlopen(str(path))) as fp:
-                        self.bot.sendPhoto(chat_id=id, photo=fp.fp)
-            except Exception, e:
-                self.log.exception(e)
+            self.gateway.broadcastPhoto(self._broadcast_ids, path, msg)
         else:
             self.log.error('No one to send image to!')
 
@@ -414,77 +414,37 @@ class Supervisor(ChimeraObject):
 
         if self.bot is not None and self["telegram-listen-ids"] is not None:
 
-            updates = self.bot.getUpdates()
-            update_id=None
-            for update in updates:
-                update_id = updates[-1].update_id + 1
-
             keyboard = [[telegram.InlineKeyboardButton("Yes", callback_data='OK'),
                          telegram.InlineKeyboardButton("No", callback_data='NO'),
                          telegram.InlineKeyboardButton("Lock dome!", callback_data='lock')]]
 
             reply_markup = telegram.InlineKeyboardMarkup(keyboard)
 
-            # bot.sendMessage(update.message.chat_id, text="Please choose:", reply_markup=reply_markup)
-
             self.log.debug('Asking lister %s.' % question)
 
-            msg_ids = []
-            for id in self._listen_ids:
-                msg_ids.append(self.bot.sendMessage(chat_id=id,
-                                     text='[waittime: %i s] %s' %
-                                          (waittime,
-                                           question),
-                                     reply_markup=reply_markup
-                                     ))
-
-            start_time = time.time()
-            while time.time() - start_time < waittime:
-
-                updates = self.bot.getUpdates(offset = update_id)
-
-                for update in updates:
-                    try:
-                        query = update.callback_query
-                        if query is None:
-                            continue
-                        dd = update.to_dict()
-                        # print dd
-                        # self.bot.editMessageText(text="Selected option: %s by %s" % (query.data,
-                        #                                                              dd['callback_query']['message']['chat']['username']),
-                        #                          chat_id=query.message.chat_id,
-                        #                          message_id=query.message.message_id)
-
-                        if query.message.chat_id in self._listen_ids:
-                            for msg in msg_ids:
-                                self.bot.editMessageText(text="%s \n Selected option: %s by %s" % (
-                                    dd['callback_query']['message']['text'],
-                                                    query.data,
-                                                    dd['callback_query']['message']['chat']['username']),
-                                                    chat_id=msg.chat_id,
-                                                    message_id=msg.message_id)
-                            answer = query.data
-                            if answer is not None:
-                                return answer
-                            else:
-                                return 'No'
-                        # else:
-                        #     for msg in msg_ids:
-                        #         self.bot.editMessageText(text="Selected option: %s by %s" % (query.data,
-                        #                             dd['callback_query']['message']['chat']['username']),
-                        #                             chat_id=msg.message.chat_id,
-                        #                             message_id=msg.message.message_id)
-                    except Exception,e:
-                        self.log.exception(e)
-                    update_id = update.update_id+1
-
-
-            for ids in msg_ids:
-                self.bot.editMessageText(text="%s (Timed out)" % ids.text,
-                                         chat_id=ids.chat_id,
-                                         message_id=ids.message_id)
-
-            return 'No'
+            def send():
+                return [self.bot.sendMessage(chat_id=id,
+                                             text='[waittime: %i s] %s' % (waittime, question),
+                                             reply_markup=reply_markup)
+                        for id in self._listen_ids]
+
+            # Blocks on an event until someone answers, the Updater polling dispatches the answer
+            pending = self.questions.ask(send, waittime)
+            answer = pending.wait()
+
+            for msg in pending.messages:
+                try:
+                    if answer is None:
+                        text = "%s (Timed out)" % msg.text
+                    else:
+                        text = "%s \n Selected option: %s by %s" % (msg.text, answer, pending.user)
+                    self.bot.editMessageText(text=text,
+                                             chat_id=msg.chat_id,
+                                             message_id=msg.message_id)
+                except Exception, e:
+                    self.log.exception(e)
+
+            return answer if answer is not None else 'No'
 
     def site(self):
         return self.getManager().getProxy('/Site/0')
@@ -495,6 +455,9 @@ class Supervisor(ChimeraObject):
     def getTel(self,index=0):
         return self.getManager().getProxy(self._instrument_list["telescope"][index])
 
+    def getDome(self,index=0):
+        return self.getManager().getProxy(self._instrument_list["dome"][index])
+
     def getSched(self,index=0):
         return self.getManager().getProxy(self._instrument_list["scheduler"][index])
 
@@ -510,6 +473,12 @@ class Supervisor(ChimeraObject):
     def getInstrumentList(self):
         return self._operationStatus.keys()
 
+    def getDatabaseStats(self):
+        '''
+        Return the commit latency stats of each database, by name.
+        '''
+        return databaseStats()
+
     def setFlag(self, instrument, flag, updatedb= True):
         if updatedb:
             if self.checklist.updateInstrumentStatus(instrument,flag):
@@ -519,6 +488,14 @@ class Supervisor(ChimeraObject):
                                                                                        flag))
         else:
             self._operationStatus[instrument] = flag
+        self._notify("flag.%s" % instrument)
+
+    def _notify(self, *inputs):
+        '''
+        Tell the machine an input changed, so the items depending on it are checked (reactive mode).
+        '''
+        if self["reactive"] and self.machine is not None:
+            self.machine.trigger(*inputs)
 
     def getFlag(self,instrument):
         return self._operationStatus[instrument]
@@ -550,6 +527,7 @@ class Supervisor(ChimeraObject):
                                                  InstrumentOperationFlag.LOCK,
                                                  key):
             self._operationStatus[instrument] = InstrumentOperationFlag.LOCK
+            self._notify("flag.%s" % instrument)
         else:
             self.log.warning("Could not change instrument status.")
 
@@ -569,6 +547,7 @@ class Supervisor(ChimeraObject):
                                                  InstrumentOperationFlag.CLOSE,
                                                  key):
             self._operationStatus[instrument] = InstrumentOperationFlag.CLOSE
+            self._notify("flag.%s" % instrument)
             return True
         else:
             raise StatusUpdateException("Unable to unlock %s with provided key"%(instrument))
@@ -644,25 +623,49 @@ class Supervisor(ChimeraObject):
         sched.stateChanged -= self.getProxy()._watchStateChanged
 
     def _connectDomeEvents(self):
-        # Todo
-        pass
+        if "dome" not in self._instrument_list:
+            return False
+        dome = self.getDome()
+        if not dome:
+            self.log.warning("Couldn't find dome.")
+            return False
+
+        dome.slitOpened += self.getProxy()._watchSlitOpened
+        dome.slitClosed += self.getProxy()._watchSlitClosed
+
+        return True
 
     def _disconnectDomeEvents(self):
-        # Todo
-        pass
+        if "dome" not in self._instrument_list:
+            return False
+        dome = self.getDome()
+        if not dome:
+            self.log.warning("Couldn't find dome.")
+            return False
+
+        dome.slitOpened -= self.getProxy()._watchSlitOpened
+        dome.slitClosed -= self.getProxy()._watchSlitClosed
+
+    def _watchSlitOpened(self, az):
+        self._notify("dome")
+
+    def _watchSlitClosed(self, az):
+        self._notify("dome")
 
     def _watchSlewBegin(self, target):
         self.setFlag("telescope",InstrumentOperationFlag.OPERATING)
+        self._notify("telescope")
 
     def _watchSlewComplete(self, position, status):
-        pass
+        self._notify("telescope")
 
     def _watchTrackingStarted(self, position):
         # Todo
-        pass
+        self._notify("telescope")
 
     def _watchTrackingStopped(self, position, status):
         self.setFlag("telescope",InstrumentOperationFlag.READY)
+        self._notify("telescope")
         self.broadCast('Telescope tracking stopped with status %s.' % status)
         if status == TelescopeStatus.OBJECT_TOO_LOW:
             # Todo: Make this an action on the checklist database, so user can configure what to do
@@ -685,12 +688,14 @@ class Supervisor(ChimeraObject):
         self.broadCast("Telescope parked")
         self.setFlag("telescope",InstrumentOperationFlag.CLOSE)
         self.setFlag("dome",InstrumentOperationFlag.CLOSE)
+        self._notify("telescope", "dome")
 
     def _watchTelescopeUnpark(self):
 
         self.broadCast("Telescope unparked")
         self.setFlag("telescope",InstrumentOperationFlag.READY)
         self.setFlag("dome",InstrumentOperationFlag.READY)
+        self._notify("telescope", "dome")
 
     def _watchProgramBegin(self,program):
         if self.getFlag("scheduler") != InstrumentOperationFlag.OPERATING:
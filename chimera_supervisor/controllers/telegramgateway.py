@@ -0,0 +1,528 @@
+'''
+Telegram notifications and questions.
+
+Checklist responses broadcast before they act (e.g. DomeAction, StopAll), so sending to Telegram from the caller thread
+puts the API latency, and its failures, in front of closing the dome. TelegramGateway queues the messages and a sender
+thread delivers them:
+
+ - Each chat gets at most one request every interval seconds (Telegram allows about one message per second per chat).
+ - Text messages that pile up for a chat while it waits are coalesced into a single message.
+ - Failed requests are retried a bounded number of times, with exponential backoff, or after the time asked by
+   Telegram flood control. Requests that can not succeed (bad request, blocked bot) are dropped.
+ - The queue is bounded, the oldest messages are dropped when it is full.
+ - A photo broadcast is fetched once (and optionally downsampled), uploaded to the first chat and sent to the others by
+   the file_id Telegram returns. The file_id of recently sent images is cached by content, so the same image (e.g. an
+   all-sky frame that did not change) is not uploaded again.
+
+Answers to inline keyboards (callback queries) arrive through the Updater polling started by the supervisor.
+CallbackDispatcher routes them, by chat and message id, to the question waiting for them, so a question waits on an
+event instead of polling getUpdates, and several questions can be open at the same time.
+'''
+
+import os
+import contextlib
+import collections
+import hashlib
+import logging
+import threading
+import time
+import urllib
+import StringIO
+
+import telegram.error
+
+# Requests that will fail again if retried
+_PERMANENT = tuple([getattr(telegram.error, name) for name in ('BadRequest', 'Unauthorized', 'InvalidToken',
+                                                                'ChatMigrated')
+                    if hasattr(telegram.error, name)])
+
+# Telegram limit for the text of a message
+MAX_MESSAGE_LENGTH = 4096
+
+class _Outbound(object):
+
+    __slots__ = ['kind', 'payload', 'caption', 'created', 'attempts']
+
+    def __init__(self, kind, payload, caption=''):
+        self.kind = kind
+        self.payload = payload
+        self.caption = caption
+        self.created = time.time()
+        self.attempts = 0
+
+class _Photo(object):
+    '''
+    Photo shared by the messages of a broadcast. Fetched by the first delivery, the data is dropped once the file_id is
+    known.
+    '''
+
+    __slots__ = ['path', 'filename', 'data', 'digest', 'file_id']
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.basename(str(path).split('?')[0]) or 'photo.jpg'
+        self.data = None
+        self.digest = None
+        self.file_id = None
+
+class TelegramGateway(object):
+    '''
+    Non-blocking sender of Telegram messages and photos.
+    '''
+
+    def __init__(self, bot, log=None, interval=1., retries=3, backoff=1., maxsize=500, photoCache=16,
+                 photoSize=None, photoQuality=85):
+        '''
+        :param bot: telegram.Bot.
+        :param log: Logger.
+        :param interval: Minimum time, in seconds, between requests to the same chat.
+        :param retries: Number of times a failed request is retried before the message is dropped.
+        :param backoff: Wait, in seconds, before the first retry. Doubles on every retry.
+        :param maxsize: Maximum number of messages waiting to be sent, over all chats.
+        :param photoCache: Number of file_ids of recently sent images kept.
+        :param photoSize: If given, photos larger than this (in pixels, longest side) are downsampled and sent as jpeg.
+                          Needs PIL.
+        :param photoQuality: Jpeg quality of the downsampled photos.
+        '''
+        self.bot = bot
+        self.log = log if log is not None else logging.getLogger(__name__)
+        self.interval = float(interval)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.maxsize = int(maxsize)
+        self.photoCache = int(photoCache)
+        self.photoSize = int(photoSize) if photoSize is not None else None
+        self.photoQuality = int(photoQuality)
+
+        # Content digest -> file_id, most recently used last
+        self._fileIds = collections.OrderedDict()
+
+        # chat_id -> deque of _Outbound and time the chat can be sent to again
+        self._pending = collections.OrderedDict()
+        self._nextSend = {}
+        self._size = 0
+
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._deadline = None
+        self._thread = None
+
+        self._stats = {'queued': 0, 'sent': 0, 'coalesced': 0, 'retried': 0, 'dropped': 0, 'failed': 0,
+                       'uploaded': 0, 'uploadedBytes': 0, 'reused': 0}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='TelegramGateway')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, flush=5.):
+        '''
+        Stop the sender thread.
+
+        :param flush: Time, in seconds, given to deliver what is still queued.
+        '''
+        with self._cond:
+            self._stopping = True
+            self._deadline = time.time() + flush
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(flush + 1.)
+            self._thread = None
+
+    def isAlive(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = self._size
+        return stats
+
+    def send(self, chat_id, text):
+        '''
+        Queue a text message. Returns immediately.
+        '''
+        self._put(chat_id, _Outbound('text', text))
+
+    def sendPhoto(self, chat_id, path, caption=''):
+        '''
+        Queue a photo, given by a path or url. Returns immediately.
+        '''
+        self._put(chat_id, _Outbound('photo', _Photo(path), caption))
+
+    def broadcast(self, chat_ids, text):
+        for chat_id in chat_ids:
+            self.send(chat_id, text)
+
+    def broadcastPhoto(self, chat_ids, path, caption=''):
+        # One photo for all the chats, so it is fetched and uploaded once
+        photo = _Photo(path)
+        for chat_id in chat_ids:
+            self._put(chat_id, _Outbound('photo', photo, caption))
+
+    def _put(self, chat_id, outbound):
+        with self._cond:
+            if self._stopping:
+                self.log.warning('Telegram gateway stopped, message to %s dropped.' % chat_id)
+                self._stats['dropped'] += 1
+                return
+
+            if self._size >= self.maxsize:
+                self._dropOldest()
+
+            self._pending.setdefault(chat_id, collections.deque()).append(outbound)
+            self._size += 1
+            self._stats['queued'] += 1
+            self._cond.notify()
+
+    def _dropOldest(self):
+        chat_id = min(self._pending.keys(), key=lambda chat: self._pending[chat][0].created)
+        self._pending[chat_id].popleft()
+        if len(self._pending[chat_id]) == 0:
+            del self._pending[chat_id]
+        self._size -= 1
+        self._stats['dropped'] += 1
+        self.log.warning('Telegram queue full, dropped oldest message to %s.' % chat_id)
+
+    def _ready(self, now):
+        '''
+        Chat to send to next and the time to wait for it (0 if it is ready).
+        '''
+        best = None
+        wait = None
+        for chat_id in self._pending.keys():
+            chatWait = max(0., self._nextSend.get(chat_id, 0.) - now)
+            if wait is None or chatWait < wait:
+                best, wait = chat_id, chatWait
+            if wait == 0.:
+                break
+        return best, wait
+
+    def _take(self, chat_id):
+        '''
+        Remove the next request of a chat from the queue: a photo or all the text messages waiting, coalesced.
+        '''
+        queue = self._pending[chat_id]
+        first = queue.popleft()
+        self._size -= 1
+
+        if first.kind == 'text':
+            texts = [first.payload]
+            length = len(first.payload)
+            while len(queue) > 0 and queue[0].kind == 'text' and \
+                    length + len(queue[0].payload) + 1 <= MAX_MESSAGE_LENGTH:
+                outbound = queue.popleft()
+                self._size -= 1
+                texts.append(outbound.payload)
+                length += len(outbound.payload) + 1
+            if len(texts) > 1:
+                self._stats['coalesced'] += len(texts) - 1
+                coalesced = _Outbound('text', '\n'.join(texts))
+                coalesced.created = first.created
+                coalesced.attempts = first.attempts
+                first = coalesced
+
+        if len(queue) == 0:
+            del self._pending[chat_id]
+
+        return first
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._stopping and (self._size == 0 or now > self._deadline):
+                        if self._size > 0:
+                            self.log.warning('Telegram gateway stopped with %i messages not sent.' % self._size)
+                            self._stats['dropped'] += self._size
+                        return
+                    chat_id, wait = self._ready(now)
+                    if chat_id is not None and wait == 0.:
+                        break
+                    if self._stopping:
+                        wait = min(wait, self._deadline - now) if wait is not None else self._deadline - now
+                    self._cond.wait(wait)
+
+                outbound = self._take(chat_id)
+                self._nextSend[chat_id] = now + self.interval
+
+            self._deliver(chat_id, outbound)
+
+    def _deliver(self, chat_id, outbound):
+        try:
+            if outbound.kind == 'text':
+                self.bot.sendMessage(chat_id=chat_id, text=outbound.payload)
+            else:
+                self._deliverPhoto(chat_id, outbound.payload, outbound.caption)
+        except _PERMANENT, e:
+            if outbound.kind == 'photo' and outbound.payload.file_id is not None:
+                # The file_id may not be valid anymore, upload the image again
+                self._forgetPhoto(outbound.payload)
+                self._retry(chat_id, outbound, e)
+                return
+            self.log.error('Could not send %s to %s, dropped: %s' % (outbound.kind, chat_id, repr(e)))
+            with self._cond:
+                self._stats['failed'] += 1
+            return
+        except Exception, e:
+            self._retry(chat_id, outbound, e)
+            return
+
+        with self._cond:
+            self._stats['sent'] += 1
+
+    def _deliverPhoto(self, chat_id, photo, caption):
+        if photo.file_id is None:
+            self._fetchPhoto(photo)
+
+        if photo.file_id is not None:
+            self.bot.sendPhoto(chat_id=chat_id, photo=photo.file_id, caption=caption)
+            with self._cond:
+                self._stats['reused'] += 1
+            return
+
+        fp = StringIO.StringIO(photo.data)
+        fp.name = photo.filename
+        message = self.bot.sendPhoto(chat_id=chat_id, photo=fp, caption=caption)
+
+        with self._cond:
+            self._stats['uploaded'] += 1
+            self._stats['uploadedBytes'] += len(photo.data)
+
+        sizes = getattr(message, 'photo', None)
+        if sizes:
+            # The largest size is the last one
+            photo.file_id = sizes[-1].file_id
+            photo.data = None
+            self._fileIds[photo.digest] = photo.file_id
+            while len(self._fileIds) > self.photoCache:
+                self._fileIds.popitem(last=False)
+
+    def _fetchPhoto(self, photo):
+        if photo.data is None:
+            with contextlib.closing(urllib.urlopen(str(photo.path))) as fp:
+                photo.data = self._downsample(photo, fp.read())
+            photo.digest = hashlib.sha1(photo.data).hexdigest()
+
+        file_id = self._fileIds.pop(photo.digest, None)
+        if file_id is not None:
+            # Sent recently, move it to the end of the cache
+            self._fileIds[photo.digest] = file_id
+            photo.file_id = file_id
+            photo.data = None
+
+    def _forgetPhoto(self, photo):
+        self._fileIds.pop(photo.digest, None)
+        photo.file_id = None
+
+    def _downsample(self, photo, data):
+        if self.photoSize is None:
+            return data
+
+        try:
+            from PIL import Image
+        except ImportError:
+            self.log.warning('PIL not available, sending %s in full size.' % photo.path)
+            return data
+
+        try:
+            image = Image.open(StringIO.StringIO(data))
+            if max(image.size) <= self.photoSize:
+                return data
+            image.thumbnail((self.photoSize, self.photoSize), Image.ANTIALIAS)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            fp = StringIO.StringIO()
+            image.save(fp, 'JPEG', quality=self.photoQuality, optimize=True)
+        except Exception, e:
+            self.log.warning('Could not downsample %s, sending it in full size: %s' % (photo.path, repr(e)))
+            return data
+
+        photo.filename = os.path.splitext(photo.filename)[0] + '.jpg'
+        return fp.getvalue()
+
+    def _retry(self, chat_id, outbound, error):
+        outbound.attempts += 1
+
+        with self._cond:
+            if outbound.attempts > self.retries:
+                self.log.error('Could not send %s to %s after %i attempts, dropped: %s' % (outbound.kind, chat_id,
+                                                                                          outbound.attempts,
+                                                                                          repr(error)))
+                self._stats['failed'] += 1
+                return
+
+            wait = getattr(error, 'retry_after', None)
+            if wait is None:
+                wait = self.backoff * 2 ** (outbound.attempts - 1)
+            self.log.warning('Sending %s to %s failed (%s), retrying in %.1f s.' % (outbound.kind, chat_id,
+                                                                                   repr(error), wait))
+
+            # Back to the front of the chat queue, so the order of the messages is kept
+            self._pending.setdefault(chat_id, collections.deque()).appendleft(outbound)
+            self._size += 1
+            self._nextSend[chat_id] = max(self._nextSend.get(chat_id, 0.), time.time() + wait)
+            self._stats['retried'] += 1
+            self._cond.notify()
+
+class Question(object):
+    '''
+    A question sent with an inline keyboard, waiting for the answer.
+    '''
+
+    def __init__(self, accept=None, callback=None):
+        self.accept = accept
+        self.callback = callback
+        self.messages = []
+        self.answer = None
+        self.user = None
+        self.timer = None
+        self._answered = threading.Event()
+
+    def isOpen(self):
+        return not self._answered.isSet()
+
+    def wait(self, timeout=None):
+        '''
+        Block until the question is answered or times out.
+
+        :return: The answer (callback_data of the button pressed), None if it timed out.
+        '''
+        self._answered.wait(timeout)
+        return self.answer
+
+class CallbackDispatcher(object):
+    '''
+    Routes callback queries to the questions waiting for them. Register dispatch as the CallbackQueryHandler of the
+    Updater.
+    '''
+
+    def __init__(self, log=None):
+        self.log = log if log is not None else logging.getLogger(__name__)
+
+        # (chat_id, message_id) -> Question
+        self._questions = {}
+        # Questions being sent and (bot, update) of the callback queries for unknown messages that arrived meanwhile
+        self._sending = 0
+        self._early = []
+        self._lock = threading.Lock()
+
+    def ask(self, send, timeout, accept=None, callback=None):
+        '''
+        Send a question and wait for the answer in the background.
+
+        :param send: Function that sends the question and returns the message (or list of messages) sent.
+        :param timeout: Time, in seconds, to wait for an answer.
+        :param accept: Function answer -> bool. Answers not accepted are ignored and the question stays open.
+        :param callback: Function question -> None, called once the question is answered or timed out. For callers
+                         that can not block, like the Updater handlers (the answers are dispatched by the same thread).
+        :return: Question.
+        '''
+        question = Question(accept, callback)
+
+        # Sent without the lock, answers to unknown messages arriving meanwhile are kept until it is registered
+        with self._lock:
+            self._sending += 1
+        try:
+            messages = send()
+            if not isinstance(messages, (list, tuple)):
+                messages = [messages]
+            question.messages = list(messages)
+
+            with self._lock:
+                for message in question.messages:
+                    self._questions[(message.chat_id, message.message_id)] = question
+
+                question.timer = threading.Timer(timeout, self._expire, [question])
+                question.timer.setDaemon(True)
+                question.timer.start()
+        finally:
+            self._sent()
+
+        return question
+
+    def _sent(self):
+        # Dispatch again the early answers of the questions registered by now, and all of them once nothing is
+        # being sent (they are answered as no longer open).
+        with self._lock:
+            self._sending -= 1
+            early = [(bot, update) for bot, update in self._early
+                     if self._sending == 0 or self._key(update) in self._questions]
+            self._early = [item for item in self._early if item not in early]
+        for bot, update in early:
+            self.dispatch(bot, update)
+
+    @staticmethod
+    def _key(update):
+        return update.callback_query.message.chat_id, update.callback_query.message.message_id
+
+    def cancelAll(self):
+        '''
+        Time out all the open questions.
+        '''
+        with self._lock:
+            questions = set(self._questions.values())
+        for question in questions:
+            self._expire(question)
+
+    def _close(self, question, answer, user=None):
+        # Must be called with the lock held. Returns False if the question was already closed.
+        if not question.isOpen():
+            return False
+        for message in question.messages:
+            self._questions.pop((message.chat_id, message.message_id), None)
+        if question.timer is not None:
+            question.timer.cancel()
+        question.answer = answer
+        question.user = user
+        question._answered.set()
+        return True
+
+    def _runCallback(self, question):
+        if question.callback is None:
+            return
+        try:
+            question.callback(question)
+        except Exception, e:
+            self.log.exception(e)
+
+    def _expire(self, question):
+        with self._lock:
+            closed = self._close(question, None)
+        if closed:
+            self._runCallback(question)
+
+    def dispatch(self, bot, update):
+        '''
+        Handle a callback query (CallbackQueryHandler callback).
+        '''
+        query = update.callback_query
+        if query is None or query.message is None:
+            return
+
+        user = query.from_user.username or query.from_user.first_name if query.from_user is not None else None
+
+        with self._lock:
+            question = self._questions.get(self._key(update))
+            if question is None and self._sending > 0:
+                # May answer a question still being sent
+                self._early.append((bot, update))
+                return
+            accepted = question is not None and (question.accept is None or question.accept(query.data))
+            closed = accepted and self._close(question, query.data, user)
+
+        if question is None:
+            text = 'This question is no longer open.'
+        elif not accepted:
+            text = 'Unidentified answer %s... Try again...' % query.data
+        else:
+            text = None
+
+        try:
+            bot.answerCallbackQuery(query.id, text=text)
+        except Exception, e:
+            self.log.debug('Could not answer callback query: %s' % repr(e))
+
+        if closed:
+            self._runCallback(question)
@@ -0,0 +1,133 @@
+'''
+Weather station readings shared by the check handlers.
+
+Every weather check used to poll all the stations by itself. The snapshot reads every station once per checklist
+cycle, one thread per station, and handlers only look at the stored readings.
+'''
+
+import datetime
+import threading
+
+class WeatherSnapshot(object):
+    '''
+    Last readings of a list of weather stations. Each reading is stored as returned by the station (an object with
+    value and time), or None if the station could not provide it.
+    '''
+
+    readings = ('temperature', 'humidity', 'wind_speed', 'dew_point', 'sky_transparency')
+
+    def __init__(self, weatherstations, timeout=5.):
+        '''
+        :param weatherstations: List of weather station proxies. None entries are ignored.
+        :param timeout: Maximum time, in seconds, to wait for a station.
+        '''
+        self.weatherstations = [ws for ws in weatherstations if ws is not None]
+        self.timeout = float(timeout)
+
+        self.time = None
+        self._data = [{} for ws in self.weatherstations]
+        self._names = ['%s' % ws for ws in self.weatherstations]
+        self._pending = [None for ws in self.weatherstations]
+        self._lock = threading.Lock()
+        self._first = threading.Lock()
+
+    def __len__(self):
+        return len(self.weatherstations)
+
+    def _fetch(self, index, data):
+        ws = self.weatherstations[index]
+        for reading in self.readings:
+            try:
+                data[reading] = getattr(ws, reading)()
+            except Exception:
+                data[reading] = None
+
+    def refresh(self):
+        '''
+        Read all stations in parallel. Stations that do not answer within timeout, or are still busy with the
+        previous request, keep no readings until the next refresh. Stations are waited for without holding the lock,
+        the previous readings stay available until all new ones are in.
+
+        :return: Set with the names of the readings that changed value (or became available/unavailable) on any
+                 station. Readings that only get older are not reported.
+        '''
+        threads = []
+        with self._lock:
+            for index in range(len(self.weatherstations)):
+                if self._pending[index] is not None and self._pending[index].isAlive():
+                    # Hanging from a previous refresh. Do not pile up requests on it.
+                    continue
+                data = {}
+                thread = threading.Thread(target=self._fetch, args=(index, data))
+                thread.setDaemon(True)
+                thread.start()
+                self._pending[index] = thread
+                threads.append((index, thread, data))
+
+        current = [{} for ws in self.weatherstations]
+        start = datetime.datetime.utcnow()
+        for index, thread, data in threads:
+            elapsed = (datetime.datetime.utcnow() - start).total_seconds()
+            thread.join(max(0., self.timeout - elapsed))
+            if not thread.isAlive():
+                current[index] = data
+
+        with self._lock:
+            previous, self._data = self._data, current
+            self.time = datetime.datetime.utcnow()
+
+        changed = set()
+        for old, new in zip(previous, current):
+            for reading in self.readings:
+                if self._value(old.get(reading)) != self._value(new.get(reading)):
+                    changed.add(reading)
+        return changed
+
+    @staticmethod
+    def _value(reading):
+        return None if reading is None else getattr(reading, 'value', None)
+
+    def _ensure(self):
+        # Handlers running before the first refresh of the cycle trigger it (only once).
+        if self.time is None:
+            with self._first:
+                if self.time is None:
+                    self.refresh()
+
+    def get(self, index, reading):
+        '''
+        Reading of a station, or None if not available.
+        '''
+        self._ensure()
+        return self._data[index].get(reading)
+
+    def fresh(self, reading, max_mins):
+        '''
+        Readings taken less than max_mins minutes ago.
+
+        :return: List of (station name, reading) in station order.
+        '''
+        self._ensure()
+
+        now = datetime.datetime.utcnow()
+        current = self._data
+        valid = []
+        for index in range(len(self.weatherstations)):
+            value = current[index].get(reading)
+            if value is not None and now - value.time < datetime.timedelta(minutes=max_mins):
+                valid.append((self._names[index], value))
+        return valid
+
+    def first(self, reading, max_mins):
+        '''
+        Index and reading of the first station with a reading taken less than max_mins minutes ago, or (None, None).
+        '''
+        self._ensure()
+
+        now = datetime.datetime.utcnow()
+        current = self._data
+        for index in range(len(self.weatherstations)):
+            value = current[index].get(reading)
+            if value is not None and now - value.time < datetime.timedelta(minutes=max_mins):
+                return index, value
+        return None, None
@@ -10,4 +10,7 @@ DEFAULT_PROGRAM_DATABASE = os.path.join(
     SYSTEM_CONFIG_DIRECTORY, 'manager_checklist.db')
 
 DEFAULT_STATUS_DATABASE = os.path.join(
-    SYSTEM_CONFIG_DIRECTORY, 'manager_status.db')
\ No newline at end of file
+    SYSTEM_CONFIG_DIRECTORY, 'manager_status.db')
+
+DEFAULT_STATUS_JOURNAL = os.path.join(
+    SYSTEM_CONFIG_DIRECTORY, 'manager_status.journal')
@@ -0,0 +1,121 @@
+'''
+Database access shared by the checklist, status and scheduler models.
+
+Every model used to create its own engine with the default settings, and sessions are created from many threads
+(checklist workers, Pyro event callbacks, the robobs machine). Here each database gets a single engine with an explicit
+connection pool and SQLite tuned for concurrent access: WAL journal (readers do not block the writer), relaxed
+synchronous mode, memory-mapped I/O and a busy timeout instead of failing right away on a locked database.
+'''
+
+import time
+import threading
+
+from sqlalchemy import create_engine, event, MetaData
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_PRAGMAS = (('journal_mode', 'WAL'),
+                   ('synchronous', 'NORMAL'),
+                   ('mmap_size', 64*1024*1024),
+                   ('busy_timeout', 30000))
+
+_databases = {}
+
+class Database(object):
+    '''
+    Engine, metadata and session factories of a SQLite database.
+
+    Session creates a new session on every call, as the old sessionmaker did. ScopedSession returns the session of
+    the calling thread; call ScopedSession.remove() when the thread is done with it.
+    '''
+
+    def __init__(self, name, path, pool_size=8, max_overflow=16, pool_timeout=30., pragmas=DEFAULT_PRAGMAS):
+        '''
+        :param name: Name used to look up the database and report its stats.
+        :param path: SQLite file.
+        :param pool_size: Number of connections kept open.
+        :param max_overflow: Extra connections allowed when the pool is exhausted.
+        :param pool_timeout: Time, in seconds, to wait for a connection.
+        :param pragmas: Sequence of (pragma, value) executed on every new connection.
+        '''
+        self.name = name
+        self.path = path
+        self.pragmas = pragmas
+
+        self.engine = create_engine('sqlite:///%s' % path,
+                                    echo=False,
+                                    poolclass=QueuePool,
+                                    pool_size=pool_size,
+                                    max_overflow=max_overflow,
+                                    pool_timeout=pool_timeout,
+                                    connect_args={'check_same_thread': False,
+                                                  'timeout': pool_timeout})
+        event.listen(self.engine, 'connect', self._configure)
+
+        self.metaData = MetaData()
+        self.metaData.bind = self.engine
+
+        self.Session = sessionmaker(bind=self.engine)
+        self.ScopedSession = scoped_session(self.Session)
+
+        self._commits = 0
+        self._commitTime = 0.
+        self._maxCommitTime = 0.
+        self._lastCommitTime = 0.
+        self._statsLock = threading.Lock()
+        self._commitStart = threading.local()
+
+        event.listen(self.Session, 'before_commit', self._beforeCommit)
+        event.listen(self.Session, 'after_commit', self._afterCommit)
+
+        _databases[name] = self
+
+    def _configure(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in self.pragmas:
+                cursor.execute('PRAGMA %s=%s' % (pragma, value))
+        finally:
+            cursor.close()
+
+    def _beforeCommit(self, session):
+        self._commitStart.time = time.time()
+
+    def _afterCommit(self, session):
+        start = getattr(self._commitStart, 'time', None)
+        if start is None:
+            return
+        self._commitStart.time = None
+        elapsed = time.time() - start
+        with self._statsLock:
+            self._commits += 1
+            self._commitTime += elapsed
+            self._lastCommitTime = elapsed
+            self._maxCommitTime = max(self._maxCommitTime, elapsed)
+
+    def stats(self):
+        '''
+        Commit latency stats, in milliseconds.
+        '''
+        with self._statsLock:
+            return {'commits': self._commits,
+                    'mean_ms': 1e3*self._commitTime/self._commits if self._commits > 0 else 0.,
+                    'max_ms': 1e3*self._maxCommitTime,
+                    'last_ms': 1e3*self._lastCommitTime,
+                    'pool': self.engine.pool.status()}
+
+    def resetStats(self):
+        with self._statsLock:
+            self._commits = 0
+            self._commitTime = 0.
+            self._maxCommitTime = 0.
+            self._lastCommitTime = 0.
+
+def getDatabase(name):
+    return _databases[name]
+
+def databaseStats():
+    '''
+    Commit latency stats of every database, by name.
+    '''
+    return dict([(name, database.stats()) for name, database in _databases.items()])
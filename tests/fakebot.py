@@ -0,0 +1,255 @@
+'''
+Local stand-in for the Telegram Bot API, used by the tests.
+
+FakeBotServer answers the Bot API methods the supervisor uses (sendMessage, sendPhoto, editMessageText, getUpdates,
+answerCallbackQuery, getMe) over HTTP, so a telegram.Bot created with base_url=server.url talks to it instead of
+api.telegram.org. Every call is recorded, answers can be delayed and failures (flood control, server errors) injected,
+which is what is needed to exercise the notification gateway without a network connection or a real bot.
+
+It can also run on its own, to point a supervisor configuration ("telegram-base-url") at it:
+
+    python tests/fakebot.py --port 8081
+'''
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import json
+import itertools
+import logging
+import threading
+import time
+import urlparse
+
+class _FakeBotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        # Keep the test output clean
+        pass
+
+    def _params(self):
+        params = dict([(key, value[-1]) for key, value in urlparse.parse_qs(urlparse.urlparse(self.path).query).items()])
+
+        if self.command != 'POST':
+            return params
+
+        content_type = self.headers.getheader('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=self.rfile,
+                                    headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST',
+                                             'CONTENT_TYPE': content_type})
+            for key in form.keys():
+                field = form[key]
+                if field.filename:
+                    # Keep only what identifies the upload
+                    params[key] = {'filename': field.filename, 'size': len(field.value)}
+                else:
+                    params[key] = field.value
+        else:
+            body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            if content_type.startswith('application/json'):
+                params.update(json.loads(body) if body else {})
+            else:
+                params.update(dict([(key, value[-1]) for key, value in urlparse.parse_qs(body).items()]))
+
+        return params
+
+    def _answer(self):
+        method = urlparse.urlparse(self.path).path.rstrip('/').split('/')[-1]
+        status, answer = self.server.call(method, self._params())
+
+        body = json.dumps(answer)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _answer
+    do_POST = _answer
+
+class FakeBotServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Bot API server running in a background thread. Use url as the base_url of telegram.Bot (the token is appended to
+    it and ignored).
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.):
+        '''
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 picks a free one.
+        :param latency: Time, in seconds, every call takes to be answered.
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _FakeBotHandler)
+
+        self.latency = latency
+        # (method, params, time) of every call
+        self.calls = []
+
+        self._lock = threading.Condition()
+        self._failures = []
+        self._updates = []
+        self._messageIds = itertools.count(1)
+        self._updateIds = itertools.count(1)
+        self._fileIds = itertools.count(1)
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%i/bot' % self.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def fail(self, error_code=500, retry_after=None, count=1):
+        '''
+        Make the next calls fail.
+
+        :param error_code: HTTP status of the failure (429 with retry_after is Telegram flood control).
+        :param retry_after: Seconds the client is asked to wait before retrying.
+        :param count: Number of calls that fail.
+        '''
+        with self._lock:
+            self._failures.extend([(error_code, retry_after)]*count)
+
+    def pushUpdate(self, update):
+        '''
+        Queue an update (a dict as in the Bot API, without update_id) to be returned by getUpdates.
+
+        :return: The update_id given to it.
+        '''
+        with self._lock:
+            update = dict(update, update_id=self._updateIds.next())
+            self._updates.append(update)
+            self._lock.notifyAll()
+        return update['update_id']
+
+    def pushCallbackQuery(self, message, data, chat_id, username='watcher'):
+        '''
+        Queue the answer to an inline keyboard, as if the user pressed the button with callback_data=data on message
+        (the result of sendMessage).
+        '''
+        return self.pushUpdate({'callback_query': {'id': str(self._updateIds.next()),
+                                                   'from': {'id': chat_id, 'first_name': username,
+                                                            'username': username},
+                                                   'message': message,
+                                                   'chat_instance': str(chat_id),
+                                                   'data': data}})
+
+    def times(self, method=None, chat_id=None):
+        '''
+        Time of the calls recorded so far.
+        '''
+        with self._lock:
+            return [when for name, params, when in self.calls
+                    if (method is None or name == method) and
+                    (chat_id is None or str(params.get('chat_id')) == str(chat_id))]
+
+    def sent(self, method=None, chat_id=None):
+        '''
+        Parameters of the calls recorded so far.
+        '''
+        with self._lock:
+            return [params for name, params, when in self.calls
+                    if (method is None or name == method) and
+                    (chat_id is None or str(params.get('chat_id')) == str(chat_id))]
+
+    def _message(self, params, **kwargs):
+        chat_id = params.get('chat_id')
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        message = {'message_id': self._messageIds.next(),
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private', 'username': 'watcher'}}
+        message.update(kwargs)
+        return message
+
+    def call(self, method, params):
+        '''
+        Answer a Bot API call.
+
+        :return: (HTTP status, answer).
+        '''
+        if self.latency > 0.:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.calls.append((method, params, time.time()))
+
+            if len(self._failures) > 0 and method != 'getUpdates':
+                error_code, retry_after = self._failures.pop(0)
+                answer = {'ok': False, 'error_code': error_code, 'description': 'Injected failure'}
+                if retry_after is not None:
+                    answer['parameters'] = {'retry_after': retry_after}
+                return error_code, answer
+
+            if method == 'getMe':
+                result = {'id': 1, 'first_name': 'FakeBot', 'username': 'fakebot'}
+            elif method == 'sendMessage':
+                result = self._message(params, text=params.get('text', ''))
+            elif method == 'editMessageText':
+                result = self._message(params, text=params.get('text', ''))
+                result['message_id'] = int(params.get('message_id', result['message_id']))
+            elif method == 'sendPhoto':
+                photo = params.get('photo')
+                if isinstance(photo, dict):
+                    file_id = 'fakefile%i' % self._fileIds.next()
+                    size = photo['size']
+                else:
+                    # Reusing an uploaded file
+                    file_id = photo
+                    size = 0
+                result = self._message(params,
+                                       caption=params.get('caption', ''),
+                                       photo=[{'file_id': file_id, 'width': 1, 'height': 1, 'file_size': size}])
+            elif method == 'getUpdates':
+                offset = int(params.get('offset') or 0)
+                timeout = float(params.get('timeout') or 0.)
+                # Acknowledged updates are forgotten, as in the Bot API
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+                deadline = time.time() + timeout
+                while len(self._updates) == 0 and time.time() < deadline:
+                    self._lock.wait(deadline - time.time())
+                    self._updates = [update for update in self._updates if update['update_id'] >= offset]
+                result = list(self._updates)
+            else:
+                result = True
+
+        return 200, {'ok': True, 'result': result}
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [--host HOST] [--port PORT] [--latency SECONDS]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type=int, default=8081)
+    parser.add_option('--latency', type=float, default=0.)
+    opt, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('fakebot')
+
+    server = FakeBotServer(opt.host, opt.port, opt.latency)
+    log.info('Fake Telegram Bot API listening on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,78 @@
+'''
+ConditionsCache eviction, keys and invalidation.
+'''
+
+import unittest
+
+from chimera_supervisor.controllers.scheduler.cache import ConditionsCache
+
+RESTRICTIONS = (1.5, -30., -1., 2.5, 0., 100., 10.)
+
+class TestConditionsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ConditionsCache(size=3, quantum=60.)
+
+    def test_time_bucket(self):
+        key = self.cache.key(1, 1, 58000.0, 600., RESTRICTIONS)
+        self.assertEqual(self.cache.key(1, 1, 58000.0 + 59./86400., 600., RESTRICTIONS), key)
+        self.assertNotEqual(self.cache.key(1, 1, 58000.0 + 61./86400., 600., RESTRICTIONS), key)
+        self.assertNotEqual(self.cache.key(1, 1, 58000.0, 660., RESTRICTIONS), key)
+
+    def test_restrictions_are_part_of_the_key(self):
+        key = self.cache.key(1, 1, 58000.0, 600., RESTRICTIONS)
+        self.cache.put(key, True)
+
+        # The same BlockPar, edited
+        changed = self.cache.key(1, 1, 58000.0, 600., RESTRICTIONS[:3] + (1.5,) + RESTRICTIONS[4:])
+        self.assertNotEqual(changed, key)
+        self.assertIsNone(self.cache.get(changed))
+        self.assertTrue(self.cache.get(key))
+
+    def test_least_recently_used_is_evicted(self):
+        keys = [self.cache.key(tid, 1, 58000.0, 0., RESTRICTIONS) for tid in range(4)]
+        for key in keys[:3]:
+            self.cache.put(key, True)
+
+        # Use the oldest, so the second one is evicted next
+        self.assertTrue(self.cache.get(keys[0]))
+        self.cache.put(keys[3], False)
+
+        self.assertEqual(self.cache.stats()['size'], 3)
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertTrue(self.cache.get(keys[0]))
+        self.assertTrue(self.cache.get(keys[2]))
+        self.assertFalse(self.cache.get(keys[3]))
+
+    def test_false_verdicts_are_cached(self):
+        key = self.cache.key(1, 1, 58000.0, 0., RESTRICTIONS)
+        self.cache.put(key, False)
+        self.assertIs(self.cache.get(key), False)
+
+    def test_invalidate(self):
+        first = self.cache.key(1, 1, 58000.0, 0., RESTRICTIONS)
+        second = self.cache.key(1, 2, 58000.0, 0., RESTRICTIONS)
+        self.cache.put(first, True)
+        self.cache.put(second, True)
+
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(first))
+        self.assertTrue(self.cache.get(second))
+
+        self.cache.invalidate()
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_stats(self):
+        key = self.cache.key(1, 1, 58000.0, 0., RESTRICTIONS)
+        self.cache.get(key)
+        self.cache.put(key, True)
+        self.cache.get(key)
+        self.cache.get(key)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_ratio'], 2./3.)
+
+if __name__ == '__main__':
+    unittest.main()
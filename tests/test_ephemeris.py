@@ -0,0 +1,246 @@
+'''
+Vectorized ephemeris against the chimera Site and Position computations it replaces, at a few epochs.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from chimera.core.manager import Manager
+from chimera.core.site import Site, datetimeFromJD
+from chimera.util.position import Position
+from chimera.util.coord import Coord
+
+from chimera_supervisor.controllers.scheduler import ephemeris
+
+# Start of a few nights (julian dates), around the solstices and an equinox
+EPOCHS = (2457935.5, 2458108.5, 2458197.5)
+NIGHT = np.arange(0., 0.5, 1800./86400.)
+
+class SiteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager()
+        self.manager.addClass(Site, 't80s', {'name': 'T80S',
+                                             'latitude': '-30 10 04.31',
+                                             'longitude': '-70 48 20.48',
+                                             'altitude': '2187',
+                                             'utc_offset': '-4'})
+        self.site = self.manager.getProxy(Site)
+
+        random = np.random.RandomState(11)
+        self.ra = random.uniform(0., 2.*np.pi, 20)
+        self.dec = np.arcsin(random.uniform(-1., 1., 20))
+
+    def tearDown(self):
+        self.manager.shutdown()
+        del self.manager
+
+class TestEphemeris(SiteTestCase):
+
+    def test_lst(self):
+        for epoch in EPOCHS:
+            ephem = ephemeris.Ephemeris.fromSite(self.site, epoch + NIGHT)
+            for jd, lst in zip(ephem.jd, ephem.lst):
+                reference = float(self.site.LST_inRads(datetimeFromJD(jd)))
+                # Within a second of time over the night
+                self.assertLess(abs(np.angle(np.exp(1j*(lst - reference)))), np.radians(15./3600.))
+
+    def test_altitude(self):
+        for epoch in EPOCHS:
+            ephem = ephemeris.Ephemeris.fromSite(self.site, epoch + NIGHT)
+            alt = ephem.altitude(self.ra, self.dec)
+            self.assertEqual(alt.shape, (len(NIGHT), len(self.ra)))
+
+            for itr in range(0, len(NIGHT), 6):
+                lst = self.site.LST_inRads(datetimeFromJD(ephem.jd[itr]))
+                for i in range(len(self.ra)):
+                    position = Position.fromRaDec(Coord.fromR(self.ra[i]), Coord.fromR(self.dec[i]))
+                    reference = float(self.site.raDecToAltAz(position, lst).alt.D)
+                    self.assertAlmostEqual(alt[itr, i], reference, places=2)
+
+    def test_offset(self):
+        ephem = ephemeris.Ephemeris.fromSite(self.site, EPOCHS[0] + NIGHT)
+        length = np.linspace(0., 3600., len(self.ra))
+
+        later = ephemeris.Ephemeris.fromSite(self.site, EPOCHS[0] + NIGHT + 1800./86400.)
+        # Half an hour offset on every target is the same as the grid half an hour later
+        self.assertTrue(np.allclose(ephem.altitude(self.ra, self.dec, 1800.), later.altitude(self.ra, self.dec),
+                                    atol=1e-3))
+        # One offset per target
+        alt = ephem.altitude(self.ra, self.dec, length)
+        for i in range(len(self.ra)):
+            self.assertTrue(np.allclose(alt[:, i], ephem.altitude(self.ra[i], self.dec[i], length[i])[:, 0]))
+
+    def test_regrid(self):
+        ephem = ephemeris.Ephemeris.fromSite(self.site, EPOCHS[1] + NIGHT)
+        jd = EPOCHS[1] + np.linspace(0.1, 0.3, 7)
+        self.assertTrue(np.allclose(ephem.regrid(jd).lst, ephemeris.Ephemeris.fromSite(self.site, jd).lst, atol=1e-5))
+
+class TestMoonTable(SiteTestCase):
+
+    def test_interpolation(self):
+        for epoch in EPOCHS:
+            moon = ephemeris.MoonTable.fromSite(self.site, epoch, epoch + 0.5)
+            self.assertTrue(moon.covers(epoch + 0.25))
+            self.assertFalse(moon.covers(epoch + 0.6))
+
+            # Halfway between the grid points, where interpolation errors are largest
+            for jd in epoch + np.arange(300., 0.5*86400., 3600.)/86400.:
+                dateTime = datetimeFromJD(jd)
+                moonPos = self.site.moonpos(dateTime)
+                moonRaDec = self.site.altAzToRaDec(moonPos, self.site.LST_inRads(dateTime))
+
+                ra, dec = moon.raDec(np.array([jd]))
+                self.assertLess(float(ephemeris.angularSeparation(ra[0], dec[0], float(moonRaDec.ra.R),
+                                                                  float(moonRaDec.dec.R))), 0.01)
+                self.assertAlmostEqual(float(moon.altitude(jd)), float(moonPos.alt.D), places=1)
+                self.assertAlmostEqual(float(moon.brightness(jd)), float(self.site.moonphase(dateTime))*100.,
+                                       places=1)
+
+    def test_cached(self):
+        directory = tempfile.mkdtemp()
+        tables = ephemeris.MoonTable._tables
+        ephemeris.MoonTable._tables = ephemeris.OrderedDict()
+        try:
+            epoch = EPOCHS[0]
+            moon = ephemeris.MoonTable.cached(self.site, epoch, epoch + 0.5, directory=directory)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertIs(ephemeris.MoonTable.cached(self.site, epoch, epoch + 0.5, directory=directory), moon)
+
+            # Loaded from disk once it is gone from memory
+            ephemeris.MoonTable._tables.clear()
+            loaded = ephemeris.MoonTable.cached(self.site, epoch, epoch + 0.5, directory=directory)
+            self.assertIsNot(loaded, moon)
+            self.assertTrue(np.all(loaded.ra == moon.ra))
+            self.assertTrue(np.all(loaded.illumination == moon.illumination))
+
+            # Only the last nights are kept in memory
+            for night in range(ephemeris.MoonTable.MAX_TABLES + 1):
+                ephemeris.MoonTable.cached(self.site, epoch + night, epoch + night + 0.5, step=3600.,
+                                           directory=directory)
+            self.assertEqual(len(ephemeris.MoonTable._tables), ephemeris.MoonTable.MAX_TABLES)
+        finally:
+            ephemeris.MoonTable._tables = tables
+            shutil.rmtree(directory)
+
+    def test_prune(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name, age in (('moon_old.npz', 10.), ('moon_new.npz', 1.), ('other.npz', 10.)):
+                filename = os.path.join(directory, name)
+                open(filename, 'w').close()
+                mtime = os.path.getmtime(filename) - age*86400.
+                os.utime(filename, (mtime, mtime))
+
+            ephemeris.MoonTable.prune(directory, keep=7.)
+            self.assertEqual(sorted(os.listdir(directory)), ['moon_new.npz', 'other.npz'])
+        finally:
+            shutil.rmtree(directory)
+
+class TestMoonSeparation(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(5)
+        self.ra = random.uniform(0., 2.*np.pi, 30)
+        self.dec = np.arcsin(random.uniform(-1., 1., 30))
+
+        jd = np.linspace(2458000.5, 2458001., 25)
+        # Right ascension crossing 0h during the night
+        self.moon = ephemeris.MoonTable(jd, np.mod(np.linspace(6., 6.6, 25), 2.*np.pi), np.linspace(-0.4, -0.3, 25),
+                                        np.linspace(-10., 50., 25), np.zeros_like(jd) + 0.6)
+
+    def test_angsep(self):
+        jd = np.linspace(2458000.5, 2458001., 13)
+        separation = self.moon.separation(jd, self.ra, self.dec)
+        self.assertEqual(separation.shape, (len(jd), len(self.ra)))
+
+        for itr in range(len(jd)):
+            moonPosition = self.moon.position(jd[itr])
+            for i in range(len(self.ra)):
+                position = Position.fromRaDec(Coord.fromR(self.ra[i]), Coord.fromR(self.dec[i]))
+                self.assertAlmostEqual(separation[itr, i], float(moonPosition.angsep(position).D), places=6)
+
+    def test_moon_mask(self):
+        jd = np.linspace(2458000.5, 2458001., 13)
+        minDist = np.linspace(0., 90., len(self.ra))
+        minBright = np.zeros(len(self.ra)) + 50.
+        maxBright = np.linspace(40., 100., len(self.ra))
+
+        separation = self.moon.separation(jd, self.ra, self.dec)
+        below = self.moon.altitude(jd) < 0.
+        mask = self.moon.moonMask(jd, self.ra, self.dec, minDist, minBright, maxBright)
+
+        for itr in range(len(jd)):
+            for i in range(len(self.ra)):
+                bright = below[itr] or minBright[i] < 60. < maxBright[i]
+                self.assertEqual(mask[itr, i], separation[itr, i] > minDist[i] and bright)
+
+        self.assertTrue(np.all(self.moon.moonMask(jd, self.ra, self.dec, minDist) == (separation > minDist)))
+
+def linearScan(condition, start, end, step):
+    # Walk back from end, one step at a time, while condition holds
+    grid = end - np.arange(0., (end - start)*86400. + step/2., step)/86400.
+    feasible = condition(grid)
+    if not feasible[0]:
+        return None
+    infeasible = np.where(np.bitwise_not(feasible))[0]
+    return grid[-1] if len(infeasible) == 0 else grid[infeasible[0]-1]
+
+class TestEarliestFeasible(unittest.TestCase):
+
+    def setUp(self):
+        self.ephem = ephemeris.Ephemeris(np.array([2458000.5]), np.radians(-30.), 0.)
+        self.start, self.end = 2458000.5, 2458000.9
+
+    def airmassCondition(self, ra, dec, maxairmass):
+        def condition(jd):
+            alt = ephemeris.altitude(self.ephem.lstAt(jd), self.ephem.latitude, ra, dec)
+            return (alt > 0.) & (ephemeris.airmass(alt) < maxairmass)
+        return condition
+
+    def test_linear_scan(self):
+        random = np.random.RandomState(9)
+        for i in range(50):
+            condition = self.airmassCondition(random.uniform(0., 2.*np.pi), random.uniform(-1.4, 0.5),
+                                              random.uniform(1.1, 2.5))
+            jd = ephemeris.earliestFeasible(condition, self.start, self.end, step=60., tolerance=1.)
+            reference = linearScan(condition, self.start, self.end, step=1.)
+
+            if reference is None:
+                self.assertIsNone(jd)
+                continue
+            self.assertAlmostEqual(jd, reference, delta=2./86400.)
+            self.assertTrue(np.all(condition(np.linspace(jd, self.end, 200))))
+
+    def test_always_and_never(self):
+        always = lambda jd: np.ones(len(jd), dtype=bool)
+        never = lambda jd: np.zeros(len(jd), dtype=bool)
+        self.assertEqual(ephemeris.earliestFeasible(always, self.start, self.end), self.start)
+        self.assertIsNone(ephemeris.earliestFeasible(never, self.start, self.end))
+
+    def test_last_window(self):
+        # Feasible twice, only the window that reaches end counts
+        switch = (self.start + 0.1, self.start + 0.2, self.start + 0.3)
+        condition = lambda jd: (jd < switch[0]) | ((jd > switch[1]) & (jd < switch[2])) | (jd > switch[2] + 0.01)
+        jd = ephemeris.earliestFeasible(condition, self.start, self.end, step=600., tolerance=0.1)
+        self.assertAlmostEqual(jd, switch[2] + 0.01, delta=0.1/86400.)
+
+class TestAltitude(unittest.TestCase):
+
+    def test_meridian(self):
+        latitude = np.radians(-30.)
+        dec = np.radians(np.linspace(-89., 59., 20))
+        # Culminating targets
+        alt = ephemeris.Ephemeris(np.array([2458000.5]), latitude, 1.).altitude(np.ones_like(dec), dec)[0]
+        self.assertTrue(np.allclose(alt, 90. - np.abs(np.degrees(latitude - dec))))
+
+    def test_airmass(self):
+        self.assertTrue(np.allclose(ephemeris.airmass(np.array([90., 30.])), [1., 2.]))
+        self.assertTrue(ephemeris.airmass(np.array([-10.]))[0] < 0.)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''
+SchedulerExecutor against Ephemeris and MoonTable evaluated in the calling process.
+'''
+
+import pickle
+import unittest
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.executor import SchedulerExecutor
+
+LATITUDE = np.radians(-30.)
+
+class TestSchedulerExecutor(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(3)
+        n = 1000
+
+        self.ra = random.uniform(0., 2.*np.pi, n)
+        self.dec = np.arcsin(random.uniform(-1., 1., n))
+        self.length = random.uniform(60., 3600., n)
+        self.minDist = random.uniform(0., 40., n)
+        self.minBright = random.uniform(0., 50., n)
+        self.maxBright = self.minBright + random.uniform(0., 50., n)
+
+        start = 2458000.5
+        self.ephem = ephemeris.Ephemeris(start + np.arange(0., 0.4, 300./86400.), LATITUDE, 1.)
+        jd = np.linspace(start, start + 0.5, 50)
+        self.moon = ephemeris.MoonTable(jd, np.linspace(0., 0.5, 50), np.zeros_like(jd) - 0.3,
+                                        np.linspace(-20., 40., 50), np.zeros_like(jd) + 0.4)
+
+    def test_partition(self):
+        executor = SchedulerExecutor(4, chunksize=100)
+        try:
+            for ntargets in (1, 150, 1000, 1001):
+                chunks = executor.partition(ntargets)
+                self.assertLessEqual(len(chunks), 4)
+                self.assertEqual(np.hstack([np.arange(ntargets)[chunk] for chunk in chunks]).tolist(),
+                                 range(ntargets))
+        finally:
+            executor.close()
+
+    def test_same_as_calling_process(self):
+        altitude = self.ephem.altitude(self.ra, self.dec, self.length)
+        moonMask = self.moon.moonMask(self.ephem.jd, self.ra, self.dec, self.minDist, self.minBright, self.maxBright)
+        separation = self.moon.moonMask(self.ephem.jd, self.ra, self.dec, self.minDist)
+
+        for processes in (1, 3):
+            with SchedulerExecutor(processes, chunksize=100) as executor:
+                self.assertTrue(np.allclose(executor.altitude(self.ephem, self.ra, self.dec, self.length), altitude))
+                self.assertTrue(np.allclose(executor.altitude(self.ephem, self.ra, self.dec),
+                                            self.ephem.altitude(self.ra, self.dec)))
+                self.assertTrue(np.all(executor.moonMask(self.moon, self.ephem.jd, self.ra, self.dec, self.minDist,
+                                                         self.minBright, self.maxBright) == moonMask))
+                self.assertTrue(np.all(executor.moonMask(self.moon, self.ephem.jd, self.ra, self.dec,
+                                                         self.minDist) == separation))
+
+    def test_tasks_carry_no_ephemeris(self):
+        executor = SchedulerExecutor(4, chunksize=100)
+        tasks = []
+        executor._map = lambda function, chunks: tasks.extend(chunks) or [function(task) for task in chunks]
+
+        try:
+            executor.altitude(self.ephem, self.ra, self.dec, self.length)
+            executor.moonMask(self.moon, self.ephem.jd, self.ra, self.dec, self.minDist, self.minBright,
+                              self.maxBright)
+        finally:
+            executor.close()
+
+        self.assertGreater(len(tasks), 2)
+        for task in tasks:
+            self.assertFalse(any([isinstance(item, (ephemeris.Ephemeris, ephemeris.MoonTable)) for item in task]))
+            # The time grid plus the slice of targets of the task
+            self.assertLess(len(pickle.dumps(task, 2)), 16*(4*len(self.ephem.jd) + 5*100) + 2048)
+
+if __name__ == '__main__':
+    unittest.main()
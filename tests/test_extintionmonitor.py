@@ -0,0 +1,78 @@
+'''
+ExtintionMonitor.process slot lengths, with an analytic ephemeris and a moon that is always below the horizon.
+'''
+
+import unittest
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.catalog import TargetCatalog
+from chimera_supervisor.controllers.scheduler.executor import SchedulerExecutor
+from chimera_supervisor.controllers.scheduler.algorithms import ExtintionMonitor
+
+LATITUDE = np.radians(-30.)
+START = 2458000.5
+END = START + 0.5
+
+def catalog():
+    # A star at the zenith latitude, culminating 6 h after the start of the night
+    data = np.zeros(1, dtype=TargetCatalog.dtype)
+    data['id'] = 1
+    data['blockid'] = 1
+    data['tid'] = 1
+    data['name'] = 'std'
+    data['ra'] = np.pi/2.
+    data['dec'] = LATITUDE
+    data['minmoonDist'] = -1.
+    data['minmoonBright'] = 0.
+    data['maxmoonBright'] = 100.
+    data['minairmass'] = -1.
+    data['maxairmass'] = 2.5
+    data['length'] = 1000.
+    data['exptime'] = 60.
+    data['frames'] = 2
+    data['focusAlign'] = 1
+    data['lastObservation'] = np.nan
+    return TargetCatalog(data)
+
+class TestExtintionMonitor(unittest.TestCase):
+
+    def setUp(self):
+        jd = np.linspace(START, END, 100)
+        self.moon = ephemeris.MoonTable(jd, np.zeros_like(jd), np.zeros_like(jd) + np.radians(80.),
+                                        np.zeros_like(jd) - 30., np.zeros_like(jd))
+        self.ephem = ephemeris.Ephemeris(np.array([START]), LATITUDE, 0.)
+        self.executor = SchedulerExecutor(1)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def process(self, **kwargs):
+        return ExtintionMonitor.process(60.,
+                                        obsStart=START,
+                                        obsEnd=END,
+                                        catalog=catalog(),
+                                        ephem=self.ephem,
+                                        moon=self.moon,
+                                        executor=self.executor,
+                                        config={'nstars': 1, 'nairmass': 3},
+                                        **kwargs)
+
+    def test_duration_is_exposure_time(self):
+        slots = self.process()
+
+        self.assertEqual(len(slots), 3)
+        # Open shutter time only, not the block length
+        for slot in slots:
+            self.assertAlmostEqual((slot['end'] - slot['start'])*86400., 60., places=2)
+
+    def test_overheads(self):
+        slots = self.process(overheads={'readout': 10., 'autofocus': {'align': 100., 'set': 0.}})
+
+        self.assertEqual(len(slots), 3)
+        for slot in slots:
+            self.assertAlmostEqual((slot['end'] - slot['start'])*86400., 60. + 2*10. + 100., places=2)
+
+if __name__ == '__main__':
+    unittest.main()
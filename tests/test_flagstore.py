@@ -0,0 +1,163 @@
+'''
+FlagStore lock semantics, persistence and journal replay, on a temporary status database.
+'''
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from chimera_supervisor.controllers import iostatus_model
+from chimera_supervisor.controllers.iostatus_model import InstrumentOperationStatus
+from chimera_supervisor.controllers.status import InstrumentOperationFlag
+from chimera_supervisor.controllers.flagstore import FlagStore
+
+class TestFlagStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = os.path.join(self.directory, 'status.journal')
+        self.engine = create_engine('sqlite:///%s' % os.path.join(self.directory, 'status.db'))
+        iostatus_model.metaData.create_all(self.engine)
+        iostatus_model.Session.configure(bind=self.engine)
+
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.stop()
+        iostatus_model.Session.configure(bind=iostatus_model.engine)
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def store(self, flush_interval=3600.):
+        store = FlagStore(logging.getLogger(__name__), self.journal, flush_interval)
+        store.start()
+        self.stores.append(store)
+        return store
+
+    def crash(self, store):
+        # The process dies: the writer never commits again and the journal is left as it is
+        self.stores.remove(store)
+        store._stop.set()
+        store._writer.join()
+        store._journalFile.close()
+        store._journalFile = None
+
+    def stored(self):
+        session = iostatus_model.Session()
+        try:
+            return dict([(str(iostatus.instrument),
+                          (iostatus.status, dict([(str(key.key), key.active) for key in iostatus.keylist])))
+                         for iostatus in session.query(InstrumentOperationStatus)])
+        finally:
+            session.commit()
+
+    def test_lock_unlock(self):
+        store = self.store()
+        store.add('dome', InstrumentOperationFlag.READY)
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.READY)
+
+        self.assertTrue(store.update('dome', InstrumentOperationFlag.LOCK, 'rain'))
+        self.assertTrue(store.update('dome', InstrumentOperationFlag.LOCK, 'wind'))
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.LOCK)
+        self.assertEqual(sorted(store.keys('dome')), ['rain', 'wind'])
+
+        # Still locked by the other key
+        self.assertFalse(store.update('dome', InstrumentOperationFlag.READY, 'rain'))
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.LOCK)
+        self.assertEqual(store.keys('dome'), ['wind'])
+
+        # Unknown keys do not unlock
+        self.assertFalse(store.update('dome', InstrumentOperationFlag.READY, 'other'))
+        self.assertFalse(store.update('dome', InstrumentOperationFlag.READY))
+
+        self.assertTrue(store.update('dome', InstrumentOperationFlag.CLOSE, 'wind'))
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.CLOSE)
+        self.assertEqual(store.keys('dome'), [])
+
+        # Not locked, status just flips
+        self.assertTrue(store.update('dome', InstrumentOperationFlag.READY))
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.READY)
+
+    def test_last_change(self):
+        store = self.store()
+        store.add('telescope', InstrumentOperationFlag.READY)
+        change = store._table['telescope']['lastChange']
+
+        store.update('telescope', InstrumentOperationFlag.READY)
+        self.assertEqual(store._table['telescope']['lastChange'], change)
+        self.assertGreaterEqual(store._table['telescope']['lastUpdate'], change)
+
+        store.update('telescope', InstrumentOperationFlag.CLOSE)
+        self.assertGreaterEqual(store._table['telescope']['lastChange'], change)
+
+    def test_write_behind(self):
+        store = self.store()
+        store.add('dome', InstrumentOperationFlag.READY)
+        store.update('dome', InstrumentOperationFlag.LOCK, 'rain')
+        # Nothing committed until the next flush
+        self.assertEqual(self.stored(), {})
+
+        store.flush()
+        self.assertEqual(self.stored(), {'dome': (InstrumentOperationFlag.LOCK.index, {'rain': True})})
+        self.assertFalse(os.path.exists(self.journal + '.old'))
+
+        store.update('dome', InstrumentOperationFlag.READY, 'rain')
+        store.stop()
+        self.stores.remove(store)
+        self.assertEqual(self.stored(), {'dome': (InstrumentOperationFlag.READY.index, {'rain': False})})
+
+        # Loaded from the database
+        store = self.store()
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.READY)
+        self.assertEqual(store.keys('dome'), [])
+
+    def test_replay_after_crash(self):
+        store = self.store()
+        store.add('dome', InstrumentOperationFlag.READY)
+        store.add('telescope', InstrumentOperationFlag.READY)
+        store.flush()
+
+        store.update('dome', InstrumentOperationFlag.LOCK, 'rain')
+        store.update('telescope', InstrumentOperationFlag.CLOSE)
+        self.crash(store)
+        # Record cut short by the crash
+        with open(self.journal, 'a') as fp:
+            fp.write('{"instrument": "dome", "sta')
+
+        self.assertEqual(self.stored()['dome'][0], InstrumentOperationFlag.READY.index)
+
+        store = self.store()
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.LOCK)
+        self.assertEqual(store.keys('dome'), ['rain'])
+        self.assertEqual(store.status('telescope'), InstrumentOperationFlag.CLOSE)
+
+        # Replayed entries are committed on start
+        self.assertEqual(self.stored(), {'dome': (InstrumentOperationFlag.LOCK.index, {'rain': True}),
+                                         'telescope': (InstrumentOperationFlag.CLOSE.index, {})})
+        self.assertFalse(os.path.exists(self.journal + '.old'))
+
+    def test_replay_failed_commit(self):
+        store = self.store()
+        store.add('dome', InstrumentOperationFlag.READY)
+        store.flush()
+        store.update('dome', InstrumentOperationFlag.CLOSE)
+        # Crash while committing: the batch is in the old journal, newer entries in the journal
+        with store._journalLock:
+            store._journalFile.close()
+            store._rotate()
+            store._journalFile = open(self.journal, 'a')
+        store.update('dome', InstrumentOperationFlag.LOCK, 'rain')
+        self.crash(store)
+
+        store = self.store()
+        self.assertEqual(store.status('dome'), InstrumentOperationFlag.LOCK)
+        self.assertEqual(store.keys('dome'), ['rain'])
+        self.assertEqual(self.stored(), {'dome': (InstrumentOperationFlag.LOCK.index, {'rain': True})})
+
+if __name__ == '__main__':
+    unittest.main()
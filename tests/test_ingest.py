@@ -0,0 +1,246 @@
+'''
+Bulk target and observing block ingest: coordinate parsing against Coord and writes on a temporary scheduler database.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+
+from chimera.util.coord import Coord
+
+from chimera_supervisor.controllers.scheduler import model, ingest
+from chimera_supervisor.controllers.scheduler.model import (Targets, ObsBlock, Action, AutoFocus, AutoFlat,
+                                                             PointVerify, Point, Expose)
+
+ACTIONS = {'autofocus': AutoFocus,
+           'autoflat': AutoFlat,
+           'pointverify': PointVerify,
+           'point': Point,
+           'expose': Expose}
+
+ACTION_FILE = '''
+pre-actions:
+  - action: autofocus
+    step: 0
+    filter: R
+pos-actions:
+  - action: point
+    offset:
+      north: 10
+  - action: expose
+    exptime: 30
+    frames: 2
+    filter: R
+    objectName: "{name}-{blockid}"
+  - action: autofocus
+    start: 0
+    end: 10
+    step: 1
+'''
+
+# Exposures with the read out time, plus a focus sequence
+BLOCK_LENGTH = (30. + 12.)*2 + 600.
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(self.directory, 'robobs.db'))
+        model.metaData.create_all(self.engine)
+        model.Session.configure(bind=self.engine)
+        self.session = model.Session()
+
+    def tearDown(self):
+        self.session.close()
+        model.Session.configure(bind=model.engine)
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def write(self, filename, text):
+        filename = os.path.join(self.directory, filename)
+        with open(filename, 'w') as fp:
+            fp.write(text)
+        return filename
+
+class TestParse(unittest.TestCase):
+
+    def test_sexagesimal(self):
+        values = ['10:20:30.5', '10 20 30.5', '10h20m30.5s', '-10d20\'30.5"', '+10:20', '-00:30:00', '15.25',
+                  ' 1:2:3 ']
+        result, valid = ingest.parseSexagesimal(values)
+
+        self.assertTrue(np.all(valid))
+        for value, parsed in zip(values[:3], result[:3]):
+            self.assertAlmostEqual(parsed, Coord.fromHMS('10:20:30.5').H, places=9)
+        self.assertAlmostEqual(result[3], Coord.fromDMS('-10:20:30.5').D, places=9)
+        self.assertAlmostEqual(result[4], 10. + 20./60., places=9)
+        # The sign applies to the whole value, even with a zero first field
+        self.assertAlmostEqual(result[5], -0.5, places=9)
+        self.assertAlmostEqual(result[6], 15.25, places=9)
+        self.assertAlmostEqual(result[7], Coord.fromDMS('1:2:3').D, places=9)
+
+    def test_invalid(self):
+        result, valid = ingest.parseSexagesimal(['10:61:00', '10:20:60', 'ten', '', '10:-5:00', '10:20:30'])
+        self.assertEqual(valid.tolist(), [False, False, False, False, False, True])
+
+    def test_ra_dec(self):
+        ra, dec, valid = ingest.parseRaDec(['05:35:17.3', '24:00:00', '23:59:59.9', '12', 'x'],
+                                           ['-05:23:28', '10', '+90:00:00', '-90:00:01', '0'])
+
+        self.assertEqual(valid.tolist(), [True, False, True, False, False])
+        self.assertAlmostEqual(ra[0], Coord.fromHMS('05:35:17.3').H, places=9)
+        self.assertAlmostEqual(dec[0], Coord.fromDMS('-05:23:28').D, places=9)
+
+    def test_to_float(self):
+        result = ingest.toFloat(['1.5', ' ', 'x', '-2'], empty=0.)
+        self.assertEqual(result[[0, 1, 3]].tolist(), [1.5, 0., -2.])
+        self.assertTrue(np.isnan(result[2]))
+
+class TestTargetIngest(DatabaseTestCase):
+
+    def test_read_chunks(self):
+        filename = self.write('targets.csv', 'Name,RA,DEC,Mag\n' +
+                                             ''.join(['t%i,%i:00:00,-10,\n' % (i, i) for i in range(5)]) +
+                                             '\n' +
+                                             't5,05:00:00\n')
+        chunks = list(ingest.readChunks(filename, chunksize=2))
+
+        self.assertEqual([line for line, columns in chunks], [2, 4, 6])
+        self.assertEqual(sorted(chunks[0][1].keys()), ['dec', 'mag', 'name', 'ra'])
+        self.assertEqual(chunks[-1][1]['name'].tolist(), ['t4', 't5'])
+        # Missing fields are blank
+        self.assertEqual(chunks[-1][1]['dec'].tolist(), ['-10', ''])
+
+    def test_insert(self):
+        targetIngest = ingest.TargetIngest(self.session)
+        invalid = targetIngest.add({'name': np.array(['a', 'b', 'c']),
+                                    'ra': np.array(['01:00:00', '25:00:00', '02:30:00']),
+                                    'dec': np.array(['-10:30:00', '0', '+20']),
+                                    'mag': np.array(['12.5', '', '13'])})
+        self.session.commit()
+
+        self.assertEqual(invalid.tolist(), [1])
+        self.assertEqual((targetIngest.inserted, targetIngest.updated, targetIngest.invalid), (2, 0, 1))
+
+        targets = self.session.query(Targets).order_by(Targets.id).all()
+        self.assertEqual([target.name for target in targets], ['a', 'c'])
+        self.assertAlmostEqual(targets[0].targetRa, 1.)
+        self.assertAlmostEqual(targets[0].targetDec, -10.5)
+        self.assertEqual([target.targetMag for target in targets], [12.5, 13.])
+        # Defaults for the columns not in the file
+        self.assertEqual(targets[1].type, 'OBJECT')
+        self.assertEqual(targets[1].targetEpoch, 2000.)
+
+    def test_upsert(self):
+        columns = {'name': np.array(['a', 'b']),
+                   'ra': np.array(['01:00:00', '02:00:00']),
+                   'dec': np.array(['-10', '-20']),
+                   'mag': np.array(['10', '11'])}
+        ingest.TargetIngest(self.session).add(columns)
+        self.session.commit()
+
+        targetIngest = ingest.TargetIngest(self.session, upsert=True)
+        targetIngest.add({'name': np.array(['a', 'b', 'c', 'c']),
+                          'ra': np.array(['01:00:00', '02:00:01', '03:00:00', '03:00:00']),
+                          'dec': np.array(['-10', '-20', '-30', '-30']),
+                          'mag': np.array(['15', '11', '12', '12'])})
+        self.session.commit()
+
+        # a is updated, b moved so it is a new target, c is given twice
+        self.assertEqual((targetIngest.inserted, targetIngest.updated, targetIngest.duplicated), (2, 1, 1))
+        targets = self.session.query(Targets.name, Targets.targetMag).order_by(Targets.id).all()
+        self.assertEqual(targets, [('a', 15.), ('b', 11.), ('b', 11.), ('c', 12.)])
+
+class TestBlockIngest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.actionFile = self.write('block.yaml', ACTION_FILE)
+
+        for name, ra, dec in (('t1', 1., -10.), ('t2', 2., -20.)):
+            self.session.add(Targets(name=name, targetRa=ra, targetDec=dec))
+        self.session.commit()
+        self.tids = [tid for tid, in self.session.query(Targets.id).order_by(Targets.id)]
+
+    def blocks(self, *blockids):
+        return [('P1', blockid, self.tids[blockid-1], self.actionFile, 1) for blockid in blockids]
+
+    def add(self, blocks):
+        blockIngest = ingest.BlockIngest(self.session, ACTIONS)
+        missing = blockIngest.add(blocks)
+        self.session.commit()
+        return blockIngest, missing
+
+    def test_add(self):
+        blockIngest, missing = self.add(self.blocks(1, 2))
+
+        self.assertEqual(missing, [])
+        self.assertEqual((blockIngest.added, blockIngest.replaced, blockIngest.observed), (2, 0, 0))
+
+        blocks = self.session.query(ObsBlock).order_by(ObsBlock.blockid).all()
+        self.assertEqual([(block.blockid, block.objid) for block in blocks], [(1, self.tids[0]), (2, self.tids[1])])
+        for block in blocks:
+            self.assertAlmostEqual(block.length, BLOCK_LENGTH)
+            # Pre actions, slew to the target and pos actions
+            self.assertEqual([action.action_type for action in block.actions],
+                             ['AutoFocus', 'Point', 'Point', 'Expose', 'AutoFocus'])
+
+        slew, offset = blocks[0].actions[1:3]
+        self.assertAlmostEqual(slew.targetRaDec.ra.H, 1.)
+        self.assertAlmostEqual(slew.targetRaDec.dec.D, -10.)
+        self.assertIsNone(offset.targetRaDec)
+        self.assertEqual(offset.offsetNS.AS, 10)
+        self.assertEqual([expose.objectName for expose in self.session.query(Expose).order_by(Expose.id)],
+                         ['t1-1', 't2-2'])
+
+    def test_replace(self):
+        self.add(self.blocks(1, 2))
+        blockIngest, missing = self.add(self.blocks(1, 2))
+
+        self.assertEqual((blockIngest.added, blockIngest.replaced), (0, 2))
+        self.assertEqual(self.session.query(ObsBlock).count(), 2)
+        # The actions of the old blocks are gone
+        self.assertEqual(self.session.query(Action).count(), 10)
+        self.assertEqual(self.session.query(Expose).count(), 2)
+
+    def test_observed_is_kept(self):
+        self.add(self.blocks(1, 2))
+        self.session.query(ObsBlock).filter(ObsBlock.blockid == 1).update({'observed': True})
+        self.session.commit()
+        observed = self.session.query(ObsBlock.id).filter(ObsBlock.blockid == 1).scalar()
+
+        blockIngest, missing = self.add(self.blocks(1, 2))
+
+        self.assertEqual((blockIngest.added, blockIngest.replaced, blockIngest.observed), (0, 1, 1))
+        self.assertEqual(self.session.query(ObsBlock.id).filter(ObsBlock.blockid == 1).scalar(), observed)
+        self.assertEqual(self.session.query(ObsBlock).count(), 2)
+
+    def test_block_given_twice(self):
+        blockIngest, missing = self.add(self.blocks(1, 1))
+
+        self.assertEqual(blockIngest.added, 1)
+        self.assertEqual(self.session.query(ObsBlock).count(), 1)
+
+    def test_missing_target(self):
+        blocks = self.blocks(1) + [('P1', 3, max(self.tids) + 1, self.actionFile, 1)]
+        blockIngest, missing = self.add(blocks)
+
+        self.assertEqual(missing, blocks[1:])
+        self.assertEqual(self.session.query(ObsBlock).count(), 0)
+
+    def test_template_read_once(self):
+        blockIngest = ingest.BlockIngest(self.session, ACTIONS)
+        blockIngest.add(self.blocks(1))
+        os.remove(self.actionFile)
+
+        self.assertEqual(blockIngest.add(self.blocks(2)), [])
+        self.session.commit()
+        self.assertEqual(self.session.query(ObsBlock).count(), 2)
+        self.assertEqual(len(blockIngest.templates), 1)
+
+if __name__ == '__main__':
+    unittest.main()
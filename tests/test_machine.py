@@ -0,0 +1,158 @@
+'''
+RobObs state machine transitions and the BUSY timeout, with a fake RobObs and scheduler.
+'''
+
+import time
+import logging
+import threading
+import unittest
+
+from chimera.controllers.scheduler.states import State
+
+from chimera_supervisor.controllers.scheduler.machine import Machine
+
+class FakeScheduler(object):
+
+    def __init__(self):
+        self.started = 0
+        self.queried = 0
+        self.current = State.OFF
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.started += 1
+            self.current = State.BUSY
+
+    def state(self):
+        with self.lock:
+            self.queried += 1
+            return self.current
+
+class FakeRobObs(object):
+
+    def __init__(self):
+        self.sched = FakeScheduler()
+
+    def getLogger(self):
+        return logging.getLogger(__name__)
+
+    def getSched(self):
+        return self.sched
+
+class TestMachine(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = FakeRobObs()
+        self.machines = []
+
+    def tearDown(self):
+        for machine in self.machines:
+            machine.state(State.SHUTDOWN)
+            machine.join(5.)
+
+    def machine(self, busy_timeout=300.):
+        machine = Machine(self.controller, busy_timeout)
+        machine.start()
+        self.machines.append(machine)
+        self.waitFor(lambda: machine.state() == State.OFF)
+        return machine
+
+    def waitFor(self, condition, timeout=5.):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail('Timed out waiting for the machine.')
+            time.sleep(0.01)
+
+    def test_transitions(self):
+        machine = self.machine()
+
+        machine.state(State.START)
+        self.waitFor(lambda: machine.state() == State.BUSY)
+        self.assertEqual(self.controller.sched.started, 1)
+
+        # Events other than the scheduler going OFF are ignored
+        machine.schedulerStateChanged(State.BUSY, State.OFF)
+        self.assertEqual(machine.state(), State.BUSY)
+
+        machine.schedulerStateChanged(State.OFF, State.BUSY)
+        self.assertEqual(machine.state(), State.IDLE)
+
+        # Only a BUSY machine goes IDLE with the scheduler
+        machine.state(State.OFF)
+        machine.schedulerStateChanged(State.OFF, State.BUSY)
+        self.assertEqual(machine.state(), State.OFF)
+
+        machine.state(State.START)
+        self.waitFor(lambda: machine.state() == State.BUSY)
+        self.assertEqual(self.controller.sched.started, 2)
+
+        machine.state(State.SHUTDOWN)
+        machine.join(5.)
+        self.assertFalse(machine.isAlive())
+
+    def test_no_spinning(self):
+        machine = self.machine()
+        machine.state(State.START)
+        self.waitFor(lambda: machine.state() == State.BUSY)
+        time.sleep(0.2)
+
+        # Asleep until an event arrives, the scheduler is never asked for its state
+        stats = machine.stats()
+        self.assertEqual(stats[str(State.BUSY)]['wakeups'], 1)
+        self.assertEqual(stats[str(State.OFF)]['wakeups'], 1)
+        self.assertEqual(self.controller.sched.queried, 0)
+
+        # Waking up without a state change goes back to sleep
+        machine.wakeup()
+        time.sleep(0.1)
+        self.assertEqual(machine.stats()[str(State.BUSY)]['wakeups'], 1)
+
+        machine.schedulerStateChanged(State.OFF, State.BUSY)
+        self.waitFor(lambda: machine.stats().get(str(State.IDLE), {}).get('wakeups') == 1)
+        self.assertGreater(machine.stats()[str(State.BUSY)]['time'], 0.2)
+
+    def test_busy_timeout(self):
+        machine = self.machine(busy_timeout=0.1)
+        machine.state(State.START)
+        self.waitFor(lambda: machine.state() == State.BUSY)
+
+        # Still running, the machine stays BUSY and checks again after each timeout
+        self.waitFor(lambda: self.controller.sched.queried >= 2)
+        self.assertEqual(machine.state(), State.BUSY)
+
+        # The stateChanged event is lost
+        with self.controller.sched.lock:
+            self.controller.sched.current = State.OFF
+        self.waitFor(lambda: machine.state() == State.IDLE, timeout=1.)
+
+    def test_busy_timeout_error(self):
+        def broken():
+            self.controller.sched.queried += 1
+            raise RuntimeError('scheduler is gone')
+        self.controller.sched.state = broken
+
+        machine = self.machine(busy_timeout=0.1)
+        machine.state(State.START)
+
+        # Errors asking the scheduler do not end the machine
+        self.waitFor(lambda: self.controller.sched.queried >= 2)
+        self.assertTrue(machine.isAlive())
+        self.assertEqual(machine.state(), State.BUSY)
+
+    def test_sleep(self):
+        machine = Machine(self.controller)
+        machine.state(State.IDLE)
+
+        begin = time.time()
+        self.assertFalse(machine.sleep(State.IDLE, 0.1))
+        self.assertGreaterEqual(time.time() - begin, 0.1)
+
+        # Returns right away once the state already changed
+        threading.Timer(0.05, machine.state, (State.START,)).start()
+        self.assertTrue(machine.sleep(State.IDLE, 5.))
+        self.assertTrue(machine.sleep(State.IDLE, 5.))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+'''
+Planner look-ahead hit and miss rules, with a fake RobObs and the scheduler models on a temporary database.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from chimera_supervisor.controllers.scheduler import model
+from chimera_supervisor.controllers.scheduler.model import Program
+from chimera_supervisor.controllers.scheduler.planner import Planner
+
+PROGRAM_LENGTH = 600.
+
+class FakeSite(object):
+
+    def __init__(self, mjd):
+        self.mjd = mjd
+
+    def MJD(self):
+        return self.mjd
+
+class FakeRobObs(object):
+    '''
+    Selects the unfinished programs in priority and slewAt order. Dry runs move slewAt earlier, without storing it,
+    like getProgram does when a program can be observed before its slewAt.
+    '''
+
+    def __init__(self, mjd):
+        self.site = FakeSite(mjd)
+        self.conditions = True
+        self.reshedules = []
+        self.submitted = []
+
+    def getLogger(self):
+        return None
+
+    def getSite(self):
+        return self.site
+
+    def isOn(self):
+        return True
+
+    def wake(self):
+        pass
+
+    def parkIfIdle(self):
+        return True
+
+    def programLength(self, program_info):
+        return PROGRAM_LENGTH
+
+    def checkConditions(self, program_info, time, length):
+        return self.conditions
+
+    def loadProgram(self, program_id):
+        session = model.Session(expire_on_commit=False)
+        try:
+            program = session.query(Program).filter(Program.id == program_id, Program.finished == False).first()
+        finally:
+            session.commit()
+        return (program, None, None, None) if program is not None else None
+
+    def reshedule(self, now=None, dryRun=False):
+        self.reshedules.append((now, dryRun))
+        session = model.Session(expire_on_commit=False)
+        try:
+            program = session.query(Program).filter(Program.finished == False).order_by(Program.priority,
+                                                                                        Program.slewAt).first()
+        finally:
+            session.commit()
+        if program is None:
+            return None
+        if dryRun:
+            program.slewAt = now - 0.01
+        return program, None, None, None
+
+    def submit(self, program_info):
+        # Same as RobObs.submit, as far as the robobs queue is concerned
+        session = model.Session()
+        try:
+            program = session.merge(program_info[0])
+            program.finished = True
+        finally:
+            session.commit()
+        self.submitted.append(program_info)
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(self.directory, 'robobs.db'))
+        model.metaData.create_all(self.engine)
+        model.Session.configure(bind=self.engine)
+
+        session = model.Session()
+        for slewAt in (58000.1, 58000.2, 58000.3):
+            session.add(Program(priority=1, slewAt=slewAt))
+        session.commit()
+
+        self.controller = FakeRobObs(58000.1)
+        self.planner = Planner(self.controller, tolerance=600.)
+
+    def tearDown(self):
+        model.Session.configure(bind=model.engine)
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def serve(self, mjd):
+        self.controller.site.mjd = mjd
+        self.controller.reshedules = []
+        self.planner._serve(0.)
+        return self.controller.submitted[-1]
+
+    def lookAheadTime(self):
+        return self.planner._next[1]
+
+    def slewAt(self, program_id):
+        session = model.Session()
+        try:
+            return session.query(Program.slewAt).filter(Program.id == program_id).scalar()
+        finally:
+            session.commit()
+
+    def test_hit(self):
+        first = self.serve(58000.1)
+        self.assertEqual(first[0].id, 1)
+        # Handed over, then looked ahead for the end of the program
+        self.assertEqual(self.controller.reshedules, [(58000.1, False), (58000.1 + PROGRAM_LENGTH/86400., True)])
+
+        second = self.serve(self.lookAheadTime())
+        self.assertEqual(second[0].id, 2)
+        self.assertEqual(self.controller.reshedules[0][1], True)
+        self.assertEqual(self.planner.stats()['lookaheadHits'], 1)
+
+        # Submitted as stored, the slewAt found by the dry run was never written
+        self.assertAlmostEqual(second[0].slewAt, 58000.2)
+        self.assertAlmostEqual(self.slewAt(2), 58000.2)
+
+    def test_miss_late(self):
+        self.serve(58000.1)
+        self.serve(self.lookAheadTime() + 601./86400.)
+
+        self.assertEqual(self.controller.reshedules[0][1], False)
+        self.assertEqual(self.planner.stats()['lookaheadMisses'], 1)
+
+    def test_miss_observed(self):
+        self.serve(58000.1)
+        session = model.Session()
+        session.query(Program).filter(Program.id == 2).update({'finished': True})
+        session.commit()
+
+        second = self.serve(self.lookAheadTime())
+
+        self.assertEqual(second[0].id, 3)
+        self.assertEqual(self.controller.reshedules[0][1], False)
+        self.assertEqual(self.planner.stats()['lookaheadMisses'], 1)
+
+    def test_miss_queue_changed(self):
+        self.serve(58000.1)
+        session = model.Session()
+        session.add(Program(priority=1, slewAt=58000.4))
+        session.commit()
+
+        self.serve(self.lookAheadTime())
+
+        self.assertEqual(self.controller.reshedules[0][1], False)
+        self.assertEqual(self.planner.stats()['lookaheadMisses'], 1)
+
+    def test_miss_higher_priority_due(self):
+        self.serve(58000.1)
+        plannedFor = self.lookAheadTime()
+        session = model.Session()
+        # Already in the queue when the look-ahead was done, comes due right after it
+        session.query(Program).filter(Program.id == 3).update({'priority': 0, 'slewAt': plannedFor + 1./86400.})
+        session.commit()
+
+        self.serve(plannedFor + 60./86400.)
+
+        self.assertEqual(self.controller.reshedules[0][1], False)
+        self.assertEqual(self.planner.stats()['lookaheadMisses'], 1)
+
+    def test_miss_conditions(self):
+        self.serve(58000.1)
+        self.controller.conditions = False
+
+        self.serve(self.lookAheadTime())
+
+        self.assertEqual(self.controller.reshedules[0][1], False)
+        self.assertEqual(self.planner.stats()['lookaheadMisses'], 1)
+
+    def test_invalidate(self):
+        self.serve(58000.1)
+        self.planner.invalidate()
+
+        self.serve(self.lookAheadTime())
+
+        self.assertEqual(self.controller.reshedules[0][1], False)
+        self.assertEqual(self.planner.stats()['lookaheadHits'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+'''
+SeasonSimulator on a synthetic queue, with an analytic ephemeris and a moon that is always below the horizon.
+'''
+
+import unittest
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.simulator import QUEUE_DTYPE, MJD0
+from chimera_supervisor.controllers.scheduler.season import SeasonSimulator, WeatherModel
+from chimera_supervisor.controllers.scheduler.algorithms import Higher
+
+LATITUDE = np.radians(-30.)
+
+def moonBelowHorizon(start, end):
+    jd = np.linspace(start, end, 100) + MJD0
+    return ephemeris.MoonTable(jd,
+                               np.zeros_like(jd),
+                               np.zeros_like(jd) + np.radians(80.),
+                               np.zeros_like(jd) - 30.,
+                               np.zeros_like(jd))
+
+def makeQueue(slewAt):
+    # Targets around the zenith at the start of the first night
+    ra = np.mod(np.radians([-10., -5., 0., 5., 10., 15.]), 2.*np.pi)
+    queue = np.zeros(len(ra), dtype=QUEUE_DTYPE)
+    queue['id'] = np.arange(len(ra)) + 1
+    queue['tid'] = np.arange(len(ra)) + 1
+    queue['blockid'] = np.arange(len(ra)) + 1
+    queue['pid'] = 'TEST'
+    queue['name'] = ['target%i' % i for i in range(len(ra))]
+    queue['slewAt'] = slewAt + np.arange(len(ra))*5./1440.
+    queue['exptime'] = 60.
+    queue['length'] = 120.
+    queue['ra'] = ra
+    queue['dec'] = LATITUDE
+    queue['minairmass'] = -1.
+    queue['maxairmass'] = 2.5
+    queue['minmoonDist'] = -1.
+    queue['minmoonBright'] = 0.
+    queue['maxmoonBright'] = 100.
+    queue['schedalgorith'] = Higher.id()
+    return queue
+
+class TestSeasonSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.nights = [(58000.0, 58000.35), (58001.0, 58001.35)]
+        self.moon = moonBelowHorizon(self.nights[0][0], self.nights[-1][1])
+        self.ephem = ephemeris.Ephemeris(np.array([self.nights[0][0] + MJD0]), LATITUDE, 0.)
+        # Slots of the first night, as makeQueue would have left them
+        self.queue = makeQueue(self.nights[0][0])
+
+    def simulator(self):
+        return SeasonSimulator(self.queue,
+                               {Higher.id(): Higher},
+                               self.ephem,
+                               [(start, end, self.moon) for start, end in self.nights],
+                               WeatherModel(lost=0., closures=0.),
+                               seed=0,
+                               revisit=[Higher.id()])
+
+    def test_queue_is_scheduled_every_night(self):
+        result = self.simulator().run()
+
+        self.assertEqual(len(result.nights), 2)
+        for (start, end), night in zip(self.nights, result.nights):
+            self.assertGreater(len(night.log), 0)
+            # Slots and observations of each night fall inside that night
+            self.assertTrue(np.all(night.log['slewAt'] >= start))
+            self.assertTrue(np.all(night.log['slewAt'] < end))
+            self.assertTrue(np.all(night.log['start'] >= start))
+            self.assertTrue(np.all(night.log['end'] <= end))
+
+        # Every program is back in the queue and observed on both nights
+        self.assertTrue(np.all(result.visits == 2))
+
+    def test_plan_second_night(self):
+        simulator = self.simulator()
+        start, end = self.nights[1]
+        lastVisit = np.zeros(len(self.queue)) + np.nan
+
+        night = simulator.plan(self.queue, start, end, self.moon, lastVisit)
+
+        planned = np.bitwise_not(night['finished'])
+        self.assertTrue(np.any(planned))
+        self.assertTrue(np.all(night['slewAt'][planned] >= start))
+        self.assertTrue(np.all(night['slewAt'][planned] < end))
+        # The queue given to the simulator is left untouched
+        self.assertTrue(np.all(self.queue['slewAt'] < self.nights[0][1]))
+
+    def test_finished_programs_are_not_scheduled(self):
+        simulator = self.simulator()
+        start, end = self.nights[1]
+        queue = np.array(self.queue)
+        queue['finished'][:3] = True
+
+        night = simulator.plan(queue, start, end, self.moon, np.zeros(len(queue)) + np.nan)
+
+        self.assertTrue(np.all(night['finished'][:3]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+'''
+NightSimulator on a small synthetic queue, with an analytic ephemeris and a moon that is always below the horizon.
+'''
+
+import unittest
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.simulator import (NightSimulator, SlewModel, QUEUE_DTYPE, MJD0,
+                                                                simulate)
+
+LATITUDE = np.radians(-30.)
+START, END = 58000.0, 58000.1
+LENGTH, EXPTIME = 600., 500.
+
+class FirstSlew(object):
+    '''
+    Picks the candidate with the earliest slewAt.
+    '''
+
+    @staticmethod
+    def simulatedNext(time, queue, candidates):
+        if len(candidates) == 0:
+            return None
+        return candidates[np.argmin(queue['slewAt'][candidates])]
+
+    @staticmethod
+    def timed_constraint():
+        return False
+
+def makeQueue():
+    # Targets at the zenith at the start of the night, 10 degrees of RA apart
+    ra = np.radians([0., 10., 20.])
+    queue = np.zeros(len(ra), dtype=QUEUE_DTYPE)
+    queue['id'] = np.arange(len(ra)) + 1
+    queue['tid'] = np.arange(len(ra)) + 1
+    queue['blockid'] = np.arange(len(ra)) + 1
+    queue['pid'] = 'TEST'
+    queue['name'] = ['target%i' % i for i in range(len(ra))]
+    queue['priority'] = 1
+    queue['slewAt'] = START + np.array([0., 0.01, 0.02])
+    queue['exptime'] = EXPTIME
+    queue['length'] = LENGTH
+    queue['ra'] = ra
+    queue['dec'] = LATITUDE
+    queue['minairmass'] = -1.
+    queue['maxairmass'] = 2.5
+    queue['minmoonDist'] = -1.
+    queue['minmoonBright'] = 0.
+    queue['maxmoonBright'] = 100.
+    queue['schedalgorith'] = 0
+    return queue
+
+class TestNightSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.ephem = ephemeris.Ephemeris(np.array([START + MJD0]), LATITUDE, 0.)
+        jd = np.linspace(START, END, 20) + MJD0
+        self.moon = ephemeris.MoonTable(jd, np.zeros_like(jd), np.zeros_like(jd) + np.radians(80.),
+                                        np.zeros_like(jd) - 30., np.zeros_like(jd))
+        self.queue = makeQueue()
+        # Time to move 10 degrees of RA at the declination of the targets, at 1 degree per second
+        self.slew = float(ephemeris.angularSeparation(0., LATITUDE, np.radians(10.), LATITUDE))
+
+    def simulator(self, queue=None, closures=None):
+        return NightSimulator(self.queue if queue is None else queue, {0: FirstSlew}, self.ephem, self.moon,
+                              START, END, SlewModel(rate=1.), closures=closures)
+
+    def assertAccounted(self, result):
+        stats = result.stats()
+        self.assertAlmostEqual(stats['idle'] + stats['slew'] + stats['shutter'] + stats['overhead'] +
+                               stats['weather'], stats['night'], places=3)
+
+    def test_run(self):
+        result = self.simulator().run()
+        log = result.log
+
+        self.assertEqual(log['id'].tolist(), [1, 2, 3])
+        # Later programs are observed as soon as the previous one ends, not at their slewAt
+        self.assertAlmostEqual(log['start'][0], START)
+        for i in (1, 2):
+            self.assertAlmostEqual(log['slewAt'][i], log['end'][i-1])
+            self.assertAlmostEqual(log['slew'][i], self.slew, places=6)
+            self.assertAlmostEqual((log['start'][i] - log['end'][i-1])*86400., self.slew, places=3)
+        self.assertTrue(np.allclose((log['end'] - log['start'])*86400., LENGTH))
+        self.assertTrue(np.allclose(log['wait'], 0.))
+        self.assertTrue(np.allclose(log['airmass'][0], 1.))
+
+        stats = result.stats()
+        self.assertEqual(stats['programs'], 3)
+        self.assertAlmostEqual(stats['shutter'], 3*EXPTIME)
+        self.assertAlmostEqual(stats['overhead'], 3*(LENGTH - EXPTIME))
+        self.assertAlmostEqual(stats['slew'], 2*self.slew, places=6)
+        self.assertAlmostEqual(stats['weather'], 0.)
+        self.assertAccounted(result)
+
+        # The queue given to the simulator is left untouched
+        self.assertFalse(np.any(self.queue['finished']))
+
+    def test_deterministic(self):
+        first = self.simulator().run()
+        second = self.simulator().run()
+        self.assertEqual(first.log.tolist(), second.log.tolist())
+        self.assertEqual(first.stats(), second.stats())
+
+        parallel = simulate([self.simulator(), self.simulator()], processes=2)
+        for result in parallel:
+            self.assertEqual(result.log.tolist(), first.log.tolist())
+
+    def test_closure(self):
+        closure = (START + 700./86400., START + 0.05)
+        result = self.simulator(closures=[closure]).run()
+        log = result.log
+
+        self.assertEqual(log['id'].tolist(), [1, 2, 3])
+        # The second program would still be running when the dome closes
+        self.assertAlmostEqual(result.weather, (closure[1] - log['end'][0])*86400., places=3)
+        self.assertGreaterEqual(log['start'][1], closure[1])
+        self.assertAccounted(result)
+
+    def test_nothing_observable(self):
+        queue = makeQueue()
+        queue['maxairmass'] = 0.5
+        result = self.simulator(queue).run()
+
+        self.assertEqual(len(result.log), 0)
+        self.assertAlmostEqual(result.idle, (END - START)*86400., places=3)
+        self.assertAccounted(result)
+
+if __name__ == '__main__':
+    unittest.main()
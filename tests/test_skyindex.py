@@ -0,0 +1,143 @@
+'''
+SkyIndex queries against brute force and SlotEvaluator with and without the index.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from chimera_supervisor.controllers.scheduler import ephemeris
+from chimera_supervisor.controllers.scheduler.skyindex import SkyIndex
+from chimera_supervisor.controllers.scheduler.catalog import TargetCatalog
+from chimera_supervisor.controllers.scheduler.executor import SchedulerExecutor
+from chimera_supervisor.controllers.scheduler.algorithms.base import SlotEvaluator
+
+LATITUDE = np.radians(-30.)
+
+def randomSky(n, random):
+    ra = random.uniform(0., 2.*np.pi, n)
+    dec = np.arcsin(random.uniform(-1., 1., n))
+    return ra, dec
+
+class TestSkyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.random = np.random.RandomState(42)
+        self.ra, self.dec = randomSky(5000, self.random)
+        self.index = SkyIndex(self.ra, self.dec, zoneHeight=2.)
+
+    def test_cone(self):
+        for ra, dec, radius in ((0., 0., 5.), (6.2, -0.5, 20.), (1., 1.5, 10.), (3., -1.55, 30.)):
+            sep = ephemeris.angularSeparation(ra, dec, self.ra, self.dec)
+            self.assertEqual(list(self.index.cone(ra, dec, radius)), list(np.where(sep <= radius)[0]))
+
+    def test_far_from(self):
+        distance = self.random.uniform(0., 40., len(self.ra))
+        sep = ephemeris.angularSeparation(1., 0.2, self.ra, self.dec)
+        self.assertEqual(list(self.index.farFrom(1., 0.2, distance)), list(np.where(sep > distance)[0]))
+
+        candidates = np.arange(0, len(self.ra), 3)
+        self.assertEqual(list(self.index.farFrom(1., 0.2, distance[candidates], candidates)),
+                         list(candidates[sep[candidates] > distance[candidates]]))
+
+    def test_hour_angle_window(self):
+        for lst in (0., 1., 3.5, 6.2):
+            for minAltitude in (0., 20., 45.):
+                alt = ephemeris.altitude(lst, LATITUDE, self.ra, self.dec)
+                window = self.index.hourAngleWindow(lst, LATITUDE, minAltitude)
+                # Every target above the limit is in the window
+                self.assertTrue(np.all(np.in1d(np.where(alt >= minAltitude)[0], window)))
+
+    def test_hour_angle_window_widen(self):
+        widen = ephemeris.hourAngleOffset(3600.)
+        window = self.index.hourAngleWindow(1., LATITUDE, 30., widen)
+        for lst in np.linspace(1. - widen, 1. + widen, 7):
+            alt = ephemeris.altitude(lst, LATITUDE, self.ra, self.dec)
+            self.assertTrue(np.all(np.in1d(np.where(alt >= 30.)[0], window)))
+
+    def test_cached_keeps_recently_used(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = lambda ra, dec: 'skyindex_%s_%.2f.npz' % (SkyIndex.key(ra, dec), 1.)
+
+            first = SkyIndex.cached(self.ra, self.dec, directory=directory, keep=2)
+            skies = [randomSky(100, self.random) for i in range(3)]
+            for ra, dec in skies:
+                # Modification times are compared, make sure they differ
+                time.sleep(1.1)
+                SkyIndex.cached(ra, dec, directory=directory, keep=2)
+
+            self.assertEqual(sorted(os.listdir(directory)), sorted([filename(*skies[1]), filename(*skies[2])]))
+
+            # Loading an index marks it as used, so the other one is removed next
+            time.sleep(1.1)
+            SkyIndex.cached(skies[1][0], skies[1][1], directory=directory, keep=2)
+            time.sleep(1.1)
+            again = SkyIndex.cached(self.ra, self.dec, directory=directory, keep=2)
+
+            self.assertEqual(list(again.order), list(first.order))
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted([filename(*skies[1]), filename(self.ra, self.dec)]))
+        finally:
+            shutil.rmtree(directory)
+
+class TestSlotEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(7)
+        n = 2000
+
+        self.blockPar = np.zeros(n, dtype=TargetCatalog.dtype)
+        self.blockPar['ra'], self.blockPar['dec'] = randomSky(n, random)
+        self.blockPar['length'] = random.uniform(60., 3600., n)
+        self.blockPar['maxairmass'] = random.uniform(1.5, 2.5, n)
+        self.blockPar['minmoonDist'] = random.uniform(0., 40., n)
+        self.blockPar['minmoonBright'] = 0.
+        self.blockPar['maxmoonBright'] = 100.
+        self.available = random.uniform(size=n) > 0.3
+
+        start = 2458000.5
+        self.ephem = ephemeris.Ephemeris(start + np.arange(0., 0.4, 600./86400.), LATITUDE, 0.)
+        jd = np.linspace(start, start + 0.5, 50)
+        self.moon = ephemeris.MoonTable(jd, np.linspace(0., 0.5, 50), np.zeros_like(jd) - 0.3,
+                                        np.zeros_like(jd) + 40., np.zeros_like(jd) + 0.5)
+
+        self.directory = tempfile.mkdtemp()
+        self.cached = SkyIndex.cached
+        SkyIndex.cached = staticmethod(lambda ra, dec: self.cached(ra, dec, directory=self.directory))
+
+    def tearDown(self):
+        SkyIndex.cached = staticmethod(self.cached)
+        shutil.rmtree(self.directory)
+
+    def test_index_and_dense_agree(self):
+        with SchedulerExecutor(1) as executor:
+            dense = SlotEvaluator(self.ephem, self.moon, self.blockPar, executor, index_threshold=len(self.blockPar))
+            indexed = SlotEvaluator(self.ephem, self.moon, self.blockPar, executor, index_threshold=0)
+        self.assertIsNone(dense.index)
+        self.assertIsNotNone(indexed.index)
+
+        for itr in range(len(self.ephem.jd)):
+            selected, alt, start_alt, end_alt = dense.evaluate(itr, self.available)
+            iselected, ialt, istart_alt, iend_alt = indexed.evaluate(itr, self.available)
+
+            # The index only leaves out blocks, never adds or changes them
+            self.assertTrue(np.all(np.in1d(iselected, selected)))
+            position = np.searchsorted(selected, iselected)
+            self.assertTrue(np.allclose(ialt, alt[position]))
+            self.assertTrue(np.allclose(istart_alt, start_alt[position]))
+            self.assertTrue(np.allclose(iend_alt, end_alt[position]))
+
+            # Blocks left out are below the lowest altitude allowed at the middle of the block
+            self.assertTrue(np.all(alt[np.bitwise_not(np.in1d(selected, iselected))] < indexed.minAltitude))
+
+            # So both select the same block
+            if len(selected) > 0 and alt.max() >= indexed.minAltitude:
+                self.assertEqual(iselected[ialt.argmax()], selected[alt.argmax()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+'''
+TelegramGateway against the fake Bot API server (tests/fakebot.py), through a real telegram.Bot, and
+CallbackDispatcher with hand made callback queries.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import telegram
+
+from chimera_supervisor.controllers.telegramgateway import TelegramGateway, CallbackDispatcher
+
+from fakebot import FakeBotServer
+
+# 1x1 transparent png
+PNG = ('\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89'
+       '\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x01\x01\x01\x00\x18\xdd\x8d\xb4\x00\x00\x00\x00IEND\xaeB`\x82')
+
+def waitFor(condition, timeout=10.):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+class TestTelegramGateway(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeBotServer().start()
+        self.bot = telegram.Bot(token='123:TEST', base_url=self.server.url)
+        self.gateway = None
+
+    def tearDown(self):
+        if self.gateway is not None:
+            self.gateway.stop(flush=0.)
+        self.server.stop()
+
+    def startGateway(self, **kwargs):
+        self.gateway = TelegramGateway(self.bot, **kwargs)
+        self.gateway.start()
+        return self.gateway
+
+    def test_broadcast_returns_immediately(self):
+        self.server.latency = 0.5
+        gateway = self.startGateway(interval=0.)
+
+        start = time.time()
+        gateway.broadcast([1, 2, 3], 'Closing dome')
+        self.assertLess(time.time() - start, 0.1)
+
+        self.assertTrue(waitFor(lambda: gateway.stats()['sent'] == 3))
+
+    def test_rate_limit_and_coalescing(self):
+        gateway = self.startGateway(interval=0.5)
+
+        for i in range(5):
+            gateway.send(1, 'message %i' % i)
+            time.sleep(0.05)
+
+        self.assertTrue(waitFor(lambda: gateway.stats()['pending'] == 0 and
+                                        gateway.stats()['sent'] + gateway.stats()['coalesced'] == 5))
+
+        texts = [params['text'] for params in self.server.sent('sendMessage', chat_id=1)]
+        # The first message goes right away, the others pile up while the chat waits and are sent as one
+        self.assertEqual(len(texts), 2)
+        self.assertEqual('\n'.join(texts).split('\n'), ['message %i' % i for i in range(5)])
+
+        times = self.server.times('sendMessage', chat_id=1)
+        self.assertGreaterEqual(times[1] - times[0], 0.45)
+
+    def test_chats_are_rate_limited_independently(self):
+        gateway = self.startGateway(interval=5.)
+
+        gateway.send(1, 'first')
+        gateway.send(2, 'second')
+
+        self.assertTrue(waitFor(lambda: gateway.stats()['sent'] == 2, timeout=2.))
+
+    def test_retry_after(self):
+        gateway = self.startGateway(interval=0., backoff=0.01)
+        self.server.fail(429, retry_after=1)
+
+        start = time.time()
+        gateway.send(1, 'flood')
+
+        self.assertTrue(waitFor(lambda: gateway.stats()['sent'] == 1))
+        # Waits the time asked by flood control, not the backoff
+        self.assertGreaterEqual(self.server.times('sendMessage')[-1] - start, 0.95)
+        self.assertEqual(gateway.stats()['retried'], 1)
+
+    def test_bounded_retries(self):
+        gateway = self.startGateway(interval=0., retries=2, backoff=0.05)
+        self.server.fail(500, count=10)
+
+        gateway.send(1, 'lost')
+
+        self.assertTrue(waitFor(lambda: gateway.stats()['failed'] == 1))
+        stats = gateway.stats()
+        self.assertEqual(stats['sent'], 0)
+        self.assertEqual(stats['retried'], 2)
+        # First attempt and two retries
+        self.assertEqual(len(self.server.sent('sendMessage')), 3)
+
+    def test_permanent_failure_is_not_retried(self):
+        gateway = self.startGateway(interval=0., backoff=0.05)
+        self.server.fail(400)
+
+        gateway.send(1, 'bad request')
+
+        self.assertTrue(waitFor(lambda: gateway.stats()['failed'] == 1))
+        time.sleep(0.2)
+        self.assertEqual(gateway.stats()['retried'], 0)
+        self.assertEqual(len(self.server.sent('sendMessage')), 1)
+
+    def test_queue_is_bounded(self):
+        # Not started, so nothing leaves the queue
+        gateway = TelegramGateway(self.bot, interval=0., maxsize=3)
+
+        for i in range(10):
+            gateway.send(i, 'message %i' % i)
+
+        stats = gateway.stats()
+        self.assertEqual(stats['pending'], 3)
+        self.assertEqual(stats['dropped'], 7)
+
+        self.gateway = gateway
+        gateway.start()
+        self.assertTrue(waitFor(lambda: gateway.stats()['sent'] == 3))
+        # The oldest messages were dropped
+        self.assertEqual(sorted([params['text'] for params in self.server.sent('sendMessage')]),
+                         ['message 7', 'message 8', 'message 9'])
+
+    def test_photo_uploaded_once(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'allsky.png')
+            with open(path, 'wb') as fp:
+                fp.write(PNG)
+
+            gateway = self.startGateway(interval=0.)
+            gateway.broadcastPhoto([1, 2, 3], path, 'All sky')
+            self.assertTrue(waitFor(lambda: gateway.stats()['sent'] == 3))
+
+            # Same image again, reused from the cache
+            gateway.broadcastPhoto([1, 2, 3], path, 'All sky')
+            self.assertTrue(waitFor(lambda: gateway.stats()['sent'] == 6))
+        finally:
+            shutil.rmtree(directory)
+
+        photos = [params['photo'] for params in self.server.sent('sendPhoto')]
+        uploads = [photo for photo in photos if isinstance(photo, dict)]
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(gateway.stats()['uploaded'], 1)
+        self.assertEqual(gateway.stats()['reused'], 5)
+
+class Message(object):
+
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+def callbackUpdate(chat_id, message_id, data):
+    return telegram.Update(1, callback_query=telegram.CallbackQuery('q%i' % message_id,
+                                                                     telegram.User(1, 'Observer'),
+                                                                     'chat',
+                                                                     message=Message(chat_id, message_id),
+                                                                     data=data))
+
+class AnswerBot(object):
+
+    def __init__(self):
+        self.answers = []
+
+    def answerCallbackQuery(self, query_id, text=None):
+        self.answers.append((query_id, text))
+
+class TestCallbackDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = CallbackDispatcher()
+        self.bot = AnswerBot()
+
+    def test_answer(self):
+        question = self.dispatcher.ask(lambda: Message(1, 10), 5., accept=lambda answer: answer in ('yes', 'no'))
+
+        self.dispatcher.dispatch(self.bot, callbackUpdate(1, 10, 'maybe'))
+        self.assertTrue(question.isOpen())
+        self.dispatcher.dispatch(self.bot, callbackUpdate(1, 10, 'yes'))
+
+        self.assertEqual(question.wait(1.), 'yes')
+        self.assertEqual(question.user, 'Observer')
+        self.assertEqual(self.bot.answers, [('q10', 'Unidentified answer maybe... Try again...'), ('q10', None)])
+
+        # Answered already
+        self.dispatcher.dispatch(self.bot, callbackUpdate(1, 10, 'no'))
+        self.assertEqual(self.bot.answers[-1], ('q10', 'This question is no longer open.'))
+        self.assertEqual(question.answer, 'yes')
+
+    def test_timeout(self):
+        answered = threading.Event()
+        question = self.dispatcher.ask(lambda: [Message(1, 10), Message(2, 10)], 0.1,
+                                       callback=lambda question: answered.set())
+
+        self.assertTrue(answered.wait(5.))
+        self.assertIsNone(question.answer)
+        self.assertFalse(question.isOpen())
+
+    def test_dispatch_does_not_wait_for_send(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send():
+            sending.set()
+            release.wait(5.)
+            return Message(1, 10)
+
+        questions = []
+        asking = threading.Thread(target=lambda: questions.append(self.dispatcher.ask(send, 5.)))
+        asking.start()
+        self.assertTrue(sending.wait(5.))
+
+        # Answers to the question being sent, and to an unknown one, arrive before send returns
+        start = time.time()
+        self.dispatcher.dispatch(self.bot, callbackUpdate(1, 10, 'yes'))
+        self.dispatcher.dispatch(self.bot, callbackUpdate(1, 11, 'yes'))
+        self.assertLess(time.time() - start, 1.)
+        self.assertEqual(self.bot.answers, [])
+
+        release.set()
+        asking.join(5.)
+
+        self.assertEqual(questions[0].wait(1.), 'yes')
+        self.assertEqual(sorted(self.bot.answers), [('q10', None), ('q11', 'This question is no longer open.')])
+
+    def test_failed_send(self):
+        def send():
+            self.dispatcher.dispatch(self.bot, callbackUpdate(1, 11, 'yes'))
+            raise IOError('Network is unreachable')
+
+        self.assertRaises(IOError, self.dispatcher.ask, send, 5.)
+        # Early answers are not kept forever
+        self.assertEqual(self.bot.answers, [('q11', 'This question is no longer open.')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+WeatherSnapshot with fake stations, some of them slow to answer.
+'''
+
+import time
+import datetime
+import threading
+import unittest
+from collections import namedtuple
+
+from chimera_supervisor.controllers.weathersnapshot import WeatherSnapshot
+
+Reading = namedtuple('Reading', ['value', 'time'])
+
+class FakeStation(object):
+
+    def __init__(self, name, humidity, delay=0.):
+        self.name = name
+        self.humidity_value = humidity
+        self.delay = delay
+
+    def __str__(self):
+        return self.name
+
+    def humidity(self):
+        time.sleep(self.delay)
+        return Reading(self.humidity_value, datetime.datetime.utcnow())
+
+    def temperature(self):
+        return Reading(20., datetime.datetime.utcnow())
+
+    def wind_speed(self):
+        raise IOError('Not available')
+
+    dew_point = sky_transparency = wind_speed
+
+class TestWeatherSnapshot(unittest.TestCase):
+
+    def test_readings(self):
+        snapshot = WeatherSnapshot([None, FakeStation('ws1', 50.), FakeStation('ws2', 60.)])
+
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.get(1, 'humidity').value, 60.)
+        self.assertIsNone(snapshot.get(0, 'wind_speed'))
+        self.assertEqual([(name, value.value) for name, value in snapshot.fresh('humidity', 1)],
+                         [('ws1', 50.), ('ws2', 60.)])
+        self.assertEqual(snapshot.first('wind_speed', 1), (None, None))
+
+    def test_changed(self):
+        station = FakeStation('ws1', 50.)
+        snapshot = WeatherSnapshot([station])
+
+        self.assertEqual(snapshot.refresh(), set(['humidity', 'temperature']))
+        self.assertEqual(snapshot.refresh(), set())
+        station.humidity_value = 55.
+        self.assertEqual(snapshot.refresh(), set(['humidity']))
+
+    def test_timeout(self):
+        slow = FakeStation('slow', 50., delay=1.)
+        snapshot = WeatherSnapshot([FakeStation('ws1', 50.), slow], timeout=0.2)
+
+        snapshot.refresh()
+        self.assertIsNone(snapshot.get(1, 'humidity'))
+        self.assertEqual(snapshot.get(0, 'humidity').value, 50.)
+
+        # Still busy with the previous request, not asked again
+        pending = snapshot._pending[1]
+        snapshot.refresh()
+        self.assertIs(snapshot._pending[1], pending)
+        self.assertIsNone(snapshot.get(1, 'humidity'))
+
+    def test_readers_do_not_wait_for_refresh(self):
+        station = FakeStation('ws1', 50.)
+        snapshot = WeatherSnapshot([station], timeout=5.)
+        snapshot.refresh()
+
+        station.delay = 1.
+        station.humidity_value = 55.
+        refresh = threading.Thread(target=snapshot.refresh)
+        refresh.start()
+        time.sleep(0.1)
+
+        # The previous readings are served while the station is being read
+        start = time.time()
+        self.assertEqual(snapshot.get(0, 'humidity').value, 50.)
+        self.assertEqual(snapshot.first('humidity', 1)[1].value, 50.)
+        self.assertLess(time.time() - start, 0.5)
+
+        refresh.join()
+        self.assertEqual(snapshot.get(0, 'humidity').value, 55.)
+
+if __name__ == '__main__':
+    unittest.main()